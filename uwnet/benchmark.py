@@ -0,0 +1,635 @@
+"""Micro-benchmarks for the training and inference pipelines
+
+Examples
+--------
+
+Compare the batch throughput of the data loader with and without
+prefetching::
+
+    python -m uwnet.benchmark loader data/processed/reshaped/noBlur/train.zarr
+
+Compare per-sample and batched gathering from XRTimeSeries::
+
+    python -m uwnet.benchmark gather
+
+Time the forward pass of the unfused and fused InnerModel, with separate and
+packed inputs::
+
+    python -m uwnet.benchmark model
+
+Compare the per-step latency of the pickled, bound, and TorchScript models in
+SAM::
+
+    python -m uwnet.benchmark sam
+
+Compare the xarray and tensor engines of the single column model::
+
+    python -m uwnet.benchmark scm
+
+Error versus cost of the time integrators on a stiff single column problem::
+
+    python -m uwnet.benchmark integrators
+
+Peak memory and time of a multiple step training step with checkpointing and
+truncated backpropagation::
+
+    python -m uwnet.benchmark bptt
+
+Peak memory and time of fitting the pca pre/post processors in memory and
+streaming from zarr::
+
+    python -m uwnet.benchmark prepost
+
+Single-pass fitting of the normalization from zarr::
+
+    python -m uwnet.benchmark normalization
+
+Throughput of TensorDict and PackedTensorDict operations::
+
+    python -m uwnet.benchmark tensordict
+
+"""
+import functools
+import time
+from collections.abc import MutableMapping
+
+import click
+import numpy as np
+import torch
+import xarray as xr
+
+
+def _time_iterations(iterable, num_iterations):
+    """Return the number of iterations per second of an iterable"""
+    start = time.perf_counter()
+    count = 0
+    for _ in iterable:
+        count += 1
+        if count >= num_iterations:
+            break
+    elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument('path')
+@click.option('-b', '--batch-size', default=256)
+@click.option('-n', '--num-batches', default=50)
+@click.option('--prefetch', default=4)
+@click.option('--num-workers', default=4)
+@click.option('--executor', default='thread',
+              type=click.Choice(['thread', 'process']))
+def loader(path, batch_size, num_batches, prefetch, num_workers, executor):
+    """Batches/sec of XarrayBatchLoader for the reshaped zarr at PATH"""
+    from uwnet.ml_models.nn.datasets_handler import get_data_loader
+
+    ds = xr.open_zarr(path)
+    configurations = [
+        ('synchronous', {}),
+        (f'prefetch={prefetch} {executor}s={num_workers}',
+         dict(prefetch=prefetch, num_workers=num_workers,
+              executor=executor)),
+        ('chunked', dict(chunked=True)),
+        (f'chunked prefetch={prefetch}',
+         dict(chunked=True, prefetch=prefetch, num_workers=num_workers,
+              executor=executor)),
+    ]
+
+    for name, kwargs in configurations:
+        data_loader = get_data_loader(ds, ['QT', 'SLI'], batch_size,
+                                      loader=kwargs)
+        rate = _time_iterations(data_loader, num_batches)
+        click.echo(f"{name}: {rate:.2f} batches/s")
+
+
+def _random_training_dataset(num_time, num_z, num_y, num_x):
+    dims_3d = ['time', 'z', 'y', 'x']
+    dims_2d = ['time', 'y', 'x']
+    data_vars = {}
+    for key in ['QT', 'SLI', 'FQT', 'FSLI']:
+        data_vars[key] = (dims_3d, np.random.rand(num_time, num_z, num_y,
+                                                  num_x))
+    for key in ['SST', 'SOLIN']:
+        data_vars[key] = (dims_2d, np.random.rand(num_time, num_y, num_x))
+    data_vars['layer_mass'] = (['z'], np.ones(num_z))
+    return xr.Dataset(data_vars)
+
+
+@cli.command()
+@click.option('--num-time', default=8)
+@click.option('-n', '--num-batches', default=20)
+def gather(num_time, num_batches):
+    """Samples/sec of XRTimeSeries with per-sample and batched indexing"""
+    from torch.utils.data import DataLoader
+    from uwnet.ml_models.nn.datasets_handler import (XRTimeSeries,
+                                                     get_batched_data_loader)
+
+    dataset = XRTimeSeries(_random_training_dataset(num_time, 34, 64, 128))
+    for batch_size in [64, 128, 256, 512, 1024]:
+        loaders = [
+            ('per-sample', DataLoader(dataset, batch_size=batch_size,
+                                      shuffle=True)),
+            ('batched', get_batched_data_loader(dataset, batch_size,
+                                                shuffle=True)),
+        ]
+        for name, data_loader in loaders:
+            rate = _time_iterations(data_loader, num_batches) * batch_size
+            click.echo(f"batch_size={batch_size} {name}: "
+                       f"{rate:.0f} samples/s")
+
+
+def _time_call(fun, num_repeats):
+    """Return the mean seconds per call of a function"""
+    fun()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        fun()
+    return (time.perf_counter() - start) / num_repeats
+
+
+def _random_inner_model(num_z, num_pca=20):
+    """InnerModel with random PCA-like pre/post processors"""
+    from uwnet.model import InnerModel
+    from uwnet.testing import random_pca_pre_post
+
+    pre, post = random_pca_pre_post(num_z, num_pca, num_pca,
+                                    scalars=['SHF', 'LHF', 'SOLIN', 'SST'])
+    return InnerModel(pre, post)
+
+
+def _random_columns(model, num_z, num_y, num_x):
+    """Random inputs for the model with shape (z, y, x)"""
+    from uwnet.tensordict import TensorDict
+    return TensorDict({
+        key: torch.rand(num, num_y, num_x)
+        for key, num in model.model[1].inputs
+    })
+
+
+@cli.command()
+@click.option('--grid', default=(128, 64, 34), type=(int, int, int),
+              help="size of the x, y, and z dimensions")
+@click.option('-n', '--num-repeats', default=10)
+def model(grid, num_repeats):
+    """Seconds per call of the unfused, fused, and fused+packed InnerModel"""
+    from uwnet.tensordict import pack
+
+    num_x, num_y, num_z = grid
+    inner_model = _random_inner_model(num_z)
+    columns = _random_columns(inner_model, num_z, num_y, num_x)
+    packed = pack(columns, inner_model.input_names)
+    inputs = columns
+
+    def forward():
+        with torch.no_grad():
+            inner_model(inputs)
+
+    def forward_backward():
+        output = inner_model(inputs)
+        sum(val.sum() for val in output.values()).backward()
+
+    for name, fused, inputs in [('unfused', False, columns),
+                                ('fused', True, columns),
+                                ('fused+packed', True, packed)]:
+        inner_model.fused = fused
+        for fun_name, fun in [('forward', forward),
+                              ('forward+backward', forward_backward)]:
+            seconds = _time_call(fun, num_repeats)
+            click.echo(f"{name} {fun_name}: {seconds * 1000:.2f} ms")
+
+
+@cli.command()
+@click.option('--grid', default=(128, 64, 34), type=(int, int, int),
+              help="size of the x, y, and z dimensions")
+@click.option('-n', '--num-repeats', default=20)
+@click.option('--num-extra', default=50,
+              help="number of state variables not used by the model")
+def sam(grid, num_repeats, num_extra):
+    """Seconds per SAM step of the pickled and TorchScript models"""
+    import tempfile
+    from uwnet.export import save_torchscript, load_torchscript
+    from uwnet.ml_models.nn.sam_interface import (CFVariableNameAdapter,
+                                                  CF_NAMES)
+    from uwnet.numpy_interface import (NumpyWrapper, NumpyBinding,
+                                       FlatNumpyWrapper)
+
+    num_x, num_y, num_z = grid
+    inner_model = _random_inner_model(num_z).eval()
+    to_cf = dict((y, x) for x, y in CF_NAMES)
+    columns = _random_columns(inner_model, num_z, num_y, num_x)
+    state = {to_cf.get(key, key): val.numpy() for key, val in columns.items()}
+    for i in range(num_extra):
+        state[f'extra_{i}'] = np.random.rand(num_y, num_x)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/model.pt"
+        save_torchscript(inner_model, path)
+        module, metadata = load_torchscript(path)
+
+    # SAM passes 2D fields with shape (y, x)
+    flat_state = {key: val[0] if val.shape[0] == 1 else val
+                  for key, val in state.items()}
+    models = [
+        ('pickled', CFVariableNameAdapter(NumpyWrapper(inner_model),
+                                          label='neural_network'), state),
+        ('binding', NumpyBinding(inner_model, rename=to_cf,
+                                 label='neural_network'), state),
+        ('torchscript', FlatNumpyWrapper(module, metadata['inputs'],
+                                         metadata['outputs'], rename=to_cf,
+                                         label='neural_network'), flat_state),
+    ]
+    for name, model, inputs in models:
+        seconds = _time_call(lambda: model(inputs), num_repeats)
+        click.echo(f"{name}: {seconds * 1000:.2f} ms/step")
+
+    # overhead of the interface with a model which does no work
+    from uwnet.tensordict import TensorDict
+
+    def identity(x):
+        return TensorDict({key: x[key] for key in ['QT', 'SLI']})
+
+    identity.input_names = inner_model.input_names
+    overheads = [
+        ('pickled', CFVariableNameAdapter(NumpyWrapper(identity),
+                                          label='neural_network')),
+        ('binding', NumpyBinding(identity, rename=to_cf,
+                                 label='neural_network')),
+    ]
+    for name, model in overheads:
+        seconds = _time_call(lambda: model(state), num_repeats)
+        click.echo(f"{name} overhead: {seconds * 1000:.3f} ms/step")
+
+@cli.command()
+@click.option('--grid', default=(128, 64, 34), type=(int, int, int),
+              help="size of the x, y, and z dimensions")
+@click.option('--num-time', default=10)
+def scm(grid, num_time):
+    """Seconds per run of single_column_simulation with each engine"""
+    from uwnet.columns import single_column_simulation
+
+    num_x, num_y, num_z = grid
+    inner_model = _random_inner_model(num_z).eval()
+    ds = _random_training_dataset(num_time, num_z, num_y, num_x)
+    for key in ['SHF', 'LHF']:
+        ds[key] = ds.SST
+    ds = ds.assign_coords(time=np.arange(num_time) / 8,
+                          z=np.arange(num_z), y=np.arange(num_y),
+                          x=np.arange(num_x))
+
+    for engine in ['xarray', 'tensor']:
+        seconds = _time_call(
+            lambda: single_column_simulation(
+                inner_model, ds, prognostics=['QT', 'SLI'], engine=engine),
+            1)
+        click.echo(f"{engine}: {seconds:.2f} s")
+
+
+class _StiffColumn(torch.nn.Module):
+    """Nonlinear relaxation with timescales from minutes to days
+
+    The apparent source is ``-rate * (x - 1) - x ** 2`` with rates between
+    0.1 and 100 per day.
+    """
+
+    def __init__(self, num_z):
+        super(_StiffColumn, self).__init__()
+        rate = torch.logspace(-1, 2, num_z, dtype=torch.double)
+        self.register_buffer('rate', rate.view(-1, 1, 1))
+        self.num_calls = 0
+
+    def forward(self, x):
+        from uwnet.tensordict import TensorDict
+        self.num_calls += 1
+        qt = x['QT']
+        return TensorDict({'QT': -self.rate * (qt - 1) - qt ** 2})
+
+
+@cli.command()
+@click.option('--num-z', default=34)
+@click.option('--days', default=2.0)
+def integrators(num_z, days):
+    """Error versus cost of the integrators on a stiff single column"""
+    from uwnet.tensordict import TensorDict
+    from uwnet.timestepper import Batch, TimeStepper
+
+    model = _StiffColumn(num_z)
+
+    def run(integrator, time_step, substeps=1):
+        num_steps = int(round(days / time_step))
+        data = TensorDict({
+            'QT': torch.zeros(1, num_steps + 1, num_z, 1, 1,
+                              dtype=torch.double),
+            'FQT': torch.zeros(1, num_steps + 1, num_z, 1, 1,
+                               dtype=torch.double),
+        })
+        batch = Batch(data, prognostics=['QT'])
+        stepper = TimeStepper(model, time_step * 86400,
+                              integrator=integrator, substeps=substeps)
+        model.num_calls = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            output = stepper(batch, prediction_length=num_steps)
+        elapsed = time.perf_counter() - start
+        return output['QT'][:, -1], model.num_calls, elapsed
+
+    reference, _, _ = run('rk4', 1 / 96, substeps=64)
+
+    click.echo("integrator substeps dt(h) calls seconds max_error")
+    for integrator in ['euler', 'rk2', 'rk4', 'semi_implicit']:
+        for substeps in [1, 4]:
+            for hours in [3, 1, 0.25]:
+                final, calls, elapsed = run(integrator, hours / 24, substeps)
+                error = (final - reference).abs().max().item()
+                click.echo(f"{integrator} {substeps} {hours} {calls} "
+                           f"{elapsed:.4f} {error:.3g}")
+
+
+def _random_training_batch(model, batch_size, num_time, num_z):
+    """Batch of random columns with shape (batch, time, z, 1, 1)"""
+    from uwnet.tensordict import TensorDict
+    from uwnet.timestepper import Batch
+
+    data = {}
+    for key, num in model.model[1].inputs:
+        data[key] = torch.rand(batch_size, num_time, num, 1, 1)
+    for key in ['QT', 'SLI']:
+        data['F' + key] = torch.rand(batch_size, num_time, num_z, 1, 1) / 1e5
+    return Batch(TensorDict(data), prognostics=['QT', 'SLI'])
+
+
+@cli.command('bptt-run')
+@click.option('--horizon', default=10)
+@click.option('--truncation', default=0)
+@click.option('--checkpoint/--no-checkpoint', default=False)
+@click.option('--batch-size', default=64)
+@click.option('--num-z', default=34)
+def bptt_run(horizon, truncation, checkpoint, batch_size, num_z):
+    """Run one multiple step training step and print its time and memory"""
+    import resource
+    from types import SimpleNamespace
+    from unittest.mock import Mock
+    from uwnet.loss import multiple_step_loss_step
+
+    model = _random_inner_model(num_z)
+    batch = _random_training_batch(model, batch_size, horizon + 1, num_z)
+    trainer = SimpleNamespace(
+        model=model, time_step=10800.0,
+        optimizer=torch.optim.SGD(model.parameters(), lr=1e-6))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    multiple_step_loss_step(trainer, Mock(), batch, checkpoint=checkpoint,
+                            truncation=truncation or None)
+    elapsed = time.perf_counter() - start
+
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux
+    click.echo(f"{elapsed} {(after - before) / 1024}")
+
+
+@cli.command()
+@click.option('--horizons', default='10,40,160')
+@click.option('--truncation', default=10)
+def bptt(horizons, truncation):
+    """Peak memory and seconds of multiple step training steps
+
+    Each configuration is run in a new process, so that the peak resident
+    memory of the process measures the memory of the step.
+    """
+    import subprocess
+    import sys
+
+    configurations = [
+        ('full', []),
+        ('checkpoint', ['--checkpoint']),
+        (f'truncation={truncation}', ['--truncation', str(truncation)]),
+        (f'checkpoint+truncation={truncation}',
+         ['--checkpoint', '--truncation', str(truncation)]),
+    ]
+
+    click.echo("horizon configuration seconds peak_MB")
+    for horizon in map(int, horizons.split(',')):
+        for name, args in configurations:
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'uwnet.benchmark', 'bptt-run',
+                 '--horizon', str(horizon)] + args)
+            seconds, megabytes = map(float, output.split())
+            click.echo(f"{horizon} {name} {seconds:.2f} {megabytes:.0f}")
+
+
+@cli.command('prepost-run')
+@click.argument('path')
+@click.option('--streaming/--no-streaming', default=False)
+@click.option('--num-workers', default=1)
+def prepost_run(path, streaming, num_workers):
+    """Fit the pca pre/post processors to the zarr at PATH
+
+    Prints the seconds and the peak memory in MB.
+    """
+    import resource
+    from uwnet.pre_post import get_pre, get_post
+
+    data = xr.open_zarr(path)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    get_pre(data, streaming=streaming, num_workers=num_workers)
+    get_post(data, streaming=streaming, num_workers=num_workers)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    click.echo(f"{elapsed} {(after - before) / 1024}")
+
+
+@cli.command()
+@click.option('--grid', default=(64, 32, 34), type=(int, int, int),
+              help="size of the x, y, and z dimensions")
+@click.option('--num-time', default=80)
+def prepost(grid, num_time):
+    """Peak memory and seconds of fitting the pca pre/post processors
+
+    The in-memory and streaming fits read the same zarr dataset, each in a
+    new process.
+    """
+    import subprocess
+    import sys
+    import tempfile
+
+    num_x, num_y, num_z = grid
+    ds = _random_training_dataset(num_time, num_z, num_y, num_x)
+    ds['SHF'] = ds.SST
+    ds['LHF'] = ds.SOLIN
+    ds = ds.assign_coords(time=np.arange(num_time) * .125)
+
+    configurations = [
+        ('in-memory', ['--no-streaming']),
+        ('streaming', ['--streaming']),
+        ('streaming workers=4', ['--streaming', '--num-workers', '4']),
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/data.zarr"
+        ds.chunk({'time': 8}).to_zarr(path)
+        click.echo(f"dataset {ds.nbytes / 1e6:.0f} MB")
+        click.echo("configuration seconds peak_MB")
+        for name, args in configurations:
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'uwnet.benchmark', 'prepost-run',
+                 path] + args)
+            seconds, megabytes = map(float, output.split())
+            click.echo(f"{name} {seconds:.2f} {megabytes:.0f}")
+
+
+@cli.command()
+@click.option('--grid', default=(64, 32, 34), type=(int, int, int),
+              help="size of the x, y, and z dimensions")
+@click.option('--num-time', default=80)
+def normalization(grid, num_time):
+    """Seconds to fit a Scaler to a zarr dataset
+
+    Compares the two passes of xarray's mean and std with the single pass of
+    Scaler.fit_xarray.
+    """
+    import tempfile
+    from uwnet.normalization import Scaler
+
+    num_x, num_y, num_z = grid
+    ds = _random_training_dataset(num_time, num_z, num_y, num_x)
+    dims = ['x', 'y', 'time']
+
+    def xarray_mean_std():
+        ds.mean(dims).load()
+        ds.std(dims).load()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/data.zarr"
+        ds.chunk({'time': 8}).to_zarr(path)
+        ds = xr.open_zarr(path)
+        click.echo(f"dataset {ds.nbytes / 1e6:.0f} MB")
+        configurations = [
+            ('xarray mean+std', xarray_mean_std),
+            ('fit_xarray', lambda: Scaler().fit_xarray(ds)),
+            ('fit_xarray threads=4',
+             lambda: Scaler().fit_xarray(ds, num_workers=4)),
+            ('fit_xarray processes=4',
+             lambda: Scaler().fit_xarray(ds, num_workers=4,
+                                         executor='process')),
+        ]
+        for name, fun in configurations:
+            seconds = _time_call(fun, 1)
+            click.echo(f"{name}: {seconds:.2f} s "
+                       f"{ds.nbytes / 1e6 / seconds:.0f} MB/s")
+
+
+def _legacy_binary_operator(name):
+    def fun(self, other):
+        out = {}
+        for key in self.data:
+            func = getattr(self.data[key], name)
+            if isinstance(other, LegacyTensorDict):
+                out[key] = func(other.data[key])
+                if self.keys() != other.keys():
+                    raise ValueError("Both arguments to binary arguments must "
+                                     "have the same keys.")
+            else:
+                out[key] = func(other)
+        return LegacyTensorDict(out)
+    return fun
+
+
+class LegacyTensorDict(MutableMapping):
+    """Reference copy of the previous TensorDict
+
+    The operators are looked up on each value for every key, and every
+    attribute access builds a new wrapper function.
+    """
+    __add__ = _legacy_binary_operator('__add__')
+    __mul__ = _legacy_binary_operator('__mul__')
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, val):
+        self.data[key] = val
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getattr__(self, key):
+        if 'data' in self.__dict__:
+            obj = next(iter(self.data.values()))
+        else:
+            raise AttributeError()
+
+        @functools.wraps(getattr(obj, key))
+        def fun(*args, **kwargs):
+            return self.apply(lambda x: getattr(x, key)(*args, **kwargs))
+
+        return fun
+
+    def copy(self):
+        return LegacyTensorDict(self.data.copy())
+
+    def apply(self, fun):
+        out = self.copy()
+        for key in self:
+            out[key] = fun(self[key])
+        return out
+
+
+@cli.command()
+@click.option('--shape', default=(64, 34, 1, 1), type=(int, int, int, int))
+@click.option('-n', '--num-repeats', default=2000)
+def tensordict(shape, num_repeats):
+    """Operations/sec of TensorDict arithmetic and dispatch
+
+    :class:`LegacyTensorDict` is a copy of the previous implementation.
+    """
+    from uwnet.tensordict import TensorDict, pack, stack
+
+    implementations = [
+        ('legacy', LegacyTensorDict, False),
+        ('slots', TensorDict, False),
+        ('slots+foreach', TensorDict, True),
+        ('packed', pack, False),
+    ]
+    for num_keys in [5, 10]:
+        data = {f'x{i}': torch.rand(*shape) for i in range(num_keys)}
+        for name, cls, use_foreach in implementations:
+            TensorDict.use_foreach = use_foreach
+            a = cls(dict(data))
+            b = cls(dict(data))
+            operations = [
+                ('add', lambda: a + b),
+                ('mul', lambda: a * 2.0),
+                ('apply', lambda: a.apply(torch.neg)),
+                ('getattr', lambda: a.float()),
+                ('a + b * dt', lambda: a + b * 0.1),
+            ]
+            if cls is not LegacyTensorDict:
+                operations += [
+                    ('a.add_scaled(b, dt)', lambda: a.add_scaled(b, 0.1)),
+                    ('a.add_scaled_(b, dt)', lambda: a.add_scaled_(b, 0.0)),
+                    ('stack', lambda: stack([a, b])),
+                    ('split', lambda: a.split(1)),
+                ]
+            for op_name, fun in operations:
+                rate = 1 / _time_call(fun, num_repeats)
+                click.echo(f"keys={num_keys} {name} {op_name}: "
+                           f"{rate:.0f} ops/s")
+    TensorDict.use_foreach = False
+
+
+if __name__ == '__main__':
+    cli()
@@ -3,7 +3,9 @@ import click
 import torch
 
 import xarray as xr
+from uwnet.tensordict import TensorDict
 from uwnet.timestepper import Batch, predict_multiple_steps
+from uwnet.xarray_interface import _array_to_tensor, _torch_dict_to_dataset
 
 
 def _convert_dataset_to_dict(dataset):
@@ -38,15 +40,60 @@ class XarrayBatch(Batch):
         return self._dataset[self.prognostics].isel(time=t)
 
 
+class TensorBatch(Batch):
+    """A batch of columns with dimensions (time, z, y, x)"""
+    time_dim = 0
+
+    def __init__(self, dataset, **kwargs):
+        data = {key: _array_to_tensor(val)
+                for key, val in _convert_dataset_to_dict(dataset).items()}
+        super(TensorBatch, self).__init__(data, **kwargs)
+
+    @staticmethod
+    def select_time(data, t):
+        return data.apply(lambda x: x[t])
+
+
 def _get_time_step(ds):
     return float(ds.time.diff('time')[0] * 86400)
 
 
+def _diagnostic_name(key, state):
+    return 'F' + key + 'NN' if key in state else key
+
+
+def _single_column_simulation_tensor(model, dataset, start, end, prognostics,
+                                     time_step):
+    batch = TensorBatch(dataset, prognostics=prognostics)
+    pred_generator = predict_multiple_steps(
+        model,
+        batch,
+        initial_time=start,
+        prediction_length=end - start,
+        time_step=time_step)
+
+    output = None
+    with torch.no_grad():
+        for i, (k, state, diag) in enumerate(pred_generator):
+            step = dict(state)
+            step.update({_diagnostic_name(key, state): val
+                         for key, val in diag.items()})
+            if output is None:
+                output = {key: val.new_empty((end - start, ) + val.shape)
+                          for key, val in step.items()}
+            for key, val in step.items():
+                output[key][i] = val
+
+    coords = dataset.isel(time=slice(start + 1, end + 1)).coords
+    return _torch_dict_to_dataset(TensorDict(output), coords)
+
+
 def single_column_simulation(model,
                              dataset,
                              interval=None,
                              prognostics=(),
-                             time_step=None):
+                             time_step=None,
+                             engine='xarray'):
     """Run a single column model simulation with a model for the source terms
 
     Parameters
@@ -57,6 +104,11 @@ def single_column_simulation(model,
         input dataset in the same format as the training data
     interval : tuple
         (start_time, end_time) interval
+    engine : str
+        'xarray' builds a dataset for the inputs and outputs of each time
+        step. 'tensor' steps all the columns at once on tensors, writes the
+        trajectory into preallocated (time, z, y, x) tensors, and converts to
+        xarray at the end, which is much faster for many columns.
     """
     if not time_step:
         time_step = _get_time_step(dataset)
@@ -66,6 +118,12 @@ def single_column_simulation(model,
     else:
         start, end = interval
 
+    if engine == 'tensor':
+        return _single_column_simulation_tensor(model, dataset, start, end,
+                                                prognostics, time_step)
+    elif engine != 'xarray':
+        raise ValueError(f"Unknown engine '{engine}'")
+
     batch = XarrayBatch(dataset, prognostics=prognostics)
     pred_generator = predict_multiple_steps(
         model.call_with_xr,
@@ -80,13 +138,14 @@ def single_column_simulation(model,
             if key in state:
                 diag = diag.rename({key: 'F' + key + 'NN'})
 
-        datasets.append(xr.Dataset(state).assign_coords(time=dataset.time[k]).merge(diag))
+        datasets.append(xr.Dataset(dict(state)).assign_coords(
+            time=dataset.time[k]).merge(diag))
     output_time_series = xr.concat(datasets, dim='time')
     return output_time_series
 
 
-def compute_apparent_sources(model, ds):
-    sources = model.call_with_xr(ds)
+def compute_apparent_sources(model, ds, chunks=None):
+    sources = model.call_with_xr(ds, chunks=chunks)
     rename_dict = {}
     for key in sources.data_vars:
         rename_dict[key] = 'F' + key + 'NN'
@@ -108,7 +167,9 @@ def remove_nonphysical_dims(data):
 @click.argument('output_path')
 @click.option('-b', '--begin', type=int)
 @click.option('-e', '--end', type=int)
-def main(model, data, output_path, begin, end):
+@click.option('--engine', default='xarray',
+              type=click.Choice(['xarray', 'tensor']))
+def main(model, data, output_path, begin, end, engine):
     model = torch.load(model)
     data = xr.open_dataset(data)
 
@@ -119,7 +180,7 @@ def main(model, data, output_path, begin, end):
 
     data = data.isel(time=slice(begin, end))
     data = remove_nonphysical_dims(data)
-    output = single_column_simulation(model, data)
+    output = single_column_simulation(model, data, engine=engine)
     sources = compute_apparent_sources(model, data)
     output.merge(sources).to_netcdf(output_path)
 
@@ -5,50 +5,233 @@ script combines the y and x dimensions into a sample dimension with a specified
 chunk size. This sample dimension is optionally shufffled, and then saved to a
 zarr archive.
 
+By default the whole stacked dataset is shuffled in memory. The streaming mode
+instead reads a block of ``y`` rows at a time and shuffles with two passes:
+first every sample is scattered to a randomly chosen bucket on disk, then each
+bucket is shuffled in memory and appended to the zarr archive one chunk at a
+time. The memory used by either pass is bounded by ``memory_budget`` bytes.
+
 The saved archive is suitable to use with uwnet.train
 """
+import logging
+import os
+import shutil
+import tempfile
+
 import xarray as xr
 import numpy as np
 
-# arguments
-input_file = snakemake.input[0]
-output_file = snakemake.output[0]
-variables = snakemake.params.variables
-shuffle = snakemake.params.shuffle
-train_or_test = snakemake.wildcards.train_or_test
+logger = logging.getLogger(__name__)
 
 chunk_size = 2**10
 
-# open data
-ds = xr.open_dataset(input_file)
 
+def select_train_or_test(ds, train_or_test):
+    if train_or_test == "train":
+        return ds.isel(x=slice(0, 64))
+    elif train_or_test == "test":
+        return ds.isel(x=slice(64, None))
+    else:
+        raise NotImplementedError(
+            f"{train_or_test} is not \"train\" or \"test\"")
+
+
+def stack_samples(ds, variables):
+    # needs to be a list for xarray
+    return (ds[list(variables)]
+            .stack(sample=['y', 'x'])
+            .drop('sample'))
+
+
+def reshape(ds, variables, output_file, shuffle=True, chunk_size=chunk_size):
+    """Stack, shuffle and save the whole dataset in memory"""
+    stacked = stack_samples(ds, variables)
+
+    # add needed variables
+    stacked['layer_mass'] = ds.layer_mass.isel(time=0)
+
+    # shuffle samples
+    if shuffle:
+        n = len(stacked.sample)
+        indices = np.random.choice(n, n, replace=False)
+        stacked = stacked.isel(sample=indices)
+
+    chunked = stacked.chunk({'sample': chunk_size})
+
+    # save to disk
+    chunked.to_zarr(output_file)
+
+
+class _ChunkWriter:
+    """Append samples to a zarr archive in whole chunks"""
+
+    def __init__(self, output_file, template, chunk_size):
+        self.output_file = output_file
+        self.template = template
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.num_buffered = 0
+        self.initialized = False
+
+    def append(self, arrays):
+        self.buffer.append(arrays)
+        self.num_buffered += _num_samples(arrays)
+        if self.num_buffered >= self.chunk_size:
+            self._write(self.num_buffered - self.num_buffered % self.chunk_size)
+
+    def close(self):
+        if self.num_buffered > 0:
+            self._write(self.num_buffered)
+
+    def _write(self, n):
+        arrays = _concat_samples(self.buffer)
+        to_write = {key: val[..., :n] for key, val in arrays.items()}
+        rest = {key: val[..., n:] for key, val in arrays.items()}
+
+        self.buffer = [rest]
+        self.num_buffered -= n
+
+        data_vars = {key: (self.template[key].dims, to_write[key])
+                     for key in to_write}
+        ds = xr.Dataset(data_vars)
+        if self.initialized:
+            ds.to_zarr(self.output_file, append_dim='sample')
+        else:
+            ds = ds.merge(self.template.drop(list(to_write)))
+            encoding = {
+                key: {'chunks': to_write[key].shape[:-1] + (self.chunk_size,)}
+                for key in to_write
+            }
+            ds.to_zarr(self.output_file, mode='w', encoding=encoding)
+            self.initialized = True
+
+
+def _num_samples(arrays):
+    return next(iter(arrays.values())).shape[-1]
+
+
+def _concat_samples(seq):
+    return {key: np.concatenate([arrays[key] for arrays in seq], axis=-1)
+            for key in seq[0]}
+
+
+def _take_samples(arrays, index):
+    return {key: val[..., index] for key, val in arrays.items()}
+
+
+def _bucket_path(tmpdir, bucket, block, key):
+    return os.path.join(tmpdir, str(bucket), f"{block}-{key}.npy")
+
+
+def reshape_streaming(ds, variables, output_file, shuffle=True,
+                      chunk_size=chunk_size, memory_budget=2**30, seed=None,
+                      tmpdir=None):
+    """Stack, shuffle and save a dataset without loading all of it at once
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        dataset with dimensions ('time', 'z', 'y', 'x')
+    variables : seq of str
+    output_file : str
+        path of the output zarr archive
+    shuffle : bool
+    chunk_size : int
+        size of the zarr chunks along the sample dimension
+    memory_budget : int
+        approximate maximum number of bytes to hold in memory. Blocks hold
+        at least one row of the y dimension, so a warning is logged and the
+        budget is exceeded if half of it cannot hold a single row.
+    seed : int, optional
+    tmpdir : str, optional
+        directory for the temporary buckets. Defaults to the system temporary
+        directory.
+    """
+    variables = list(variables)
+    rng = np.random.RandomState(seed)
+
+    template = stack_samples(ds.isel(y=slice(0, 1), x=slice(0, 1)), variables)
+    template['layer_mass'] = ds.layer_mass.isel(time=0)
+
+    num_y, num_x = len(ds.y), len(ds.x)
+    num_samples = num_y * num_x
+    bytes_per_sample = sum(template[key].nbytes for key in variables)
+
+    # hold at most half the budget in a block or bucket to leave room for
+    # the output chunk and temporary copies
+    samples_per_block = max(1, memory_budget // (2 * bytes_per_sample))
+    rows_per_block = max(1, samples_per_block // num_x)
+    if 2 * num_x * bytes_per_sample > memory_budget:
+        logger.warning(f"A row of {num_x} samples needs "
+                       f"{2 * num_x * bytes_per_sample} bytes, more than the "
+                       f"memory budget of {memory_budget} bytes")
+    num_buckets = max(1, -(-num_samples // samples_per_block))
+    logger.info(f"Reshaping {num_samples} samples in blocks of "
+                f"{rows_per_block} rows and {num_buckets} buckets")
+
+    writer = _ChunkWriter(output_file, template, chunk_size)
+    blocks = range(0, num_y, rows_per_block)
+
+    def read_block(start):
+        block = ds.isel(y=slice(start, start + rows_per_block))
+        stacked = stack_samples(block, variables)
+        return {key: stacked[key].values for key in variables}
+
+    if not shuffle:
+        for start in blocks:
+            writer.append(read_block(start))
+        writer.close()
+        return
+
+    tmpdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        # pass 1: scatter samples to random buckets
+        for block, start in enumerate(blocks):
+            arrays = read_block(start)
+            buckets = rng.randint(num_buckets, size=_num_samples(arrays))
+            for bucket in range(num_buckets):
+                index = np.nonzero(buckets == bucket)[0]
+                os.makedirs(os.path.join(tmpdir, str(bucket)), exist_ok=True)
+                for key, val in _take_samples(arrays, index).items():
+                    np.save(_bucket_path(tmpdir, bucket, block, key), val)
+
+        # pass 2: shuffle within each bucket
+        for bucket in range(num_buckets):
+            arrays = _concat_samples([
+                {key: np.load(_bucket_path(tmpdir, bucket, block, key))
+                 for key in variables}
+                for block in range(len(blocks))
+            ])
+            index = rng.permutation(_num_samples(arrays))
+            writer.append(_take_samples(arrays, index))
+        writer.close()
+    finally:
+        shutil.rmtree(tmpdir)
 
-if train_or_test == "train":
-    ds = ds.isel(x=slice(0, 64))
-elif train_or_test == "test":
-    ds = ds.isel(x=slice(64, None))
-else:
-    raise NotImplementedError("{test_or_train} is not \"train\" or \"test\"")
 
-# perform basic validation
-assert ds['SLI'].dims == ('time', 'z', 'y', 'x')
+def main(snakemake):
+    # arguments
+    input_file = snakemake.input[0]
+    output_file = snakemake.output[0]
+    variables = snakemake.params.variables
+    shuffle = snakemake.params.shuffle
+    streaming = getattr(snakemake.params, 'streaming', False)
+    train_or_test = snakemake.wildcards.train_or_test
 
-# stack data
-variables = list(variables) # needs to be a list for xarray
-stacked = (ds[variables]
-           .stack(sample=['y', 'x'])
-           .drop('sample'))
+    # open data
+    ds = xr.open_dataset(input_file)
+    ds = select_train_or_test(ds, train_or_test)
 
-# add needed variables
-stacked['layer_mass'] = ds.layer_mass.isel(time=0)
+    # perform basic validation
+    assert ds['SLI'].dims == ('time', 'z', 'y', 'x')
 
-# shuffle samples
-if shuffle:
-    n = len(stacked.sample)
-    indices = np.random.choice(n, n, replace=False)
-    stacked = stacked.isel(sample=indices)
+    if streaming:
+        memory_budget = getattr(snakemake.params, 'memory_budget', 2**30)
+        reshape_streaming(ds, variables, output_file, shuffle=shuffle,
+                          memory_budget=memory_budget)
+    else:
+        reshape(ds, variables, output_file, shuffle=shuffle)
 
-chunked = stacked.chunk({'sample': chunk_size})
 
-# save to disk
-chunked.to_zarr(output_file)
+if 'snakemake' in globals():
+    main(snakemake)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from uwnet.data.reshape import reshape, reshape_streaming
+
+
+def _training_dataset(t=3, z=2, y=6, x=5):
+    dims_3d = ['time', 'z', 'y', 'x']
+    dims_2d = ['time', 'y', 'x']
+    size = t * z * y * x
+    return xr.Dataset(
+        {
+            'QT': (dims_3d, np.arange(size).reshape((t, z, y, x)) * 1.0),
+            'SST': (dims_2d, np.random.rand(t, y, x)),
+            'layer_mass': (['time', 'z'], np.ones((t, z))),
+        },
+        coords={'time': np.arange(t), 'z': np.arange(z) * 10.0})
+
+
+def _sort_samples(ds):
+    # the first value of QT is unique for each sample
+    order = np.argsort(ds.QT.isel(time=0, z=0).values)
+    return ds.isel(sample=order)
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('memory_budget', [200, 10**6])
+def test_reshape_streaming_matches_in_memory(tmpdir, shuffle, memory_budget):
+    ds = _training_dataset()
+    variables = ['QT', 'SST']
+    expected_path = str(tmpdir.join('expected.zarr'))
+    actual_path = str(tmpdir.join('actual.zarr'))
+
+    reshape(ds, variables, expected_path, shuffle=False, chunk_size=4)
+    reshape_streaming(ds, variables, actual_path, shuffle=shuffle,
+                      chunk_size=4, memory_budget=memory_budget, seed=0,
+                      tmpdir=str(tmpdir))
+
+    expected = xr.open_zarr(expected_path).load()
+    actual = xr.open_zarr(actual_path)
+
+    assert actual.QT.encoding['chunks'] == (3, 2, 4)
+    assert actual.QT.dims == expected.QT.dims
+    actual = actual.load()
+    if shuffle:
+        actual = _sort_samples(actual)
+    xr.testing.assert_equal(actual, expected)
+
+    # the temporary buckets are removed
+    assert sorted(tmpdir.listdir()) == sorted(
+        [tmpdir.join('actual.zarr'), tmpdir.join('expected.zarr')])
+
+
+def test_reshape_streaming_warns_if_row_exceeds_budget(tmpdir, caplog):
+    ds = _training_dataset()
+    expected_path = str(tmpdir.join('expected.zarr'))
+    actual_path = str(tmpdir.join('actual.zarr'))
+
+    reshape(ds, ['QT'], expected_path, shuffle=False, chunk_size=4)
+    with caplog.at_level('WARNING', logger='uwnet.data.reshape'):
+        reshape_streaming(ds, ['QT'], actual_path, shuffle=False,
+                          chunk_size=4, memory_budget=1,
+                          tmpdir=str(tmpdir))
+
+    assert any('memory budget' in record.getMessage()
+               for record in caplog.records)
+    xr.testing.assert_equal(
+        xr.open_zarr(actual_path).load(),
+        xr.open_zarr(expected_path).load())
@@ -0,0 +1,202 @@
+"""Export trained models for inference
+
+The fixed pre/post processing of a trained :class:`uwnet.model.InnerModel`
+(e.g. PCA or normalization) is an affine transform, as is the first and last
+layer of the network. Folding the pre-processing into the first layer and the
+post-processing into the last layer gives an equivalent model with fewer
+matrix multiplications.
+
+For deployment in SAM, the folded model is compiled with TorchScript into a
+:class:`FlatModel`, which takes and returns a single tensor of shape
+(features, y, x). The names and sizes of the features are saved with the
+compiled module and read by :func:`load_torchscript`.
+
+Examples
+--------
+
+Fold the pre/post processing of a trained model::
+
+    python -m uwnet.export fold models/1/5.pkl models/1/5.folded.pkl
+
+Compile a trained model with TorchScript::
+
+    python -m uwnet.export torchscript models/1/5.pkl models/1/5.pt
+
+The compiled model is used by SAM with the following entry in
+``python_config.json``::
+
+    {"type": "torchscript", "path": "models/1/5.pt"}
+
+"""
+import copy
+import json
+
+import click
+import torch
+from torch import nn
+
+import uwnet.modules as um
+from .model import InnerModel
+
+METADATA_FILE = 'uwnet.json'
+
+
+def get_affine(module):
+    """Affine transforms applied by a pre/post processor
+
+    Parameters
+    ----------
+    module : nn.Module
+        :class:`uwnet.modules.MapByKey` of :class:`uwnet.modules.LinearFixed`
+        objects or any module with an ``affine`` method (e.g.
+        :class:`uwnet.normalization.Scaler`).
+
+    Returns
+    -------
+    dict
+        (weight, bias) for each transformed variable
+
+    Raises
+    ------
+    ValueError
+        if the module is not a known affine transform
+    """
+    if isinstance(module, um.MapByKey):
+        funcs = {key: module[key] for key in module.funcs}
+        for key, func in funcs.items():
+            if not isinstance(func, um.LinearFixed):
+                raise ValueError(f"The module for '{key}' is not LinearFixed")
+        return {key: (func.weight, func.bias) for key, func in funcs.items()}
+    elif hasattr(module, 'affine'):
+        return module.affine()
+    else:
+        raise ValueError(
+            f"{type(module).__name__} is not an affine transform")
+
+
+def fold_pre_post(model):
+    """Fold the pre/post processing of a model into its first and last layers
+
+    Parameters
+    ----------
+    model : InnerModel
+
+    Returns
+    -------
+    InnerModel
+        a copy of ``model`` with the same outputs, whose pre/post processors
+        are :class:`uwnet.modules.IdentityByKey`
+    """
+    if not isinstance(model, InnerModel):
+        raise ValueError(f"Cannot fold a {type(model).__name__}")
+
+    model = copy.deepcopy(model)
+    pre, linear_in, linear_out, post = (model.model[i] for i in (1, 2, 8, 9))
+    linear_in = linear_in.fold_input_affine(get_affine(pre))
+    linear_out = linear_out.fold_output_affine(get_affine(post))
+
+    model.model[1] = um.IdentityByKey([
+        (key, lin.in_features) for key, lin in linear_in.models.items()])
+    model.model[2] = linear_in
+    model.model[8] = linear_out
+    model.model[9] = um.IdentityByKey([
+        (key, lin.out_features) for key, lin in linear_out.models.items()])
+    return model
+
+
+class FlatModel(nn.Module):
+    """Folded and fused InnerModel with a single tensor input and output
+
+    The input is the concatenation of the variables in ``inputs`` along the
+    first dimension, and has shape (features, y, x). The output is the
+    concatenation of the variables in ``outputs``. Two-dimensional variables
+    have one feature.
+    """
+
+    def __init__(self, model):
+        super(FlatModel, self).__init__()
+        model = fold_pre_post(model)
+        (weight_in, bias_in), (weight_out, bias_out) = model.fused_parameters()
+
+        input_sizes = dict(model.model[1].inputs)
+        output_sizes = dict(model.model[9].outputs)
+        self.inputs = [(key, input_sizes[key]) for key in model.input_names]
+        self.outputs = [(key, output_sizes[key])
+                        for key in model.output_names]
+
+        self.register_buffer('weight_in', weight_in.detach().clone())
+        self.register_buffer('bias_in', bias_in.detach().clone())
+        self.hidden = nn.Sequential(*model.model[3:8])
+        self.register_buffer('weight_out', weight_out.detach().clone())
+        self.register_buffer('bias_out', bias_out.detach().clone())
+
+    def forward(self, x):
+        columns = x.reshape(x.size(0), -1).t()
+        hidden = self.hidden(columns.matmul(self.weight_in) + self.bias_in)
+        out = hidden.matmul(self.weight_out) + self.bias_out
+        return out.t().reshape(-1, x.size(1), x.size(2))
+
+
+def to_torchscript(model):
+    """Compile a model to a TorchScript :class:`FlatModel`
+
+    Returns
+    -------
+    module : torch.jit.ScriptModule
+    metadata : dict
+        the names and sizes of the ``inputs`` and ``outputs``
+    """
+    flat = FlatModel(model).eval()
+    for param in flat.parameters():
+        param.requires_grad = False
+    metadata = {'inputs': flat.inputs, 'outputs': flat.outputs}
+    return torch.jit.script(flat), metadata
+
+
+def save_torchscript(model, path):
+    """Compile a model with :func:`to_torchscript` and save it to path"""
+    module, metadata = to_torchscript(model)
+    torch.jit.save(module, path,
+                   _extra_files={METADATA_FILE: json.dumps(metadata)})
+
+
+def load_torchscript(path):
+    """Load a module saved by :func:`save_torchscript`
+
+    Returns
+    -------
+    module : torch.jit.ScriptModule
+    metadata : dict
+        the names and sizes of the ``inputs`` and ``outputs``
+    """
+    extra_files = {METADATA_FILE: ''}
+    module = torch.jit.load(path, _extra_files=extra_files)
+    metadata = json.loads(extra_files[METADATA_FILE])
+    return module.eval(), metadata
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument('model')
+@click.argument('output')
+def fold(model, output):
+    """Fold the pre/post processing of MODEL and save it to OUTPUT"""
+    model = torch.load(model)
+    torch.save(fold_pre_post(model), output)
+
+
+@cli.command()
+@click.argument('model')
+@click.argument('output')
+def torchscript(model, output):
+    """Compile MODEL with TorchScript and save it to OUTPUT"""
+    model = torch.load(model)
+    save_torchscript(model, output)
+
+
+if __name__ == '__main__':
+    cli()
@@ -97,7 +97,8 @@ def equilibrium_penalty(criterion, model, batch, dt, n=20):
     for t in range(n):
         inputs = batch.get_model_inputs(i, state)
         src = model(inputs)
-        state = state + dt * src + dt * mean_forcing * 86400
+        state = state.add_scaled(src, dt).add_scaled_(mean_forcing,
+                                                      dt * 86400)
 
     return compute_loss(criterion, mean, state)
 
@@ -128,25 +129,76 @@ def instability_penalty_step(self, engine, data, alpha=1.0):
     return pred, x1
 
 
-def multiple_step_loss_step(self, engine, batch):
+def _masked_squared_error(truth, prediction, threshold=100.0):
+    loss = ((truth - prediction)**2)
+    combined_var_loss = sum(loss.values())
+    return combined_var_loss[combined_var_loss < threshold]
+
+
+def _truncated_multiple_step_loss(self, stepper, batch, truncation):
+    """Backpropagate the multiple step loss in windows of ``truncation`` steps
+
+    The state is detached at the start of each window, and the gradients of
+    each window are accumulated, so only one window is held in memory. The
+    accumulated gradients are those of the mean loss.
+    """
+    num_steps = batch.num_time - 1
+    state = None
+    total = 0.0
+    count = 0
+    for start in range(0, num_steps, truncation):
+        length = min(truncation, num_steps - start)
+        prediction = stepper(batch, initial_time=start,
+                             prediction_length=length, initial_state=state)
+        truth = batch.get_prognostics().apply(
+            lambda x: x.narrow(batch.time_dim, start + 1, length))
+        errors = _masked_squared_error(truth, prediction)
+        errors.sum().backward()
+
+        total += errors.sum().item()
+        count += errors.numel()
+        state = prediction.apply(
+            lambda x: x.select(batch.time_dim, -1).detach())
+
+    for param in self.model.parameters():
+        if param.grad is not None:
+            param.grad /= count
+    return total / count
+
+
+def multiple_step_loss_step(self, engine, batch, integrator='euler',
+                            substeps=1, preallocate=False, checkpoint=False,
+                            truncation=None):
+    """Training step with the loss of a time series prediction
+
+    ``integrator``, ``substeps``, ``preallocate`` and ``checkpoint`` are
+    passed to :class:`TimeStepper`. If ``truncation`` is given, the gradients
+    are truncated every ``truncation`` steps (truncated backpropagation
+    through time). These can be set from the ``kwargs`` of the step
+    configuration.
+    """
     self.optimizer.zero_grad()
-    stepper = TimeStepper(self.model, time_step=self.time_step)
+    stepper = TimeStepper(self.model, time_step=self.time_step,
+                          integrator=integrator, substeps=substeps,
+                          preallocate=preallocate, checkpoint=checkpoint)
 
-    prediction = stepper(batch)
+    if truncation:
+        loss = _truncated_multiple_step_loss(self, stepper, batch, truncation)
+    else:
+        prediction = stepper(batch)
 
-    # TODO: maybe TimeStepper should return a batch object
-    prediction = tensordict.lag(prediction, -1, batch.time_dim)
-    truth = batch.data_for_lag(1)
+        # TODO: maybe TimeStepper should return a batch object
+        prediction = tensordict.lag(prediction, -1, batch.time_dim)
+        truth = batch.data_for_lag(1)
 
-    loss = ((truth - prediction)**2)
-    combined_var_loss = sum(loss.values())
-    loss = combined_var_loss[combined_var_loss < 100.0].mean()
+        loss = _masked_squared_error(truth, prediction).mean()
+        loss.backward()
+        loss = loss.item()
 
-    loss.backward()
     self.optimizer.step()
     self.optimizer.zero_grad()
 
-    info = {"loss": loss.item()}
+    info = {"loss": loss}
 
     engine.state.loss_info = info
     return info
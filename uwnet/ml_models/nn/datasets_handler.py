@@ -1,18 +1,29 @@
-from dataclasses import dataclass
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 
 import numpy as np
 import torch
 from toolz import valmap
-from torch.utils.data import Dataset
+from torch.utils.data import (BatchSampler, DataLoader, Dataset,
+                              RandomSampler, SequentialSampler)
+from functools import partial
 from itertools import product
 import xarray as xr
 
-from uwnet.utils import dataset_to_broadcastable_array_dict
+from uwnet.utils import (atomic_save, dataset_fingerprint,
+                         dataset_process_pool,
+                         dataset_to_broadcastable_array_dict, map_ordered,
+                         worker_dataset)
 from uwnet.tensordict import TensorDict
 from src.data import assign_apparent_sources
 
 from uwnet.thermo import sec_in_day
 
+logger = logging.getLogger(__name__)
+
+
 def _stack_or_rename(x, **kwargs):
     for key, val in kwargs.items():
         if isinstance(val, str):
@@ -44,6 +55,66 @@ def _ds_slice_to_torch(ds):
     return valmap(_numpy_to_torch, _ds_slice_to_numpy_dict(ds))
 
 
+def _sample_major_shape(data_array):
+    num_z = data_array.sizes.get('z', 1)
+    num_samples = data_array.sizes['y'] * data_array.sizes['x']
+    return (num_samples, data_array.sizes['time'], num_z)
+
+
+def _write_sample_major_cache(data_array, path, memory_budget=2**28):
+    """Write a (time, [z], y, x) array to a float32 .npy file with the layout
+    (sample, time, z)
+
+    The data are copied ``memory_budget`` bytes worth of time steps at a time.
+    """
+    shape = _sample_major_shape(data_array)
+    num_samples, num_time, num_z = shape
+    arr = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                    shape=shape)
+
+    bytes_per_time_step = num_samples * num_z * 4
+    block = max(1, memory_budget // bytes_per_time_step)
+    dims = [dim for dim in ['y', 'x', 'time', 'z'] if dim in data_array.dims]
+    for start in range(0, num_time, block):
+        stop = min(start + block, num_time)
+        values = (data_array.isel(time=slice(start, stop))
+                  .transpose(*dims).values.astype(np.float32))
+        arr[:, start:stop] = values.reshape((num_samples, stop - start, num_z))
+
+    arr.flush()
+    del arr
+
+
+def _open_sample_major_cache(data_array, path, fingerprint):
+    """Open the cache for a variable, (re)building it if it is invalid
+
+    The cache is valid if the fingerprint stored next to it matches
+    ``fingerprint``, and it has the expected shape and dtype.
+    """
+    shape = _sample_major_shape(data_array)
+    fingerprint_path = os.path.splitext(path)[0] + '.fingerprint'
+    try:
+        with open(fingerprint_path) as f:
+            valid = f.read() == fingerprint
+        arr = np.load(path, mmap_mode='r')
+        valid = valid and arr.shape == shape and arr.dtype == np.float32
+        del arr
+    except (FileNotFoundError, ValueError):
+        valid = False
+
+    if not valid:
+        logger.info(f"Writing training cache to {path}")
+        if os.path.exists(fingerprint_path):
+            os.remove(fingerprint_path)
+        atomic_save(partial(_write_sample_major_cache, data_array), path)
+        with open(fingerprint_path, 'w') as f:
+            f.write(fingerprint)
+
+    # copy-on-write makes the array writeable without ever modifying the file,
+    # which avoids warnings from torch.from_numpy
+    return np.load(path, mmap_mode='c')
+
+
 class XRTimeSeries(Dataset):
     """A pytorch Dataset class for time series data in xarray format
 
@@ -54,6 +125,11 @@ class XRTimeSeries(Dataset):
     horizontal location. The time-varying variables in this sample will have
     shape (time, z, 1, 1).
 
+    If ``cache_dir`` is given, the time-varying variables are copied once into
+    float32 ``.npy`` files with the layout (sample, time, z), which are then
+    memory-mapped. Samples are served as zero-copy torch views of these files,
+    so the dataset does not need to fit in memory.
+
     Examples
     --------
     >>> ds = xr.open_dataset("in.nc")
@@ -63,7 +139,7 @@ class XRTimeSeries(Dataset):
     """
     dims = ['time', 'z', 'x', 'y']
 
-    def __init__(self, data, time_length=None):
+    def __init__(self, data, time_length=None, cache_dir=None):
         """
         Parameters
         ----------
@@ -73,10 +149,13 @@ class XRTimeSeries(Dataset):
         time_length : int, optional
             The length of the time sequences to use, must evenly divide the
             total number of time points.
+        cache_dir : str, optional
+            Directory for the memory-mapped training cache. The cache of a
+            variable is built if it is not present, or if it was built from
+            different data.
         """
         self.time_length = time_length or len(data.time)
         self.data = data
-        self.numpy_data = {key: data[key].values for key in data.data_vars}
         self.data_vars = set(data.data_vars) - {'p', 'RHO', 'rho', 'Ps', 'layer_mass'}
         self.dims = {key: data[key].dims for key in data.data_vars}
         self.constants = {
@@ -84,6 +163,20 @@ class XRTimeSeries(Dataset):
             for key in data.data_vars
             if len({'x', 'y', 'time'} & set(data[key].dims)) == 0
         }
+
+        if cache_dir is None:
+            self.cache = None
+            self.numpy_data = {key: data[key].values for key in data.data_vars}
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache = {
+                key: _open_sample_major_cache(
+                    data[key], os.path.join(cache_dir, key + '.npy'),
+                    dataset_fingerprint(data[[key]]))
+                for key in self.data_vars - self.constants
+            }
+            self.numpy_data = {key: data[key].values for key in self.constants}
+
         self.setup_indices()
 
     def setup_indices(self):
@@ -96,11 +189,65 @@ class XRTimeSeries(Dataset):
         t_iter = range(0, len_t, self.time_length)
         assert len_t % self.time_length == 0
         self.indices = list(product(t_iter, y_iter, x_iter))
+        self.index_array = np.array(self.indices, dtype=np.int64).reshape(-1, 3)
 
     def __len__(self):
         return len(self.indices)
 
+    def _get_cached_item(self, i):
+        t, y, x = self.indices[i]
+        sample = y * len(self.data['x']) + x
+        output_tensors = {}
+        for key, arr in self.cache.items():
+            view = arr[sample, t:t + self.time_length, :, np.newaxis, np.newaxis]
+            output_tensors[key] = torch.from_numpy(view)
+        return output_tensors
+
+    def gather(self, indices):
+        """Gather several samples at once
+
+        Uses a single advanced indexing operation per variable.
+
+        Returns
+        -------
+        TensorDict
+            the variables with shape (len(indices), time, z, 1, 1)
+        """
+        t, y, x = self.index_array[np.asarray(indices)].T
+        time = t[:, np.newaxis] + np.arange(self.time_length)
+        y = y[:, np.newaxis]
+        x = x[:, np.newaxis]
+
+        output_tensors = {}
+        for key in self.data_vars - self.constants:
+            if self.cache is not None:
+                sample = y * len(self.data['x']) + x
+                batch = self.cache[key][sample, time]
+            elif 'z' in self.dims[key]:
+                batch = self.numpy_data[key][time, :, y, x]
+            else:
+                batch = self.numpy_data[key][time, y, x][..., np.newaxis]
+
+            batch = batch[..., np.newaxis, np.newaxis].astype(np.float32)
+            output_tensors[key] = torch.from_numpy(batch)
+        return TensorDict(output_tensors)
+
+    def __getitems__(self, indices):
+        """List of the samples at indices, as expected by the DataLoader
+
+        The samples are views of a single :meth:`gather`.
+        """
+        batch = self.gather(indices)
+        return [{key: val[i] for key, val in batch.items()}
+                for i in range(len(indices))]
+
     def __getitem__(self, i):
+        if isinstance(i, (list, np.ndarray)):
+            return self.gather(i)
+
+        if self.cache is not None:
+            return self._get_cached_item(i)
+
         t, y, x = self.indices[i]
         output_tensors = {}
         for key in self.data_vars:
@@ -136,17 +283,160 @@ class XRTimeSeries(Dataset):
 
 
 
+def _identity(x):
+    return x
+
+
+def get_batched_data_loader(dataset, batch_size, shuffle=False, **kwargs):
+    """DataLoader which gathers whole batches with ``dataset[indices]``
+
+    Unlike the default DataLoader, this does not call ``__getitem__`` once per
+    sample and then collate the results.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None,
+                      collate_fn=_identity, **kwargs)
+
+
+def _load_batch(dataset, variables, dims, index):
+    """Read a batch of samples from disk into a dict of numpy arrays
+
+    This is a module level function so that it can be sent to a process pool.
+    """
+    subset = dataset[variables].isel(sample=index)
+    numpy_dict = dataset_to_broadcastable_array_dict(subset, dims=dims)
+    # force any lazy (e.g. dask) arrays to be read and decoded here
+    return {key: np.asarray(val) for key, val in numpy_dict.items()}
+
+
+def _load_worker_batch(variables, dims, index):
+    return _load_batch(worker_dataset(), variables, dims, index)
+
+
+def _get_executor(kind, num_workers, dataset):
+    """Executor and the function of (variables, dims, index) which loads a
+    batch of ``dataset`` in it
+    """
+    if kind == 'thread':
+        return ThreadPoolExecutor(num_workers), partial(_load_batch, dataset)
+    elif kind == 'process':
+        return dataset_process_pool(num_workers, dataset), _load_worker_batch
+    else:
+        raise ValueError(
+            f"Executor must be either 'thread' or 'process', not '{kind}'")
+
+
+def _sample_chunk_sizes(dataset, num_samples):
+    """The sizes of the on-disk chunks along the sample dimension"""
+    for key in dataset.data_vars:
+        variable = dataset[key]
+        if 'sample' not in variable.dims:
+            continue
+        axis = variable.dims.index('sample')
+
+        if variable.chunks is not None:
+            return list(variable.chunks[axis])
+
+        chunks = variable.encoding.get('chunks')
+        if chunks:
+            size = chunks[axis]
+            return [min(size, num_samples - start)
+                    for start in range(0, num_samples, size)]
+
+    return [num_samples]
+
+
+def _sizes_to_slices(sizes):
+    slices = []
+    start = 0
+    for size in sizes:
+        slices.append(slice(start, start + size))
+        start += size
+    return slices
+
+
+def _window_index(window):
+    """Index which reads a group of chunks in a single call"""
+    window = sorted(window, key=lambda chunk: chunk.start)
+    contiguous = all(a.stop == b.start for a, b in zip(window[:-1], window[1:]))
+    if contiguous:
+        return slice(window[0].start, window[-1].stop)
+    else:
+        return np.concatenate([np.arange(chunk.start, chunk.stop)
+                               for chunk in window])
+
+
+def _concat_samples(a, b, sample_keys, axis):
+    if a is None:
+        return b
+    out = dict(b)
+    for key in sample_keys:
+        out[key] = np.concatenate([a[key], b[key]], axis=axis)
+    return out
+
+
+def _take_samples(numpy_dict, index, sample_keys, axis):
+    out = dict(numpy_dict)
+    for key in sample_keys:
+        out[key] = np.take(numpy_dict[key], index, axis=axis)
+    return out
+
+
 @dataclass
 class XarrayBatchLoader:
-    """Yield batches from an xarray"""
+    """Yield batches from an xarray
+
+    If ``prefetch`` is positive, the next ``prefetch`` batches are read and
+    decoded in a pool of ``num_workers`` background threads or processes
+    (``executor``) while the current batch is being used. The batches are
+    always yielded in the same order as ``batches``.
+
+    If ``chunked`` is True, the data are read one window of
+    ``shuffle_window`` on-disk ``sample`` chunks at a time and split into
+    batches in memory, so that every compressed chunk is decoded once per
+    epoch. Samples left over at the end of a window are carried over to the
+    next one, so all batches but the last have ``batch_size`` samples. With
+    ``shuffle``, the order of the chunks and the samples within each window
+    are randomized using ``seed``.
+
+    If ``batch_subset`` is given, only these slices of samples are loaded as
+    batches (see :meth:`subset`).
+    """
     dataset: xr.Dataset
     batch_size: int
     dims: tuple = ('sample', 'time', 'z', 'x', 'y')
     variables: list = None
     torch: bool = False
+    prefetch: int = 0
+    num_workers: int = 1
+    executor: str = 'thread'
+    chunked: bool = False
+    shuffle: bool = False
+    shuffle_window: int = 1
+    seed: int = None
+    batch_subset: list = None
+
+    def __post_init__(self):
+        self._random_state = np.random.RandomState(self.seed)
+
+    def subset(self, num_batches, seed=None):
+        """Loader of a fixed random subset of the batches
+
+        The batches are loaded in order and are the same every epoch.
+        """
+        batches = self.batches
+        num_batches = min(num_batches, len(batches))
+        index = np.random.RandomState(seed).choice(
+            len(batches), num_batches, replace=False)
+        return replace(self, chunked=False, shuffle=False,
+                       batch_subset=[batches[i] for i in sorted(index)])
 
     @property
     def batches(self):
+        if self.batch_subset is not None:
+            return list(self.batch_subset)
+
         n = self.num_samples
         batch_size = self.batch_size
         indices = list(range(0, n, batch_size)) + [n]
@@ -159,17 +449,82 @@ class XarrayBatchLoader:
     def num_samples(self):
         return len(self.dataset.sample)
 
+    @property
+    def chunks(self):
+        """Slices of the on-disk chunks along the sample dimension"""
+        dataset = self.dataset[self._get_variables()]
+        sizes = _sample_chunk_sizes(dataset, self.num_samples)
+        return _sizes_to_slices(sizes)
+
+    def _chunk_windows(self):
+        chunks = self.chunks
+        if self.shuffle:
+            order = self._random_state.permutation(len(chunks))
+            chunks = [chunks[i] for i in order]
+
+        n = self.shuffle_window
+        return [_window_index(chunks[i:i + n])
+                for i in range(0, len(chunks), n)]
+
     def __len__(self):
         return len(self.batches)
 
-    def __iter__(self):
-        for batch in self.batches:
-            if self.variables is None:
-                variables = list(self.dataset.data_vars)
+    def _get_variables(self):
+        if self.variables is None:
+            return list(self.dataset.data_vars)
+        else:
+            return list(self.variables)
+
+    def _map_load(self, indices):
+        variables = self._get_variables()
+        if self.prefetch > 0:
+            executor, load = _get_executor(self.executor, self.num_workers,
+                                           self.dataset)
+            load = partial(load, variables, self.dims)
+            with executor:
+                yield from map_ordered(load, indices, executor=executor,
+                                       depth=self.prefetch)
+        else:
+            load = partial(_load_batch, self.dataset, variables, self.dims)
+            yield from map(load, indices)
+
+    def _split_windows(self, windows):
+        axis = self.dims.index('sample')
+        sample_keys = [key for key in self._get_variables()
+                       if 'sample' in self.dataset[key].dims]
+        batch_size = self.batch_size
+
+        leftover = None
+        for window in windows:
+            data = _concat_samples(leftover, window, sample_keys, axis)
+            n = data[sample_keys[0]].shape[axis]
+            if self.shuffle:
+                index = self._random_state.permutation(n)
+                data = _take_samples(data, index, sample_keys, axis)
+
+            num_full = n - n % batch_size
+            for start in range(0, num_full, batch_size):
+                index = np.arange(start, start + batch_size)
+                yield _take_samples(data, index, sample_keys, axis)
+
+            if num_full < n:
+                index = np.arange(num_full, n)
+                leftover = _take_samples(data, index, sample_keys, axis)
             else:
-                variables = self.variables
-            subset = self.dataset[variables].isel(sample=batch)
-            numpy_dict = dataset_to_broadcastable_array_dict(subset, dims=self.dims)
+                leftover = None
+
+        if leftover is not None:
+            yield leftover
+
+    def _iter_numpy(self):
+        if self.chunked:
+            windows = self._map_load(self._chunk_windows())
+            yield from self._split_windows(windows)
+        else:
+            yield from self._map_load(self.batches)
+
+    def __iter__(self):
+        for numpy_dict in self._iter_numpy():
             if self.torch:
                 yield TensorDict.from_numpy_dict(numpy_dict)
             else:
@@ -214,7 +569,8 @@ def get_dataset(data, predict_radiation):
 def get_data_loader(
     ds: xr.Dataset,
     prognostics, 
-    batch_size
+    batch_size,
+    loader=None
 ):
     # List needed variables
     variables = prognostics + ['SST', 'SOLIN', 'QRAD']
@@ -222,5 +578,7 @@ def get_data_loader(
         forcing_key = 'F' + variable
         variables.append(forcing_key)
 
-    train_data = XarrayBatchLoader(ds, batch_size=batch_size, variables=variables, torch=True)
+    loader = loader or {}
+    train_data = XarrayBatchLoader(ds, batch_size=batch_size, variables=variables, torch=True,
+                                   **loader)
     return train_data
\ No newline at end of file
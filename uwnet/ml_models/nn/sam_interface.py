@@ -8,6 +8,11 @@ these are
 
 - UWNET_MODEL : The path to the model in a pickle file
 
+The models are listed in ``python_config.json``. A model of type
+``neural_network`` is a pickled module, and a model of type ``torchscript``
+is a module compiled by ``python -m uwnet.export torchscript``, which avoids
+the python overhead of the pickled module.
+
 
 Nudging
 ~~~~~~~
@@ -25,7 +30,7 @@ from toolz import curry, valmap
 
 import torch
 from torch import nn
-from uwnet.numpy_interface import NumpyWrapper
+from uwnet.numpy_interface import NumpyBinding, FlatNumpyWrapper
 from uwnet.sam_ngaqua import get_ngaqua_nudger
 import json
 from cProfile import Profile
@@ -53,6 +58,24 @@ def get_configuration():
         return {'models': []}
 
 
+# (CF name, neural network name)
+CF_NAMES = [
+    ("liquid_ice_static_energy", "SLI"),
+    ("x_wind", "U"),
+    ("y_wind", "V"),
+    ("upward_air_velocity", "W"),
+    ("total_water_mixing_ratio", "QT"),
+    ("air_temperature", "TABS"),
+    ("latitude", "lat"),
+    ("longitude", "lon"),
+    ("sea_surface_temperature", "SST"),
+    ("surface_air_pressure", "p0"),
+    ("toa_incoming_shortwave_flux", "SOLIN"),
+    ("surface_upward_sensible_heat_flux", "SHF"),
+    ("surface_upward_latent_heat_flux", "LHF"),
+]
+
+
 def rename_keys(rename_table, d):
     return {rename_table.get(key, key): d[key] for key in d}
 
@@ -62,24 +85,8 @@ def CFVariableNameAdapter(model, d, label=''):
     """Wrapper for translating input/output variable names in the neural network
     model to CF-compliant ones"""
 
-    table = [
-        ("liquid_ice_static_energy", "SLI"),
-        ("x_wind", "U"),
-        ("y_wind", "V"),
-        ("upward_air_velocity", "W"),
-        ("total_water_mixing_ratio", "QT"),
-        ("air_temperature", "TABS"),
-        ("latitude", "lat"),
-        ("longitude", "lon"),
-        ("sea_surface_temperature", "SST"),
-        ("surface_air_pressure", "p0"),
-        ("toa_incoming_shortwave_flux", "SOLIN"),
-        ("surface_upward_sensible_heat_flux", "SHF"),
-        ("surface_upward_latent_heat_flux", "LHF"),
-    ]
-
-    input_keys = dict(table)
-    output_keys = dict((y, x) for x, y in table)
+    input_keys = dict(CF_NAMES)
+    output_keys = dict((y, x) for x, y in CF_NAMES)
 
     # Translate from CF input names to the QT, SLI, names
     d_with_old_names = rename_keys(input_keys, d)
@@ -102,8 +109,16 @@ def get_model(config):
         model = torch.load(config['path'])
         if isinstance(model, nn.Module):
             model.eval()
-            model = NumpyWrapper(model)
+            rename = dict((y, x) for x, y in CF_NAMES)
+            return NumpyBinding(model, rename=rename, label='neural_network')
         return CFVariableNameAdapter(model, label='neural_network')
+    elif type == 'torchscript':
+        from uwnet.export import load_torchscript
+        module, metadata = load_torchscript(config['path'])
+        rename = dict((y, x) for x, y in CF_NAMES)
+        return FlatNumpyWrapper(module, metadata['inputs'],
+                                metadata['outputs'], rename=rename,
+                                label='neural_network')
     elif type == "cf":
         return torch.load(config['path'])
     elif type == 'nudging':
@@ -21,24 +21,26 @@ To see a list of all the available configuration options run::
 """
 import matplotlib
 matplotlib.use('agg')
+import copy
 import logging
 import os
-from contextlib import contextmanager
+from functools import partial
 from os.path import join
 
 import xarray as xr
 from sacred import Experiment
-from toolz import curry
 
 import torch
 from torch.optim.lr_scheduler import StepLR
 from ignite.engine import Engine, Events
 from .datasets_handler import get_timestep, XarrayBatchLoader, get_dataset, get_data_loader
-from uwnet.loss import get_input_output, get_step, weighted_mean_squared_error
+from .validation import (CheckpointValidator, attach_metrics,
+                         get_validation_engine, validate_checkpoint)
+from uwnet.loss import get_step, weighted_mean_squared_error
 from uwnet.model import get_model
 from uwnet.pre_post import get_pre_post
 from uwnet.training_plots import TrainingPlotManager
-from uwnet.metrics import WeightedMeanSquaredError
+from uwnet.utils import BackgroundWorker
 
 ex = Experiment("Q1", interactive=True)
 
@@ -63,6 +65,10 @@ def my_config():
     skip = 5
     time_length = None
     batch_size = 256
+    # read the next `prefetch` batches in the background while training.
+    # `chunked` reads whole on-disk chunks once and splits them into batches
+    loader = dict(prefetch=2, num_workers=2, executor='thread',
+                  chunked=False, shuffle=False, shuffle_window=1)
     vertical_grid_size = 34
     loss_scale = {
         'LHF': 150,
@@ -81,9 +87,15 @@ def my_config():
     output_dir = None
 
     prognostics = ['QT', 'SLI']
-    prepost = dict(kind='pca', path='models/prepost.pkl')
+    # `streaming` fits the pca pre/post processors from moments accumulated
+    # over blocks of `chunk_size` time points, reduced by `num_workers` threads.
+    # The fitted modules are saved in `cache_dir` and reused by later runs
+    # with the same dataset and configuration. Set it to None to always fit.
+    prepost = dict(kind='pca', path='models/prepost.pkl', streaming=False,
+                   chunk_size=16, num_workers=1,
+                   cache_dir='models/prepost_cache')
 
-    model = dict(kind='inner_model')
+    model = dict(kind='inner_model', fused=False)
 
     plots = dict(interval=1, single_column_locations=[(32, 0)])
     step = dict(
@@ -92,22 +104,23 @@ def my_config():
     )
     lr_decay_rate = None
     lr_step_size = 5
-
-
-def get_plot_manager(model):
+    # the checkpoints and plots of at most this many epochs wait to be written
+    # by a background thread. 0 writes them before training continues.
+    output_queue_size = 2
+    # `strategy` is one of
+    # - 'full': validate on the whole test set every epoch
+    # - 'subset': validate on a fixed random subset of `num_batches` test
+    #   batches, and on the whole test set every `full_every` epochs and at
+    #   the last epoch
+    # - 'process': validate each checkpoint on the whole test set in a
+    #   separate process while training continues
+    validation = dict(strategy='full', num_batches=20, full_every=5, seed=0)
+
+
+def get_plot_manager(model, output_dir='.'):
     from src.data import open_data
     dataset = open_data('training')
-    return TrainingPlotManager(ex, model, dataset)
-
-
-def get_validation_engine(model, dt):
-    def _validate(engine, data):
-        from uwnet.timestepper import Batch
-        # TODO this code duplicaates loss.py:107
-        batch = Batch(data.float(), prognostics=['QT', 'SLI'])
-        return get_input_output(model, dt, batch)
-
-    return Engine(_validate)
+    return TrainingPlotManager(ex, model, dataset, output_dir=output_dir)
 
 
 @ex.capture
@@ -128,7 +141,8 @@ class Trainer(object):
 
     @ex.capture
     def __init__(self, _run, lr, loss_scale, train_data, test_data,
-                 lr_decay_rate=None, lr_step_size=5):
+                 lr_decay_rate=None, lr_step_size=5, output_queue_size=2,
+                 validation=None):
         # setup logging
         logging.basicConfig(level=logging.INFO)
 
@@ -159,35 +173,79 @@ class Trainer(object):
 
         self.criterion = weighted_mean_squared_error(
             weights=self.mass / self.mass.mean(), dim=-3)
-        self.plot_manager = get_plot_manager(self.model)
-        self.setup_validation_engine()
+        # the checkpoints and plots are made from this copy of the model in a
+        # background thread, so that training can continue
+        self.output_worker = BackgroundWorker(
+            output_queue_size, background=output_queue_size > 0)
+        self.snapshot_model = copy.deepcopy(self.model)
+        self.plot_manager = get_plot_manager(self.snapshot_model,
+                                             self.output_dir)
+        self.validation = validation or {'strategy': 'full'}
+        # the metrics depend on the gradient stepper
         self.setup_engine()
+        self.setup_validation_engine()
 
     def step_lr_scheduler(self):
         if self.lr_scheduler is not None:
             self.lr_scheduler.step()
 
-    def log_validation_results(self, trainer):
-        self.tester.run(self.test_loader)
-        metrics = self.tester.state.metrics
-
-        log_str = "test metrics: "
+    def log_metrics(self, prefix, metrics, epoch):
+        log_str = f"{prefix} metrics: "
         for name, val in metrics.items():
-            ex.log_scalar("train_" + name, val)
+            ex.log_scalar(f"{prefix}_{name}", val, epoch)
             log_str += f'{name}: {val:.2f}\t'
         self.logger.info(log_str)
 
-        metrics = trainer.state.metrics
-        log_str = "train metrics: "
-        for name, val in metrics.items():
-            ex.log_scalar("test_" + name, val)
-            log_str += f'{name}: {val:.2f}\t'
-        self.logger.info(log_str)
+    def get_validation_loader(self, epoch, max_epochs):
+        """The test loader for an epoch, or None if validating in a process
+        """
+        strategy = self.validation['strategy']
+        if strategy == 'full':
+            return self.test_loader
+        elif strategy == 'process':
+            return None
+        elif strategy == 'subset':
+            full_every = self.validation['full_every']
+            if epoch == max_epochs or (full_every and epoch % full_every == 0):
+                return self.test_loader
+            return self.test_subset
+        else:
+            raise ValueError(f"Unknown validation strategy '{strategy}'")
+
+    def log_validation_results(self, trainer):
+        epoch = trainer.state.epoch
+        loader = self.get_validation_loader(epoch, trainer.state.max_epochs)
+        if loader is not None:
+            self.tester.run(loader)
+            self.log_metrics("test", self.tester.state.metrics, epoch)
+        self.log_metrics("train", trainer.state.metrics, epoch)
 
     def setup_validation_engine(self):
         self.tester = get_validation_engine(self.model, self.time_step)
         self.setup_metrics_for_engine(self.tester)
 
+        strategy = self.validation['strategy']
+        self.test_subset = None
+        self.checkpoint_validator = None
+        if strategy == 'subset':
+            self.test_subset = self.test_loader.subset(
+                self.validation['num_batches'], seed=self.validation['seed'])
+        elif strategy == 'process' and self.compute_metrics:
+            self.checkpoint_validator = self.get_checkpoint_validator()
+
+    @ex.capture
+    def get_checkpoint_validator(self, test_data, predict_radiation,
+                                 prognostics, batch_size, loader):
+        fun = partial(validate_checkpoint, data=test_data,
+                      predict_radiation=predict_radiation,
+                      prognostics=prognostics, batch_size=batch_size,
+                      mass=self.mass, dt=self.time_step, loader=loader)
+
+        def log(epoch, metrics):
+            self.log_metrics("test", metrics, epoch)
+
+        return CheckpointValidator(fun, log)
+
     @ex.capture(prefix='step')
     def get_step(self, name, kwargs, _log):
         _log.info(f"Using `{name}` gradient stepper")
@@ -217,16 +275,7 @@ class Trainer(object):
         if not self.compute_metrics:
             return
 
-        @curry
-        def output_transform(key, args):
-            x, y = args
-            return x[key], y[key]
-
-        for key in prognostics:
-            metric = WeightedMeanSquaredError(
-                self.mass, output_transform=output_transform(key))
-
-            metric.attach(engine, key)
+        attach_metrics(engine, self.mass, prognostics)
 
     def print_loss_info(self, engine):
         n = len(self.train_loader)
@@ -246,16 +295,34 @@ class Trainer(object):
         ex.log_scalar('loss', batch_info['loss'])
 
     def after_epoch(self, engine):
-        # save artifacts
-        n = engine.state.epoch
-        epoch_file = f"{n}.pkl"
+        # copy the weights now, and save artifacts in the background
+        state = {key: val.detach().clone()
+                 for key, val in self.model.state_dict().items()}
+        self.output_worker.submit(self.save_outputs, engine.state.epoch,
+                                  state)
+        self.step_lr_scheduler()
 
-        with self.change_to_work_dir():
-            torch.save(self.model, epoch_file)
-            ex.add_artifact(epoch_file)
-            self.plot_manager(engine)
+    def save_outputs(self, n, state):
+        """Save the checkpoint and plots of epoch n
 
-        self.step_lr_scheduler()
+        Parameters
+        ----------
+        n : int
+            the epoch
+        state : dict
+            a copy of the model's ``state_dict`` at the end of the epoch
+        """
+        self.logger.info(f"Saving outputs in {self.output_dir}")
+        self._make_work_dir()
+        self.snapshot_model.load_state_dict(state)
+        epoch_file = join(self.output_dir, f"{n}.pkl")
+        torch.save(self.snapshot_model, epoch_file)
+        ex.add_artifact(epoch_file)
+        with torch.no_grad():
+            self.plot_manager.plot_epoch(n)
+
+        if self.checkpoint_validator is not None:
+            self.checkpoint_validator.submit(epoch_file, n)
 
     def _make_work_dir(self):
         try:
@@ -263,22 +330,19 @@ class Trainer(object):
         except OSError:
             pass
 
-    @contextmanager
-    def change_to_work_dir(self):
-        """Context manager for using a working directory"""
-        self.logger.info(f"Saving outputs in {self.output_dir}")
-        self._make_work_dir()
-        try:
-            cwd = os.getcwd()
-            os.chdir(self.output_dir)
-            yield
-        finally:
-            os.chdir(cwd)
-
     @ex.capture
     def train(self, epochs):
-        """Train the neural network for a fixed number of epochs"""
-        self.engine.run(self.train_loader, max_epochs=epochs)
+        """Train the neural network for a fixed number of epochs
+
+        Waits for the checkpoints and plots to be saved, and the checkpoints
+        to be validated, before returning.
+        """
+        try:
+            self.engine.run(self.train_loader, max_epochs=epochs)
+        finally:
+            self.output_worker.close()
+            if self.checkpoint_validator is not None:
+                self.checkpoint_validator.close()
 
 
 @ex.command()
@@ -0,0 +1,142 @@
+"""Validation of neural network parametrizations during training
+
+The validation metrics are the :class:`uwnet.metrics.WeightedMeanSquaredError`
+of the apparent sources of each prognostic variable. They can be computed in
+the training process with :func:`validate`, or from a saved checkpoint in a
+separate process with :class:`CheckpointValidator`.
+"""
+import logging
+import threading
+from functools import partial
+
+import torch
+from ignite.engine import Engine
+
+from uwnet.loss import get_input_output
+from uwnet.metrics import WeightedMeanSquaredError
+from uwnet.utils import load_module, spawn_process_pool
+from .datasets_handler import get_data_loader, get_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def get_validation_engine(model, dt):
+    def _validate(engine, data):
+        from uwnet.timestepper import Batch
+        # TODO this code duplicaates loss.py:107
+        batch = Batch(data.float(), prognostics=['QT', 'SLI'])
+        with torch.no_grad():
+            return get_input_output(model, dt, batch)
+
+    return Engine(_validate)
+
+
+def _select(key, output):
+    x, y = output
+    return x[key], y[key]
+
+
+def attach_metrics(engine, mass, prognostics):
+    """Attach the weighted mean squared error of each prognostic variable"""
+    for key in prognostics:
+        metric = WeightedMeanSquaredError(
+            mass, output_transform=partial(_select, key))
+        metric.attach(engine, key)
+
+
+def validate(model, data_loader, mass, dt, prognostics):
+    """Validation metrics of a model
+
+    Returns
+    -------
+    dict
+        the metric of each prognostic variable
+    """
+    engine = get_validation_engine(model, dt)
+    attach_metrics(engine, mass, prognostics)
+    engine.run(data_loader)
+    return dict(engine.state.metrics)
+
+
+def validate_checkpoint(path, data, predict_radiation, prognostics,
+                        batch_size, mass, dt, loader=None):
+    """Validation metrics of a model saved at path on the dataset at data"""
+    model = load_module(path)
+    dataset = get_dataset(data, predict_radiation)
+    data_loader = get_data_loader(dataset, prognostics, batch_size,
+                                  loader=loader)
+    return validate(model, data_loader, mass, dt, prognostics)
+
+
+class CheckpointValidator(object):
+    """Validate checkpoints in a separate process
+
+    One checkpoint is validated at a time. If checkpoints are submitted
+    faster than they are validated, only the latest waiting one is validated.
+    An exception raised by a validation is logged, and re-raised by the next
+    :meth:`submit` or :meth:`close`.
+
+    Parameters
+    ----------
+    fun : callable
+        picklable function of the checkpoint path returning the metrics, e.g.
+        a partial of :func:`validate_checkpoint`
+    callback : callable
+        called with the epoch and metrics of each validated checkpoint
+    """
+
+    def __init__(self, fun, callback):
+        self.fun = fun
+        self.callback = callback
+        self._executor = spawn_process_pool(1)
+        self._condition = threading.Condition(threading.RLock())
+        self._running = None
+        self._waiting = None
+        self._error = None
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, path, epoch):
+        with self._condition:
+            self._raise()
+            if self._running is None:
+                self._start(path, epoch)
+            else:
+                if self._waiting is not None:
+                    logger.info(f"Skipping validation of epoch "
+                                f"{self._waiting[1]}")
+                self._waiting = (path, epoch)
+
+    def _start(self, path, epoch):
+        future = self._executor.submit(self.fun, path)
+        self._running = future
+        future.add_done_callback(partial(self._done, epoch))
+
+    def _done(self, epoch, future):
+        error = None
+        try:
+            self.callback(epoch, future.result())
+        except Exception as e:
+            logger.exception(f"Validation of epoch {epoch} failed")
+            error = e
+
+        with self._condition:
+            if self._error is None:
+                self._error = error
+            self._running = None
+            if self._waiting is not None:
+                path, epoch = self._waiting
+                self._waiting = None
+                self._start(path, epoch)
+            self._condition.notify_all()
+
+    def close(self):
+        """Wait for the validations to finish and stop the process"""
+        with self._condition:
+            while self._running is not None:
+                self._condition.wait()
+        self._executor.shutdown()
+        self._raise()
@@ -3,13 +3,29 @@ from torch import nn
 
 import uwnet.modules as um
 
+from .tensordict import PackedTensorDict, TensorDict
 from .xarray_interface import XRCallMixin
 
 
 class InnerModel(nn.Module, XRCallMixin):
-    """Inner model which operates with height along the last dimension"""
+    """Inner model which operates with height along the last dimension
 
-    def __init__(self, pre, post):
+    If ``fused`` is True, the inputs are concatenated into a single feature
+    matrix, and the fixed pre-processing and first layer are applied as one
+    matrix multiplication. Likewise for the final layer and post-processing.
+    This requires ``pre`` and ``post`` to be :class:`uwnet.modules.MapByKey`
+    objects of :class:`uwnet.modules.LinearFixed` modules (e.g. the ``pca``
+    pre/post processors) or :class:`uwnet.modules.IdentityByKey`, and gives
+    the same outputs as the unfused model. The concatenation is a view if the
+    inputs are a :class:`uwnet.tensordict.PackedTensorDict` with the input
+    variables adjacent along the height dimension.
+
+    In eval mode or with gradients disabled, the fused weights are computed
+    once and reused until the parameters change, and no gradients flow through
+    them.
+    """
+
+    def __init__(self, pre, post, fused=False):
         "docstring"
         super(InnerModel, self).__init__()
 
@@ -29,8 +45,94 @@ class InnerModel(nn.Module, XRCallMixin):
             post,
             transpose
         )
+        self.fused = fused
+        self._fused_cache = None
+        if fused:
+            self.fused_parameters()
+
+    def __getstate__(self):
+        # the cached fused weights are not saved
+        state = self.__dict__.copy()
+        state['_fused_cache'] = None
+        return state
+
+    def train(self, mode=True):
+        self._fused_cache = None
+        return super(InnerModel, self).train(mode)
+
+    @property
+    def output_names(self):
+        return [name for name, _ in self.model[9].inputs]
+
+    def fused_parameters(self):
+        """Weights and biases of the fused input and output layers"""
+        pre, linear_in, linear_out, post = (self.model[i]
+                                            for i in (1, 2, 8, 9))
+        for module in [pre, post]:
+            if not isinstance(module, (um.MapByKey, um.IdentityByKey)):
+                raise ValueError(
+                    "Only MapByKey pre/post processors can be fused, not "
+                    f"{type(module).__name__}")
+
+        weight, bias = linear_in.fused_parameters(self.input_names)
+        weight_in, bias_in = weight.t(), bias
+        if isinstance(pre, um.MapByKey):
+            pre_weight, pre_bias = pre.block_diagonal(self.input_names)
+            weight_in = pre_weight.matmul(weight.t())
+            bias_in = pre_bias.matmul(weight.t()) + bias
+
+        weight, bias = linear_out.fused_parameters(self.output_names)
+        weight_out, bias_out = weight.t(), bias
+        if isinstance(post, um.MapByKey):
+            post_weight, post_bias = post.block_diagonal(self.output_names)
+            weight_out = weight.t().matmul(post_weight)
+            bias_out = bias.matmul(post_weight) + post_bias
+
+        return (weight_in, bias_in), (weight_out, bias_out)
+
+    def _fused_key(self):
+        # changes if the parameters are replaced, moved, or updated in place
+        return tuple((tensor.data_ptr(), tensor._version)
+                     for i in (1, 2, 8, 9)
+                     for tensor in self.model[i].state_dict(
+                         keep_vars=True).values())
+
+    def _cached_fused_parameters(self):
+        key = self._fused_key()
+        # models saved before the cache was added lack the attribute
+        cached = getattr(self, '_fused_cache', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with torch.no_grad():
+            parameters = self.fused_parameters()
+        self._fused_cache = (key, parameters)
+        return parameters
+
+    def _forward_fused(self, x):
+        if self.training and torch.is_grad_enabled():
+            parameters = self.fused_parameters()
+        else:
+            parameters = self._cached_fused_parameters()
+        (weight_in, bias_in), (weight_out, bias_out) = parameters
+
+        if isinstance(x, PackedTensorDict) and x.dim == -3:
+            inputs = x.cat(self.input_names)
+        else:
+            inputs = torch.cat([x[key] for key in self.input_names], dim=-3)
+        hidden = inputs.transpose(-3, -1).matmul(weight_in) + bias_in
+        for i in range(3, 8):
+            hidden = self.model[i](hidden)
+        outputs = (hidden.matmul(weight_out) + bias_out).transpose(-3, -1)
+
+        sizes = [num for _, num in self.model[9].outputs]
+        return TensorDict(
+            dict(zip(self.output_names, outputs.split(sizes, dim=-3))))
 
     def forward(self, x):
+        # models saved before the fused option existed lack the attribute
+        if getattr(self, 'fused', False):
+            return self._forward_fused(x)
         return self.model(x[self.input_names])
 
 
@@ -40,4 +142,5 @@ def get_model(pre, post, _config):
     kind = _config['kind']
 
     if kind == 'inner_model':
-        return InnerModel(pre, post).to(dtype=torch.float)
+        fused = _config.get('fused', False)
+        return InnerModel(pre, post, fused=fused).to(dtype=torch.float)
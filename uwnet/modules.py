@@ -26,6 +26,51 @@ class LinearDictIn(nn.Module):
         return sum(self.models[key](input[key])
                    for key in self.models) + self.bias
 
+    def fused_parameters(self, keys):
+        """Weight and bias of a single layer acting on the inputs concatenated
+        along the last dimension in the order of ``keys``
+        """
+        weight = torch.cat([self.models[key].weight for key in keys], dim=1)
+        bias = sum(self.models[key].bias for key in keys) + self.bias
+        return weight, bias
+
+    def fold_input_affine(self, affines):
+        """Return an equivalent layer which is applied before an affine
+        transform of the inputs
+
+        Parameters
+        ----------
+        affines : dict
+            (weight, bias) for some of the inputs. The transformed input is
+            ``x @ weight + bias`` if ``weight`` is a matrix and ``x * weight +
+            bias`` if it is a vector. Inputs not present are unchanged.
+
+        Returns
+        -------
+        LinearDictIn
+            new layer such that ``new(x) == self(transformed(x))``
+        """
+        inputs = []
+        weights = {}
+        bias = self.bias.detach().clone()
+        for key, lin in self.models.items():
+            weight = lin.weight.detach()
+            if key in affines:
+                a, b = (arg.detach().to(weight.dtype) for arg in affines[key])
+                weight = weight * a if a.dim() <= 1 else weight.matmul(a.t())
+                bias += lin.weight.detach().matmul(b.view(-1).expand(
+                    lin.in_features))
+            weights[key] = weight
+            inputs.append((key, weight.size(1)))
+
+        folded = LinearDictIn(inputs, self.bias.size(0))
+        with torch.no_grad():
+            for key, lin in folded.models.items():
+                lin.weight.copy_(weights[key])
+                lin.bias.copy_(self.models[key].bias)
+            folded.bias.copy_(bias)
+        return folded
+
     def reset_parameters(self):
         n = sum(lin.weight.size(1) for lin in self.models.values())
         stdv = 1. / math.sqrt(n)
@@ -53,6 +98,53 @@ class LinearDictOut(nn.Module):
             {key: self.models[key](input)
              for key in self.models})
 
+    def fold_output_affine(self, affines):
+        """Return an equivalent layer which includes an affine transform of
+        the outputs
+
+        Parameters
+        ----------
+        affines : dict
+            (weight, bias) for some of the outputs. The transformed output is
+            ``y @ weight + bias`` if ``weight`` is a matrix and ``y * weight +
+            bias`` if it is a vector. Outputs not present are unchanged.
+
+        Returns
+        -------
+        LinearDictOut
+            new layer such that ``new(x) == transformed(self(x))``
+        """
+        weights = {}
+        biases = {}
+        for key, lin in self.models.items():
+            weight, bias = lin.weight.detach(), lin.bias.detach()
+            if key in affines:
+                a, b = (arg.detach().to(weight.dtype) for arg in affines[key])
+                if a.dim() <= 1:
+                    weight = weight * a.view(-1, 1)
+                    bias = bias * a + b.view(-1)
+                else:
+                    weight = a.t().matmul(weight)
+                    bias = bias.matmul(a) + b.view(-1)
+            weights[key] = weight
+            biases[key] = bias
+
+        outputs = [(key, weights[key].size(0)) for key in self.models]
+        folded = LinearDictOut(weights[outputs[0][0]].size(1), outputs)
+        with torch.no_grad():
+            for key, lin in folded.models.items():
+                lin.weight.copy_(weights[key])
+                lin.bias.copy_(biases[key])
+        return folded
+
+    def fused_parameters(self, keys):
+        """Weight and bias of a single layer whose output is the concatenation
+        of the outputs in the order of ``keys``
+        """
+        weight = torch.cat([self.models[key].weight for key in keys], dim=0)
+        bias = torch.cat([self.models[key].bias for key in keys], dim=0)
+        return weight, bias
+
 
 def get_affine_transforms(func, n):
     """Get weights matrix and bias of an affine function
@@ -224,6 +316,42 @@ class MapByKey(nn.Module):
     def forward(self, d):
         return TensorDict(mapbykey(self.funcs, d))
 
+    def block_diagonal(self, keys):
+        """Weight and bias of a single LinearFixed equivalent to this module
+        acting on inputs concatenated along the last dimension
+
+        All the modules must be instances of :class:`LinearFixed`.
+        """
+        funcs = [self.funcs[key] for key in keys]
+        for key, func in zip(keys, funcs):
+            if not isinstance(func, LinearFixed):
+                raise ValueError(f"The module for '{key}' is not LinearFixed")
+        weight = torch.block_diag(*[func.weight for func in funcs])
+        bias = torch.cat([func.bias.view(-1) for func in funcs])
+        return weight, bias
+
+
+class IdentityByKey(nn.Module):
+    """Identity pre/post processor with the same inputs and outputs
+
+    This replaces processors which have been folded into the neighboring
+    layers of a model.
+    """
+
+    def __init__(self, features):
+        """
+        Parameters
+        ----------
+        features : list of (str, int)
+            names and sizes of the inputs (and outputs)
+        """
+        super(IdentityByKey, self).__init__()
+        self.inputs = list(features)
+        self.outputs = list(features)
+
+    def forward(self, x):
+        return x
+
 
 class ConcatenatedWithIndex(nn.Module):
     """Module for concatenating the output of another module in a reproducable
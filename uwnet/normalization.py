@@ -1,26 +1,34 @@
+"""Normalization of the inputs and outputs of the neural networks
+
+The means and standard deviations are computed in a single pass over the
+data, by merging the :func:`moments` of chunks which can be reduced in
+parallel.
+"""
 import logging
-from functools import reduce
+import time
+from functools import partial
 
 from toolz.curried import valmap
-from toolz import first
 
 import torch
 from torch import nn
 
-import xarray as xr
+from .utils import dataset_process_pool, map_ordered, worker_dataset
 
 logger = logging.getLogger(__name__)
 
+# log the throughput every this many chunks
+LOG_INTERVAL = 100
 
-def _scale_var(scale, mean, x):
-    x = x.double()
-    mu = mean.double()
-    sig = scale.double()
 
-    x = x.sub(mu)
-    x = x.div(sig + 1e-7)
+def _affine_from_mean_scale(mean, scale):
+    """float32 weight and bias equivalent to ``(x - mean) / (scale + 1e-7)``
 
-    return x.float()
+    The affine transform is computed in double precision and then rounded.
+    """
+    weight = 1 / (scale.double() + 1e-7)
+    bias = -mean.double() * weight
+    return weight.float(), bias.float()
 
 
 def _dict_to_parameter_dict(x):
@@ -30,81 +38,266 @@ def _dict_to_parameter_dict(x):
     return nn.ParameterDict(out)
 
 
-def _convert_dataset_to_torch_dict(ds: xr.Dataset):
-    return {key: torch.from_numpy(ds[key].values)
-            for key in ds.data_vars}
+def _variable_moments(x, dims):
+    """Count, mean, and sum of squared deviations of x over dims
 
+    NaNs are skipped, so the count can differ between the features.
+    """
+    x = x.double()
+    valid = ~torch.isnan(x)
+    count = valid.sum(dims).double()
+    total = torch.where(valid, x, torch.zeros_like(x)).sum(dims)
+    mean = total / count.clamp(min=1)
 
-def _compute_scaler_data_from_xarray(dataset):
-    logger.info("Computing mean")
-    mean = dataset.mean(['x', 'y', 'time'])
-    logger.info("Computing std")
-    scale = dataset.std(['x', 'y', 'time'])
-
-    args = [valmap(torch.squeeze, _convert_dataset_to_torch_dict(arg))
-            for arg in [mean, scale]]
-    return args
+    dev = torch.where(valid, x - mean.view(_keepdim_shape(x, dims)),
+                      torch.zeros_like(x))
+    return count, mean, (dev ** 2).sum(dims)
 
 
-def add_tuples(x, y):
-    return tuple(xx + yy for xx, yy in zip(x, y))
+def _keepdim_shape(x, dims):
+    return [1 if i in dims else n for i, n in enumerate(x.shape)]
 
 
-def moments(data):
-    """Compute the first and second moments over first two dimensions
+def moments(data, dims=(0, 1)):
+    """Compute the moments of each variable over the first two dimensions
 
     Parameters
     ----------
     data : TensorDict
+    dims : tuple
+        the dimensions to reduce over
 
     Returns
     -------
-    num_examples, ex, ex2
+    dict
+        (count, mean, sum of squared deviations) of each variable. These can
+        be combined with :func:`merge_moments`.
     """
-    data = data.double()
-    first_variable = first(data.values())
-    shape = first_variable.shape
-    num_examples = shape[1] * shape[0]
-    m1 = data.sum(0).sum(0)
-    m2 = (data ** 2).sum(0).sum(0)
-    return num_examples, m1, m2
+    return {key: _variable_moments(val, dims) for key, val in data.items()}
+
+
+def _merge_variable_moments(a, b):
+    """Combine the (count, mean, sum of squared deviations) of two chunks
+
+    Uses the pairwise update of Chan, Golub, and LeVeque (1979), which is
+    stable in floating point and independent of the order of the chunks.
+    Works with numpy arrays or torch tensors. The sum of squared deviations is
+    either per feature, or the matrix of the sums of the products of the
+    deviations of each pair of features, whose diagonal is the former.
+    """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    # avoid dividing by zero if both chunks are empty
+    weight = count_b / (count + (count == 0))
+    delta = mean_b - mean_a
+    mean = mean_a + delta * weight
+    if m2_a.ndim > delta.ndim:
+        delta2 = delta[..., :, None] * delta[..., None, :]
+    else:
+        delta2 = delta ** 2
+    m2 = m2_a + m2_b + delta2 * (count_a * weight)
+    return count, mean, m2
+
+
+def merge_moments(a, b):
+    """Combine the :func:`moments` of two chunks of data"""
+    return {key: _merge_variable_moments(a[key], b[key]) for key in a}
 
 
-def moments_from_data_loader(loader):
-    n, m1, m2 = reduce(add_tuples, map(moments, iter(loader)))
-    m1 = m1 / n
-    v = m2 / n - m1 ** 2
-    return m1, v.sqrt()
+def _mean_std(moments):
+    mean = {key: val[1] for key, val in moments.items()}
+    std = {key: (m2 / count.clamp(min=1)).sqrt()
+           for key, (count, _, m2) in moments.items()}
+    return mean, std
+
+
+def _reduce_moments(chunks, num_chunks=None):
+    """Merge the moments of (moments, nbytes) pairs and log the throughput"""
+    total = None
+    nbytes = 0
+    start = time.perf_counter()
+    for i, (chunk, chunk_bytes) in enumerate(chunks, 1):
+        total = chunk if total is None else merge_moments(total, chunk)
+        nbytes += chunk_bytes
+        if i % LOG_INTERVAL == 0:
+            elapsed = time.perf_counter() - start
+            of = f" of {num_chunks}" if num_chunks else ""
+            logger.info(f"Moments of {i}{of} chunks: "
+                        f"{nbytes / 1e6 / elapsed:.1f} MB/s")
+
+    if total is None:
+        raise ValueError("Cannot compute the moments of no data")
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Computed the moments of {i} chunks ({nbytes / 1e6:.0f} MB) "
+                f"in {elapsed:.1f} s: {nbytes / 1e6 / elapsed:.1f} MB/s")
+    return total
+
+
+def _batch_moments(batch):
+    nbytes = sum(val.numel() * val.element_size() for val in batch.values())
+    return moments(batch), nbytes
+
+
+def moments_from_data_loader(loader, num_workers=1):
+    """Mean and standard deviation over the first two dimensions of batches
+
+    The moments of up to ``num_workers`` batches are computed in parallel
+    threads while the loader reads the next ones.
+    """
+    chunks = map_ordered(_batch_moments, iter(loader), num_workers)
+    return _mean_std(_reduce_moments(chunks))
+
+
+def _dataset_block_moments(dataset, dims, block):
+    """Moments of the variables of dataset.isel(time=block) over dims"""
+    block = dataset.isel(time=block).load()
+    out = {}
+    for key in block.data_vars:
+        val = block[key]
+        axes = tuple(val.get_axis_num(dim) for dim in dims if dim in val.dims)
+        x = torch.from_numpy(val.values)
+        if not axes:
+            x, axes = x.unsqueeze(0), (0, )
+        out[key] = _variable_moments(x, axes)
+    return out, block.nbytes
+
+
+def _worker_block_moments(dims, block):
+    return _dataset_block_moments(worker_dataset(), dims, block)
+
+
+def moments_from_xarray(dataset, dims=('x', 'y', 'time'), chunk_size=None,
+                        num_workers=1, executor='thread'):
+    """Mean and standard deviation of the variables of a dataset
+
+    Parameters
+    ----------
+    dataset : xr.Dataset
+    dims : tuple
+        the dimensions to reduce over
+    chunk_size : int, optional
+        the number of time points read at once. Defaults to the dask chunks
+        of ``dataset`` or the whole dataset.
+    num_workers : int
+        the number of chunks reduced in parallel
+    executor : str
+        'thread' or 'process'. Processes are useful for datasets opened
+        lazily (e.g. with ``xr.open_zarr``), which are cheap to send to the
+        workers.
+
+    Returns
+    -------
+    mean, std : dict
+    """
+    num_time = dataset.sizes['time']
+    if chunk_size is None:
+        chunks = dataset.chunks.get('time') if dataset.chunks else None
+        chunk_size = chunks[0] if chunks else num_time
+    blocks = [slice(start, start + chunk_size)
+              for start in range(0, num_time, chunk_size)]
+
+    if executor == 'process':
+        with dataset_process_pool(num_workers, dataset) as pool:
+            chunks = map_ordered(partial(_worker_block_moments, dims), blocks,
+                                 num_workers, executor=pool)
+            return _mean_std(_reduce_moments(chunks, len(blocks)))
+    elif executor == 'thread':
+        fun = partial(_dataset_block_moments, dataset, dims)
+        chunks = map_ordered(fun, blocks, num_workers)
+        return _mean_std(_reduce_moments(chunks, len(blocks)))
+    else:
+        raise ValueError(
+            f"Executor must be either 'thread' or 'process', not '{executor}'")
 
 
 class Scaler(nn.Module):
-    """Torch class for normalizing data along the final dimension"""
+    """Torch class for normalizing data along the final dimension
+
+    The normalization is applied as a precomputed float32 affine transform
+    ``x * weight + bias`` (see :meth:`affine`), which avoids the temporary
+    arrays of computing ``(x - mean) / scale`` in double precision.
+    """
 
     def __init__(self, mean=None, scale=None):
         "docstring"
         super(Scaler, self).__init__()
         self.mean = mean
         self.scale = scale
+        self._affine = None
+
+    def _affine_key(self):
+        # changes if the mean or scale are replaced, moved to a different
+        # device, or modified in place e.g. by load_state_dict
+        return tuple((key, tensor.data_ptr(), tensor._version)
+                     for params in [self.mean, self.scale]
+                     for key, tensor in params.items())
+
+    def affine(self):
+        """float32 (weight, bias) of each variable
+
+        These are computed once and recomputed if the mean or scale change.
+        """
+        key = self._affine_key()
+        # Scalers saved before this method was added lack the attribute
+        cached = getattr(self, '_affine', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        affine = {
+            key: _affine_from_mean_scale(self.mean[key], self.scale[key])
+            for key in self.scale if key in self.mean
+        }
+        self._affine = (key, affine)
+        return affine
 
     def forward(self, x):
+        affine = self.affine()
         out = {}
         for key in x:
-            if key in self.scale and key in self.mean:
-                out[key] = _scale_var(self.scale[key], self.mean[key], x[key])
+            if key in affine:
+                weight, bias = affine[key]
+                out[key] = torch.addcmul(bias, x[key].float(), weight)
             else:
                 out[key] = x[key]
         return out
 
+    def fold_into(self, linear):
+        """Fold the normalization into the following layer
+
+        Parameters
+        ----------
+        linear : uwnet.modules.LinearDictIn
+            the layer which is applied to the output of this Scaler
+
+        Returns
+        -------
+        LinearDictIn
+            a new layer equivalent to ``linear(self(x))``
+        """
+        return linear.fold_input_affine(self.affine())
+
     def set_mean_scale(self, mean, scale):
         self.mean = _dict_to_parameter_dict(mean)
         self.scale = _dict_to_parameter_dict(scale)
+        self._affine = None
+
+    def fit_xarray(self, dataset, **kwargs):
+        """Fit to the mean and std over x, y, and time of each variable
 
-    def fit_xarray(self, dataset):
-        mean, scale = _compute_scaler_data_from_xarray(dataset)
-        self.set_mean_scale(mean, scale)
+        The keyword arguments are passed to :func:`moments_from_xarray`.
+        """
+        mean, scale = moments_from_xarray(dataset, **kwargs)
+        self.set_mean_scale(valmap(torch.squeeze, mean),
+                            valmap(torch.squeeze, scale))
         return self
 
-    def fit_generator(self, data_loader):
-        mean, sig = moments_from_data_loader(data_loader)
-        self.set_mean_scale(mean.view(-1), sig.view(-1))
+    def fit_generator(self, data_loader, num_workers=1):
+        """Fit to the mean and std over the first two dimensions of batches
+        """
+        mean, sig = moments_from_data_loader(data_loader,
+                                             num_workers=num_workers)
+        self.set_mean_scale(valmap(lambda x: x.view(-1), mean),
+                            valmap(lambda x: x.view(-1), sig))
         return self
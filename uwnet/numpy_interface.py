@@ -35,3 +35,129 @@ def NumpyWrapper(model, state):
             kwargs[key] = val
 
     return call_with_numpy_dict(model, kwargs)
+
+
+def _output_name(key, rename, label):
+    name = rename.get(key, key)
+    if label is None:
+        return name
+    return f'tendency_of_{name}_due_to_{label}'
+
+
+class NumpyBinding(object):
+    """Persistent binding of a model to a dict of numpy arrays
+
+    Unlike :func:`NumpyWrapper`, the names of the inputs and outputs are
+    resolved once, and only the inputs of the model are converted. The outputs
+    are returned as numpy views of the model outputs.
+
+    Parameters
+    ----------
+    model : nn.Module
+        function of a :class:`TensorDict`
+    input_names : list of str, optional
+        names of the model inputs. Defaults to ``model.input_names`` if
+        present, and otherwise all the arrays in the first state.
+    rename : dict, optional
+        map from the model variable names to the state variable names
+    label : str, optional
+        if given, an output ``key`` is returned as
+        ``'tendency_of_{key}_due_to_{label}'``
+    """
+
+    def __init__(self, model, input_names=None, rename=None, label=None):
+        self.model = model
+        self.rename = dict(rename or {})
+        self.label = label
+        self._inputs = None
+        self._output_names = {}
+
+        if input_names is None:
+            input_names = getattr(model, 'input_names', None)
+        if input_names is not None:
+            self._inputs = self._resolve_inputs(input_names)
+
+    def _resolve_inputs(self, input_names):
+        return [(key, self.rename.get(key, key)) for key in input_names]
+
+    def _output_name(self, key):
+        try:
+            return self._output_names[key]
+        except KeyError:
+            name = _output_name(key, self.rename, self.label)
+            self._output_names[key] = name
+            return name
+
+    def __call__(self, state):
+        if self._inputs is None:
+            inverse = {val: key for key, val in self.rename.items()}
+            self._inputs = self._resolve_inputs(
+                inverse.get(key, key) for key, val in state.items()
+                if isinstance(val, np.ndarray))
+
+        inputs = TensorDict({key: torch.from_numpy(state[name])
+                             for key, name in self._inputs})
+        with torch.no_grad():
+            output = self.model(inputs)
+
+        return {self._output_name(key): val.numpy()
+                for key, val in output.items()}
+
+
+class FlatNumpyWrapper(object):
+    """Call a model with a flat tensor signature on a dict of numpy arrays
+
+    The inputs are copied into a preallocated float32 array of shape
+    (features, y, x), and the outputs are returned as views of the model
+    output. Two-dimensional inputs and outputs have shape (y, x). Like
+    :class:`NumpyBinding`, the names of the inputs and outputs are resolved
+    once.
+
+    Parameters
+    ----------
+    model : callable
+        function of a (features, y, x) tensor, e.g. a
+        :class:`uwnet.export.FlatModel`
+    inputs, outputs : list of (str, int)
+        names and sizes of the variables in the flat input and output
+    rename : dict, optional
+        map from the model variable names to the state variable names
+    label : str, optional
+        if given, an output ``key`` is returned as
+        ``'tendency_of_{key}_due_to_{label}'``
+    """
+
+    def __init__(self, model, inputs, outputs, rename=None, label=None):
+        rename = dict(rename or {})
+        self.model = model
+        self.inputs = [(rename.get(key, key), int(num)) for key, num in inputs]
+        self.outputs = [(_output_name(key, rename, label), int(num))
+                        for key, num in outputs]
+        self._buffer = None
+
+    def _get_buffer(self, horizontal_shape):
+        num_features = sum(num for _, num in self.inputs)
+        shape = (num_features, ) + tuple(horizontal_shape)
+        if self._buffer is None or self._buffer.shape != shape:
+            self._buffer = np.empty(shape, dtype=np.float32)
+        return self._buffer
+
+    def __call__(self, state):
+        horizontal_shape = state[self.inputs[0][0]].shape[-2:]
+        buffer = self._get_buffer(horizontal_shape)
+
+        start = 0
+        for key, num in self.inputs:
+            val = state[key].reshape((num, ) + horizontal_shape)
+            np.copyto(buffer[start:start + num], val, casting='unsafe')
+            start += num
+
+        with torch.no_grad():
+            output = self.model(torch.from_numpy(buffer)).numpy()
+
+        out = {}
+        start = 0
+        for key, num in self.outputs:
+            out[key] = output[start] if num == 1 else output[start:start + num]
+            start += num
+        return out
@@ -2,7 +2,17 @@
 
 Unlike pytorch's builtin tools, this code allows building pytorch modules from
 scikit-learn estimators.
+
+The PCA and scaling transforms only depend on the mean and covariance of the
+data, so they can also be fit without loading the whole dataset. With
+``streaming=True``, :func:`get_pre` and :func:`get_post` accumulate these
+moments over blocks of time points, which are reduced in parallel.
 """
+import hashlib
+import json
+import os
+from functools import partial
+
 import pandas as pd
 import numpy as np
 import xarray as xr
@@ -11,6 +21,9 @@ from torch import nn
 
 from uwnet.thermo import compute_apparent_source
 from uwnet.modules import MapByKey, LinearFixed
+from uwnet.normalization import merge_moments
+from uwnet.utils import (atomic_save, dataset_fingerprint, load_module,
+                         map_ordered)
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 
@@ -18,6 +31,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# change to invalidate the cached pre/post modules when the fitting changes
+CACHE_VERSION = 1
+
 
 def prepare_data(data, exog=['QT', 'SLI', 'SST', 'SOLIN'], sample=None):
     """Flatten XArray dataset into dataframe.
@@ -30,13 +46,8 @@ def prepare_data(data, exog=['QT', 'SLI', 'SST', 'SOLIN'], sample=None):
     logger.info(f"Size: {size} GB")
     vals = []
     names = []
-    sample_dims = ['x', 'y', 'time']
     for key in exog:
-        val = data[key].stack(s=sample_dims)
-        if 'z' not in val.dims:
-            val = val.expand_dims('z')
-
-        arr = val.transpose('s', 'z').values
+        arr = _flatten_samples(data[key])
         vals.append(arr)
 
         for z in range(arr.shape[1]):
@@ -47,6 +58,113 @@ def prepare_data(data, exog=['QT', 'SLI', 'SST', 'SOLIN'], sample=None):
     return pd.DataFrame(inputs, columns=idx)
 
 
+def _flatten_samples(val):
+    """Array of shape (samples, z) from a DataArray"""
+    val = val.stack(s=['x', 'y', 'time'])
+    if 'z' not in val.dims:
+        val = val.expand_dims('z')
+    return val.transpose('s', 'z').values
+
+
+def _block_moments(x):
+    """Number of samples, mean, and sum of squared deviations of an array
+
+    The samples (rows) containing NaNs are skipped.
+    """
+    x = x[np.all(np.isfinite(x), axis=1)].astype(np.float64)
+    n = x.shape[0]
+    if n == 0:
+        return 0, np.zeros(x.shape[1]), np.zeros((x.shape[1], x.shape[1]))
+    mean = x.mean(axis=0)
+    dev = x - mean
+    return n, mean, dev.T.dot(dev)
+
+
+def streaming_moments(data, keys, chunk_size=16, num_workers=1):
+    """Mean and covariance of the variables in a dataset
+
+    Parameters
+    ----------
+    data : xr.Dataset
+        dataset with a 'time' dimension. If it is backed by dask (e.g.
+        ``xr.open_zarr``), only ``num_workers`` blocks are loaded at once.
+    keys : list of str
+    chunk_size : int
+        the number of time points in each block
+    num_workers : int
+        the number of threads reducing blocks in parallel
+
+    Returns
+    -------
+    dict
+        (number of samples, mean, sum of squared deviations) of each
+        variable. The features are the heights.
+    """
+    def reduce_block(start):
+        block = data[keys].isel(time=slice(start, start + chunk_size))
+        return {key: _block_moments(_flatten_samples(block[key]))
+                for key in keys}
+
+    moments = None
+    starts = range(0, len(data.time), chunk_size)
+    for i, block in enumerate(map_ordered(reduce_block, starts,
+                                          num_workers)):
+        logger.debug(f"Reduced block {i + 1} of {len(starts)}")
+        if moments is None:
+            moments = block
+        else:
+            moments = merge_moments(moments, block)
+    return moments
+
+
+def _pca_from_moments(moments, n):
+    """Mean, components, and variances of the first n principal components
+
+    Matches :class:`sklearn.decomposition.PCA`, with the sign of each
+    component chosen so that its largest entry is positive.
+    """
+    count, mean, m2 = moments
+    eigenvalues, eigenvectors = np.linalg.eigh(m2 / (count - 1))
+    order = np.argsort(eigenvalues)[::-1][:n]
+    variance = eigenvalues[order]
+    components = eigenvectors[:, order].T
+
+    largest = np.argmax(np.abs(components), axis=1)
+    components *= np.sign(components[np.arange(len(order)), largest])[:, None]
+    # round off can make the smallest eigenvalues of the covariance negative
+    variance = np.maximum(variance, variance[0] * np.finfo(np.float64).eps)
+    return mean, components, variance
+
+
+def fit_pca_transform_from_moments(moments, n=16):
+    mean, components, variance = _pca_from_moments(moments, n)
+
+    def transform(x):
+        return (x - mean).dot(components.T) / np.sqrt(variance)
+
+    return LinearFixed.from_affine(transform, len(mean))
+
+
+def fit_pca_inverse_transform_from_moments(moments, n=16):
+    mean, components, variance = _pca_from_moments(moments, n)
+
+    def inverse_transform(x):
+        return (x * np.sqrt(variance)).dot(components) + mean
+
+    return LinearFixed.from_affine(inverse_transform, len(variance))
+
+
+def fit_scaler_transform_from_moments(moments):
+    count, mean, m2 = moments
+    scale = np.sqrt(np.diag(m2) / count)
+    scale[scale == 0.0] = 1.0
+
+    def transform(x):
+        return (x - mean) / scale
+
+    return LinearFixed.from_affine(transform, len(mean))
+
+
 def fit_pca_inverse_transform(q1, n=16):
     pca = PCA(n_components=n, whiten=True)
     pca.fit(q1)
@@ -64,12 +182,28 @@ def fit_scaler_transform(x):
     return LinearFixed.from_affine(scaler.transform, x.shape[1])
 
 
-def get_post(data, m=20):
-    logger.info("Fitting PCA models for outputs")
-    q1 = compute_apparent_source(data.SLI, data.FSLI * 86400).dropna('time')
-    q2 = compute_apparent_source(data.QT, data.FQT * 86400).dropna('time')
+def get_post(data, m=20, streaming=False, chunk_size=16, num_workers=1):
+    """PCA inverse transforms of the apparent sources
 
-    ds = xr.Dataset({'Q1': q1, 'Q2': q2})
+    If ``streaming``, fit from moments accumulated by
+    :func:`streaming_moments` over blocks of ``chunk_size`` time points.
+    """
+    logger.info("Fitting PCA models for outputs")
+    q1 = compute_apparent_source(data.SLI, data.FSLI * 86400)
+    q2 = compute_apparent_source(data.QT, data.FQT * 86400)
+
+    if streaming:
+        # the samples with NaNs at the last time are skipped by the blocks
+        ds = xr.Dataset({'Q1': q1, 'Q2': q2})
+        moments = streaming_moments(ds, ['Q1', 'Q2'], chunk_size=chunk_size,
+                                    num_workers=num_workers)
+        funcs = {
+            'SLI': fit_pca_inverse_transform_from_moments(moments['Q1'], m),
+            'QT': fit_pca_inverse_transform_from_moments(moments['Q2'], m),
+        }
+        return MapByKey(funcs)
+
+    ds = xr.Dataset({'Q1': q1.dropna('time'), 'Q2': q2.dropna('time')})
     df = prepare_data(ds, exog=['Q1', 'Q2'])
 
     funcs = {
@@ -80,9 +214,29 @@ def get_post(data, m=20):
     return MapByKey(funcs)
 
 
-def get_pre(data, m=20):
+def get_pre(data, m=20, streaming=False, chunk_size=16, num_workers=1):
+    """PCA transforms of the 3D inputs and scalers of the 2D inputs
+
+    If ``streaming``, fit from moments accumulated by
+    :func:`streaming_moments` over blocks of ``chunk_size`` time points.
+    """
     logger.info("Building preprocessing module")
     keys = ['QT', 'SLI', 'SHF', 'LHF', 'SOLIN', 'SST']
+    if streaming:
+        moments = streaming_moments(data, keys, chunk_size=chunk_size,
+                                    num_workers=num_workers)
+        transformers = {}
+        for key in keys:
+            if len(moments[key][1]) == 1:
+                logger.info(f"Fitting Scaler for {key}")
+                transformers[key] = fit_scaler_transform_from_moments(
+                    moments[key])
+            else:
+                logger.info(f"Fitting PCA for {key}")
+                transformers[key] = fit_pca_transform_from_moments(
+                    moments[key], m)
+        return MapByKey(transformers)
+
     df = prepare_data(data, exog=keys)
     transformers = {}
     for key in keys:
@@ -112,6 +266,11 @@ class Post(nn.Module):
         d['QT'] = d['QT'] * q0
         return d
 
+    def affine(self):
+        """(weight, bias) of the elementwise transform of each output"""
+        q0 = self.q0.clamp(max=1)
+        return {'QT': (q0, torch.zeros_like(q0))}
+
 
 class LowerAtmosInput(nn.Module):
 
@@ -169,16 +328,52 @@ def get_pre_post_orig(data, data_loader, n):
     return scaler, post
 
 
+def _cache_path(cache_dir, data, _config):
+    config = {key: val for key, val in _config.items()
+              if key not in ('cache_dir', 'num_workers')}
+    sha = hashlib.sha256()
+    sha.update(json.dumps([CACHE_VERSION, config], sort_keys=True,
+                          default=str).encode())
+    sha.update(dataset_fingerprint(data).encode())
+    return os.path.join(cache_dir, f"{config['kind']}-{sha.hexdigest()}.pkl")
+
+
 def get_pre_post(data, data_loader, _config):
+    """Fit or load the pre and post processing modules
+
+    If ``_config['cache_dir']`` is set, the fitted modules are saved in it,
+    and loaded on later calls with the same configuration and a dataset with
+    the same :func:`dataset_fingerprint`.
+    """
+    cache_dir = _config.get('cache_dir')
+    if not cache_dir or _config['kind'] in ('saved', 'identity'):
+        return _fit_pre_post(data, data_loader, _config)
+
+    path = _cache_path(cache_dir, data, _config)
+    if os.path.exists(path):
+        logger.info(f"Loading cached pre/post module from {path}")
+        return load_module(path)
+
+    pre_post = _fit_pre_post(data, data_loader, _config)
+    logger.info(f"Caching pre/post module to {path}")
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_save(partial(torch.save, pre_post), path)
+    return pre_post
+
+
+def _fit_pre_post(data, data_loader, _config):
     kind = _config['kind']
     logger.info(f"Getting pre/post processor of type {kind}")
 
     if kind == 'pca':
-        return get_pre(data, m=20), get_post(data, m=20)
+        kwargs = dict(streaming=_config.get('streaming', False),
+                      chunk_size=_config.get('chunk_size', 16),
+                      num_workers=_config.get('num_workers', 1))
+        return get_pre(data, m=20, **kwargs), get_post(data, m=20, **kwargs)
     elif kind == 'saved':
         path = _config['path']
         logger.info(f"Loading pre/post module from {path}")
-        return torch.load(path)
+        return load_module(path)
     elif kind == 'lower_atmos':
         pre, post = get_pre_post_orig(data, data_loader, n=34)
         lower = LowerAtmosInput()
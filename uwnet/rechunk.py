@@ -0,0 +1,251 @@
+"""Rechunk the arrays of a zarr group
+
+Each array is copied block by block in a pool of processes. The blocks are
+aligned with the destination chunks, so no two processes write the same chunk,
+and are sized so the blocks being copied at once fit in the memory budget. The
+bounds of the completed blocks are recorded in the destination, and running
+the same command again after an interruption only copies the missing blocks.
+If the memory budget or number of processes changes, the blocks change and are
+all copied again.
+
+The staggered dimensions xs and xc are chunked like x, and ys and yc like y.
+
+Examples
+--------
+
+Rechunk to single columns with all the time points in one chunk::
+
+    python -m uwnet.rechunk training_data.zarr rechunk.zarr \\
+        -c x=1 -c y=1 -c time=640 -c z=34
+
+"""
+import logging
+import os
+import time
+from concurrent.futures import as_completed
+from itertools import product
+
+import click
+import numpy as np
+import zarr
+
+from uwnet.utils import spawn_process_pool
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILE = '.rechunk_progress'
+
+# the dimension whose chunk size is used for each staggered dimension
+STAGGERED_DIMS = {'xs': 'x', 'xc': 'x', 'ys': 'y', 'yc': 'y'}
+
+ZARR_MAJOR_VERSION = int(zarr.__version__.split('.')[0])
+
+
+def parse_chunks(specs):
+    """Parse a sequence of 'dim=size' strings"""
+    chunks = {}
+    for spec in specs:
+        dim, size = spec.split('=')
+        chunks[dim] = int(size)
+    return chunks
+
+
+def get_dims(var):
+    return var.attrs['_ARRAY_DIMENSIONS']
+
+
+def get_target_chunks(var, chunks):
+    """Destination chunks of an array. Unspecified dims keep their chunks"""
+    target = []
+    for dim, size, length in zip(get_dims(var), var.chunks, var.shape):
+        dim = dim if dim in chunks else STAGGERED_DIMS.get(dim, dim)
+        target.append(min(chunks.get(dim, size), length))
+    return tuple(target)
+
+
+def get_block_shape(shape, chunks, itemsize, memory_budget):
+    """Largest multiple of the chunks which fits in the memory budget
+
+    The block is grown along the trailing dimensions first.
+    """
+    block = list(chunks)
+    for axis in reversed(range(len(shape))):
+        nbytes = int(np.prod(block)) * itemsize
+        num_chunks = max(1, memory_budget // nbytes)
+        block[axis] = min(shape[axis], block[axis] * num_chunks)
+        if block[axis] < shape[axis]:
+            break
+    return tuple(block)
+
+
+def get_blocks(shape, block_shape):
+    ranges = [range(0, n, size) for n, size in zip(shape, block_shape)]
+    return [
+        tuple(slice(start, min(start + size, n))
+              for start, size, n in zip(starts, block_shape, shape))
+        for starts in product(*ranges)
+    ]
+
+
+def rename_dims(var):
+    dims = var.attrs['_ARRAY_DIMENSIONS']
+    out = [STAGGERED_DIMS.get(dim, dim) for dim in dims]
+
+    var.attrs['_ARRAY_DIMENSIONS'] = out
+
+
+def _copy_block(src_path, dest_path, key, block):
+    src = zarr.open_group(src_path, mode='r')
+    dest = zarr.open_group(dest_path, mode='r+')
+    data = src[key][block]
+    dest[key][block] = data
+    return data.nbytes
+
+
+def format_block(block):
+    """String of the bounds of a block e.g. '0:3,2:4'"""
+    return ','.join(f'{s.start}:{s.stop}' for s in block)
+
+
+def _read_progress(dest_path):
+    """Set of (key, block bounds) of the completed blocks"""
+    path = os.path.join(dest_path, PROGRESS_FILE)
+    completed = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                key, bounds = line.split()
+                completed.add((key, bounds))
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def _forget_progress(dest_path, key):
+    path = os.path.join(dest_path, PROGRESS_FILE)
+    completed = {(k, b) for k, b in _read_progress(dest_path) if k != key}
+    with open(path, 'w') as f:
+        for k, b in sorted(completed):
+            print(k, b, file=f)
+
+
+def _open_destination(src, dest_path):
+    if ZARR_MAJOR_VERSION >= 3:
+        # the codecs of the source arrays are only valid in the same format
+        return zarr.open_group(dest_path, mode='a',
+                               zarr_format=src.metadata.zarr_format)
+    return zarr.open_group(dest_path, mode='a')
+
+
+def _codecs(var):
+    """Keyword arguments of create which copy the codecs of var"""
+    if ZARR_MAJOR_VERSION >= 3:
+        return dict(compressors=var.compressors, filters=var.filters)
+    return dict(compressor=var.compressor, filters=var.filters)
+
+
+def _create_destination(src, dest, dest_path, key, chunks):
+    var = src[key]
+    target_chunks = get_target_chunks(var, chunks)
+
+    if key in dest:
+        arr = dest[key]
+        if (arr.shape == var.shape and arr.chunks == target_chunks
+                and arr.dtype == var.dtype):
+            return arr
+
+    _forget_progress(dest_path, key)
+    arr = dest.create(key, shape=var.shape, chunks=target_chunks,
+                      dtype=var.dtype, fill_value=var.fill_value,
+                      overwrite=True, **_codecs(var))
+    arr.attrs.update(var.attrs.asdict())
+    return arr
+
+
+def rechunk_group(src_path, dest_path, chunks, memory_budget=2**30,
+                  processes=None, rename=False):
+    """Rechunk all the arrays in a zarr group
+
+    Parameters
+    ----------
+    src_path, dest_path : str
+        paths of the source and destination zarr groups
+    chunks : dict
+        destination chunk size for each dimension name
+    memory_budget : int
+        bytes shared by all the processes for the blocks being copied
+    processes : int, optional
+        size of the process pool. Defaults to the number of CPUs.
+    rename : bool
+        rename the staggered xs/xc/ys/yc dimensions to x and y
+
+    Returns
+    -------
+    throughput : float
+        MB/s copied by this invocation
+    """
+    processes = processes or os.cpu_count()
+    src = zarr.open_group(src_path, mode='r')
+    dest = _open_destination(src, dest_path)
+    dest.attrs.update(src.attrs.asdict())
+
+    budget_per_process = memory_budget // processes
+    total_bytes = 0
+    start = time.perf_counter()
+
+    with spawn_process_pool(processes) as executor, \
+            open(os.path.join(dest_path, PROGRESS_FILE), 'a') as progress:
+        for key in src.array_keys():
+            arr = _create_destination(src, dest, dest_path, key, chunks)
+            completed = _read_progress(dest_path)
+            block_shape = get_block_shape(arr.shape, arr.chunks,
+                                          arr.dtype.itemsize,
+                                          budget_per_process)
+            blocks = get_blocks(arr.shape, block_shape)
+            futures = {
+                executor.submit(_copy_block, src_path, dest_path, key,
+                                block): format_block(block)
+                for block in blocks
+                if (key, format_block(block)) not in completed
+            }
+            logger.info(f"Copying {len(futures)} of {len(blocks)} blocks "
+                        f"of {key}")
+
+            var_bytes = 0
+            var_start = time.perf_counter()
+            for future in as_completed(futures):
+                var_bytes += future.result()
+                print(key, futures[future], file=progress, flush=True)
+
+            elapsed = time.perf_counter() - var_start
+            logger.info(f"{key}: {var_bytes / 1e6 / elapsed:.2f} MB/s")
+            total_bytes += var_bytes
+
+    if rename:
+        for key in dest.array_keys():
+            rename_dims(dest[key])
+
+    return total_bytes / 1e6 / (time.perf_counter() - start)
+
+
+@click.command()
+@click.argument('src')
+@click.argument('dest')
+@click.option('-c', '--chunks', multiple=True,
+              help="chunk size of a dimension e.g. 'time=640'")
+@click.option('-m', '--memory-budget', default=1024,
+              help="memory in MB for the blocks being copied")
+@click.option('-j', '--processes', type=int, default=None)
+@click.option('--rename/--no-rename', default=True,
+              help="rename staggered dimensions (e.g. xs) to x and y")
+def main(src, dest, chunks, memory_budget, processes, rename):
+    """Rechunk the zarr group SRC into DEST"""
+    logging.basicConfig(level=logging.INFO)
+    throughput = rechunk_group(src, dest, parse_chunks(chunks),
+                               memory_budget=memory_budget * 2**20,
+                               processes=processes, rename=rename)
+    click.echo(f"Throughput: {throughput:.2f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
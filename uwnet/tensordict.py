@@ -1,55 +1,147 @@
 import functools
-from abc import ABCMeta
-from collections import KeysView, MutableMapping, defaultdict
+import operator
+from collections import defaultdict
+from collections.abc import KeysView, MutableMapping
 
 import torch
 import numpy as np
-from toolz import curry, first
-
-mathfuns = [
-    '__add__', '__rmul__', '__mul__', '__sub__', '__radd__', '__rmul__',
-    '__truediv__', '__floordiv__', '__pow__', '__rpow__'
-]
-
-dictfuns = ['__len__', '__iter__', '__delitem__', '__setitem__']
-
-
-@curry
-def valmap_binary_operator(name, self, other):
-    out = {}
-    for key in self.data:
-        func = getattr(self.data[key], name)
-        if isinstance(other, self.__class__):
-            out[key] = func(other.data[key])
-            if self.keys() != other.keys():
-                raise ValueError("Both arguments to binary arguments must "
-                                 "have the same keys.")
+from toolz import first
+
+# binary operators. The reflected operators swap the arguments.
+OPERATORS = {
+    '__add__': operator.add,
+    '__sub__': operator.sub,
+    '__mul__': operator.mul,
+    '__truediv__': operator.truediv,
+    '__floordiv__': operator.floordiv,
+    '__pow__': operator.pow,
+}
+
+REFLECTED_OPERATORS = {
+    '__radd__': operator.add,
+    '__rsub__': operator.sub,
+    '__rmul__': operator.mul,
+    '__rtruediv__': operator.truediv,
+    '__rpow__': operator.pow,
+}
+
+# torch._foreach functions used by the operators if TensorDict.use_foreach
+FOREACH_FUNCTIONS = {
+    '__add__': '_foreach_add',
+    '__sub__': '_foreach_sub',
+    '__mul__': '_foreach_mul',
+    '__truediv__': '_foreach_div',
+}
+
+
+def _foreach(fun_name, values, other, **kwargs):
+    """Apply a torch._foreach function
+
+    The foreach functions require tensors of the same shape and dtype, and
+    do not support autograd. NotImplemented is returned if they do not
+    apply.
+    """
+    fun = getattr(torch, fun_name, None)
+    if fun is None:
+        return NotImplemented
+    tensors = values + (other if isinstance(other, list) else [])
+    if not all(isinstance(val, torch.Tensor) for val in tensors):
+        return NotImplemented
+    if torch.is_grad_enabled() and any(val.requires_grad for val in tensors):
+        return NotImplemented
+    try:
+        return fun(values, other, **kwargs)
+    except (RuntimeError, TypeError):
+        return NotImplemented
+
+
+def _other_values(data, other):
+    """The values of other in the order of data, or other if it is a scalar"""
+    if isinstance(other, TensorDict):
+        other = other.data
+        if data.keys() != other.keys():
+            raise ValueError("Both arguments to binary arguments must "
+                             "have the same keys.")
+        return [other[key] for key in data]
+    else:
+        return other
+
+
+def _binary_operator(name):
+    op = OPERATORS[name]
+    foreach_name = FOREACH_FUNCTIONS.get(name, '')
+
+    def fun(self, other):
+        data = self.data
+        other = _other_values(data, other)
+        if self.use_foreach and isinstance(other, (list, int, float)):
+            out = _foreach(foreach_name, list(data.values()), other)
+            if out is not NotImplemented:
+                return TensorDict(dict(zip(data, out)))
+
+        if isinstance(other, list):
+            return TensorDict({key: op(val, other_val) for (key, val),
+                               other_val in zip(data.items(), other)})
         else:
-            out[key] = func(other)
-    return TensorDict(out)
+            return TensorDict({key: op(val, other)
+                               for key, val in data.items()})
 
+    fun.__name__ = name
+    return fun
 
-@curry
-def valmap_unary_operator(name, attrname, self, *args, **kwargs):
-    func = getattr(getattr(self, attrname), name)
-    return func(*args, **kwargs)
 
+def _reflected_operator(name):
+    op = REFLECTED_OPERATORS[name]
 
-class ArithmaticMeta(ABCMeta):
-    def __new__(cls, name, bases, dct):
-        for fun in mathfuns:
-            dct[fun] = valmap_binary_operator(fun)
-        for fun in dictfuns:
-            dct[fun] = valmap_unary_operator(fun, 'data')
-        return super().__new__(cls, name, bases, dct)
+    def fun(self, other):
+        return TensorDict(
+            {key: op(other, val) for key, val in self.data.items()})
 
+    fun.__name__ = name
+    return fun
 
-class TensorDict(MutableMapping, metaclass=ArithmaticMeta):
-    """Wrapper which overloads operators for dicts of tensors"""
+
+def _dispatch(name):
+    """Method calling ``name`` on each value. Cached by :class:`TensorDict`"""
+
+    def method(self, *args, **kwargs):
+        return TensorDict({key: getattr(val, name)(*args, **kwargs)
+                           for key, val in self.data.items()})
+
+    method.__name__ = name
+    return method
+
+
+class TensorDict(MutableMapping):
+    """Wrapper which overloads operators for dicts of tensors
+
+    The arithmetic operators act on each value, and attributes which are not
+    defined here are called on each value (e.g. ``d.float()``). If
+    ``use_foreach`` is True, arithmetic between tensors of the same shape and
+    dtype without autograd uses the fused ``torch._foreach`` functions. The
+    in place operations (``add_``, ``mul_``, ``add_scaled_``, ``+=``, etc.)
+    always use them when possible.
+    """
+    __slots__ = ('data', )
+
+    use_foreach = False
+    _methods = {}
 
     def __init__(self, data):
         self.data = data
 
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
     def __getitem__(self, key):
         if isinstance(key, (list, set, KeysView, self.__class__)):
             keys = list(key)
@@ -57,27 +149,108 @@ class TensorDict(MutableMapping, metaclass=ArithmaticMeta):
         else:
             return self.data[key]
 
+    def __getstate__(self):
+        return self.data
+
+    def __setstate__(self, state):
+        self.data = state
+
     def __getattr__(self, key):
         """Get attribute from the values"""
-        if 'data' in self.__dict__:
-            object = first(self.data.values())
-        else:
-            raise AttributeError()
+        try:
+            data = object.__getattribute__(self, 'data')
+        except AttributeError:
+            raise AttributeError(key)
+
+        # raises AttributeError if the values do not have the attribute
+        if not callable(getattr(first(data.values()), key)):
+            raise AttributeError(key)
 
-        @functools.wraps(getattr(object, key))
-        def fun(*args, **kwargs):
-            return self.apply(lambda x: getattr(x, key)(*args, **kwargs))
+        try:
+            method = self._methods[key]
+        except KeyError:
+            method = self._methods[key] = _dispatch(key)
+        return method.__get__(self, TensorDict)
 
-        return fun
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
 
     def copy(self):
         return TensorDict(self.data.copy())
 
+    def add_(self, other, alpha=1):
+        """In place ``self += other * alpha``"""
+        data = self.data
+        values = list(data.values())
+        other = _other_values(data, other)
+        if isinstance(other, list):
+            if _foreach('_foreach_add_', values, other,
+                        alpha=alpha) is NotImplemented:
+                for val, other_val in zip(values, other):
+                    val.add_(other_val, alpha=alpha)
+        elif _foreach('_foreach_add_', values,
+                      other * alpha) is NotImplemented:
+            for val in values:
+                val.add_(other * alpha)
+        return self
+
+    def mul_(self, other):
+        """In place ``self *= other``"""
+        data = self.data
+        values = list(data.values())
+        other = _other_values(data, other)
+        if _foreach('_foreach_mul_', values, other) is NotImplemented:
+            if isinstance(other, list):
+                for val, other_val in zip(values, other):
+                    val.mul_(other_val)
+            else:
+                for val in values:
+                    val.mul_(other)
+        return self
+
+    def add_scaled_(self, other, alpha):
+        """In place ``self += other * alpha``"""
+        return self.add_(other, alpha=alpha)
+
+    def add_scaled(self, other, alpha):
+        """``self + other * alpha`` without a temporary for ``other * alpha``
+        """
+        data = self.data
+        values = list(data.values())
+        other = _other_values(data, other)
+        if not isinstance(other, list):
+            return self + other * alpha
+
+        if self.use_foreach:
+            out = _foreach('_foreach_add', values, other, alpha=alpha)
+            if out is not NotImplemented:
+                return TensorDict(dict(zip(data, out)))
+
+        out = {}
+        for (key, val), other_val in zip(data.items(), other):
+            if isinstance(val, torch.Tensor):
+                out[key] = torch.add(val, other_val, alpha=alpha)
+            else:
+                out[key] = val + other_val * alpha
+        return TensorDict(out)
+
+    def __iadd__(self, other):
+        return self.add_(other)
+
+    def __isub__(self, other):
+        return self.add_(other, alpha=-1)
+
+    def __imul__(self, other):
+        return self.mul_(other)
+
     def apply(self, fun):
-        out = self.copy()
-        for key in self:
-            out[key] = fun(self[key])
-        return out
+        return TensorDict({key: fun(val) for key, val in self.data.items()})
 
     def __repr__(self):
         s = "TensorDict:\n"
@@ -114,8 +287,240 @@ class TensorDict(MutableMapping, metaclass=ArithmaticMeta):
         return cls(data_dict)
 
 
+for _name in OPERATORS:
+    setattr(TensorDict, _name, _binary_operator(_name))
+
+for _name in REFLECTED_OPERATORS:
+    setattr(TensorDict, _name, _reflected_operator(_name))
+
+
+# methods which act on each element and keep the shape. PackedTensorDict
+# applies them to the whole buffer at once.
+PACKED_METHODS = ('float', 'double', 'half', 'to', 'cpu', 'cuda', 'detach',
+                  'clone')
+
+
+def _packed_binary_operator(name):
+    op = OPERATORS[name]
+    unpacked = getattr(TensorDict, name)
+
+    def fun(self, other):
+        if isinstance(other, (int, float)):
+            return self._new(op(self.buffer, other))
+        elif self._same_layout(other):
+            return self._new(op(self.buffer, other.buffer))
+        return unpacked(self, other)
+
+    fun.__name__ = name
+    return fun
+
+
+def _packed_reflected_operator(name):
+    op = REFLECTED_OPERATORS[name]
+    unpacked = getattr(TensorDict, name)
+
+    def fun(self, other):
+        if isinstance(other, (int, float)):
+            return self._new(op(other, self.buffer))
+        return unpacked(self, other)
+
+    fun.__name__ = name
+    return fun
+
+
+def _packed_method(name):
+
+    def method(self, *args, **kwargs):
+        return self._new(getattr(self.buffer, name)(*args, **kwargs))
+
+    method.__name__ = name
+    return method
+
+
+class PackedTensorDict(TensorDict):
+    """TensorDict whose values are views of one contiguous buffer
+
+    The values are concatenated along the dimension ``dim``, and must have
+    the same size along the other dimensions. ``index`` maps each key to the
+    (offset, size) of its value along ``dim``. The views are only created
+    when the values are accessed.
+
+    Arithmetic between PackedTensorDicts with the same index, or with
+    scalars, the dtype/device casts (e.g. ``.float()``), :meth:`split` and
+    :func:`stack` are single operations on the buffer. Other operations act
+    on the views and return plain TensorDicts. Use :func:`pack` to create a
+    PackedTensorDict and :meth:`unpack` to convert it back.
+    """
+    __slots__ = ('buffer', 'index', 'dim', '_views')
+
+    def __init__(self, buffer, index, dim=-3):
+        if dim >= 0:
+            dim = dim - buffer.dim()
+        self.buffer = buffer
+        self.index = index
+        self.dim = dim
+        self._views = None
+
+    @property
+    def data(self):
+        if self._views is None:
+            self._views = {
+                key: self.buffer.narrow(self.dim, offset, size)
+                for key, (offset, size) in self.index.items()
+            }
+        return self._views
+
+    def _new(self, buffer):
+        return PackedTensorDict(buffer, self.index, self.dim)
+
+    def _same_layout(self, other):
+        return (isinstance(other, PackedTensorDict) and self.dim == other.dim
+                and (self.index is other.index or self.index == other.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __setitem__(self, key, value):
+        raise TypeError("Cannot set the values of a PackedTensorDict. Use "
+                        "unpack() to get a TensorDict.")
+
+    def __delitem__(self, key):
+        raise TypeError("Cannot delete the values of a PackedTensorDict. Use "
+                        "unpack() to get a TensorDict.")
+
+    def __getstate__(self):
+        return self.buffer, self.index, self.dim
+
+    def __setstate__(self, state):
+        self.buffer, self.index, self.dim = state
+        self._views = None
+
+    def __repr__(self):
+        s = "PackedTensorDict:\n"
+        s += "-----------------\n"
+        for key, (offset, size) in self.index.items():
+            s += f"{key} \t[{offset}:{offset + size}]\n"
+        s += f"buffer ({self.buffer.dtype}): {tuple(self.buffer.shape)}\n"
+        return s
+
+    def unpack(self):
+        """TensorDict of views into the buffer"""
+        return TensorDict(dict(self.data))
+
+    def copy(self):
+        return self._new(self.buffer)
+
+    def cat(self, keys):
+        """Concatenate the values of keys along ``dim``
+
+        This is a view of the buffer if the keys are adjacent and in order.
+        """
+        start, size = self.index[keys[0]]
+        end = start + size
+        for key in keys[1:]:
+            offset, size = self.index[key]
+            if offset != end:
+                return torch.cat([self.data[key] for key in keys], self.dim)
+            end += size
+        return self.buffer.narrow(self.dim, start, end - start)
+
+    def add_(self, other, alpha=1):
+        if isinstance(other, (int, float)):
+            self.buffer.add_(other * alpha)
+        elif self._same_layout(other):
+            self.buffer.add_(other.buffer, alpha=alpha)
+        else:
+            super(PackedTensorDict, self).add_(other, alpha=alpha)
+        return self
+
+    def mul_(self, other):
+        if isinstance(other, (int, float)):
+            self.buffer.mul_(other)
+        elif self._same_layout(other):
+            self.buffer.mul_(other.buffer)
+        else:
+            super(PackedTensorDict, self).mul_(other)
+        return self
+
+    def add_scaled(self, other, alpha):
+        if self._same_layout(other):
+            return self._new(torch.add(self.buffer, other.buffer, alpha=alpha))
+        return super(PackedTensorDict, self).add_scaled(other, alpha)
+
+    def split(self, split_size, dim=0):
+        if dim >= 0:
+            dim = dim - self.buffer.dim()
+        if dim == self.dim:
+            return super(PackedTensorDict, self).split(split_size, dim)
+        return [self._new(buffer) for buffer in
+                self.buffer.split(split_size, dim)]
+
+    def size(self, dim):
+        if dim >= 0:
+            dim = dim - self.buffer.dim()
+        if dim == self.dim:
+            return super(PackedTensorDict, self).size(dim)
+        return self.buffer.size(dim)
+
+
+for _name in OPERATORS:
+    setattr(PackedTensorDict, _name, _packed_binary_operator(_name))
+
+for _name in REFLECTED_OPERATORS:
+    setattr(PackedTensorDict, _name, _packed_reflected_operator(_name))
+
+for _name in PACKED_METHODS:
+    setattr(PackedTensorDict, _name, _packed_method(_name))
+
+
+def pack(td, keys=None, dim=-3):
+    """Copy the values of a TensorDict into a :class:`PackedTensorDict`
+
+    Parameters
+    ----------
+    td : TensorDict or dict
+    keys : list, optional
+        the keys to pack, in order. Defaults to all the keys of ``td``.
+    dim : int
+        the dimension to concatenate along. The values must have the same size
+        along the other dimensions.
+    """
+    if keys is None:
+        keys = list(td.keys())
+    values = [td[key] for key in keys]
+
+    index = {}
+    offset = 0
+    for key, val in zip(keys, values):
+        index[key] = (offset, val.size(dim))
+        offset += val.size(dim)
+
+    return PackedTensorDict(torch.cat(values, dim), index, dim)
+
+
 def stack(seq, dim=0):
-    """Stack tensordicts"""
+    """Stack tensordicts
+
+    PackedTensorDicts with the same index are stacked with a single operation.
+    """
+    seq = list(seq)
+    packed = seq[0]
+    if isinstance(packed, PackedTensorDict) and all(
+            packed._same_layout(item) for item in seq[1:]):
+        buffer = torch.stack([item.buffer for item in seq], dim=dim)
+        if dim < 0:
+            dim = dim + buffer.dim()
+        # the new dimension is after the packed one
+        if dim >= buffer.dim() + packed.dim:
+            return PackedTensorDict(buffer, packed.index, packed.dim - 1)
+        return PackedTensorDict(buffer, packed.index, packed.dim)
+
     data = defaultdict(list)
 
     for item in seq:
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import xarray as xr
+from torch import nn
+
+from uwnet.columns import single_column_simulation
+from uwnet.tensordict import TensorDict
+from uwnet.xarray_interface import XRCallMixin
+
+
+class Relaxation(nn.Module, XRCallMixin):
+    def forward(self, x):
+        return TensorDict({
+            'QT': -x['QT'] + x['SST'],
+            'SLI': -x['SLI'] * 2,
+        })
+
+
+def _dataset(t=5, z=3, y=2, x=4):
+    dims_3d = ['time', 'z', 'y', 'x']
+    dims_2d = ['time', 'y', 'x']
+    coords = {'time': np.arange(t) / 8, 'z': np.arange(z), 'y': np.arange(y),
+              'x': np.arange(x)}
+    return xr.Dataset({
+        'QT': (dims_3d, np.random.rand(t, z, y, x)),
+        'SLI': (dims_3d, np.random.rand(t, z, y, x)),
+        'FQT': (dims_3d, np.random.rand(t, z, y, x)),
+        'FSLI': (dims_3d, np.random.rand(t, z, y, x)),
+        'SST': (dims_2d, np.random.rand(t, y, x)),
+    }, coords=coords)
+
+
+@pytest.mark.parametrize('interval', [None, (1, 4)])
+def test_single_column_simulation_tensor_engine(interval):
+    ds = _dataset()
+    model = Relaxation()
+    kwargs = dict(interval=interval, prognostics=['QT', 'SLI'])
+    expected = single_column_simulation(model, ds, **kwargs)
+    out = single_column_simulation(model, ds, engine='tensor', **kwargs)
+
+    assert set(out.data_vars) == set(expected.data_vars)
+    for key in expected.data_vars:
+        assert out[key].dims == expected[key].dims
+        np.testing.assert_allclose(out[key].values, expected[key].values,
+                                   rtol=1e-5)
+    np.testing.assert_array_equal(out.time.values, expected.time.values)
@@ -1,8 +1,13 @@
 import numpy as np
 import pytest
+import torch
 import xarray as xr
 
-from uwnet.ml_models.nn.datasets_handler import XRTimeSeries, get_timestep, XarrayBatchLoader
+from torch.utils.data import DataLoader
+
+from uwnet.ml_models.nn.datasets_handler import (
+    XRTimeSeries, get_timestep, XarrayBatchLoader, get_batched_data_loader)
+from uwnet.tensordict import TensorDict
 
 
 def get_obj():
@@ -105,3 +110,221 @@ def test_XarrayBatchLoader_iter():
     # see if the loader works
     for batch in loader:
         check_batch(batch, num_time)
+
+
+def _init_XarrayBatchLoader_random(num_samples, batch_size, **kwargs):
+    ds = xr.Dataset({
+        'a': (['sample', 'time', 'z'], np.random.rand(num_samples, 3, 2)),
+        'b': (['sample', 'time'], np.random.rand(num_samples, 3)),
+    })
+    return XarrayBatchLoader(ds, batch_size=batch_size, **kwargs)
+
+
+@pytest.mark.parametrize('executor, prefetch, num_workers', [
+    ('thread', 1, 1),
+    ('thread', 3, 2),
+    ('process', 2, 2),
+])
+def test_XarrayBatchLoader_prefetch_is_deterministic(executor, prefetch,
+                                                     num_workers):
+    loader = _init_XarrayBatchLoader_random(20, 3)
+    expected = list(loader)
+
+    loader.prefetch = prefetch
+    loader.num_workers = num_workers
+    loader.executor = executor
+    actual = list(loader)
+
+    assert len(actual) == len(expected)
+    for a, b in zip(actual, expected):
+        for key in b:
+            np.testing.assert_array_equal(a[key], b[key])
+
+
+def test_XarrayBatchLoader_process_sends_dataset_once(monkeypatch):
+    num_pickles = []
+
+    def _reduce_ex(self, protocol):
+        num_pickles.append(1)
+        return object.__reduce_ex__(self, protocol)
+
+    monkeypatch.setattr(xr.Dataset, '__reduce_ex__', _reduce_ex,
+                        raising=False)
+    loader = _init_XarrayBatchLoader_random(20, 2, prefetch=2, num_workers=2,
+                                            executor='process')
+    assert len(list(loader)) == 10
+    assert len(num_pickles) <= loader.num_workers
+
+
+def test_XarrayBatchLoader_prefetch_invalid_executor():
+    loader = _init_XarrayBatchLoader_random(5, 2, prefetch=1,
+                                            executor='gpu')
+    with pytest.raises(ValueError):
+        list(loader)
+
+
+def _chunked_loader(num_samples, batch_size, chunk_size, **kwargs):
+    loader = _init_XarrayBatchLoader_random(num_samples, batch_size)
+    ds = loader.dataset.assign(c=('z', np.ones(2)))
+    ds = ds.chunk({'sample': chunk_size})
+    return XarrayBatchLoader(ds, batch_size=batch_size, chunked=True,
+                             **kwargs)
+
+
+def test_XarrayBatchLoader_chunks():
+    loader = _chunked_loader(10, 3, 4)
+    assert loader.chunks == [slice(0, 4), slice(4, 8), slice(8, 10)]
+
+
+def test_XarrayBatchLoader_chunked_matches_unchunked():
+    loader = _chunked_loader(23, 5, 4, shuffle_window=2)
+    expected = list(XarrayBatchLoader(loader.dataset, batch_size=5))
+    actual = list(loader)
+
+    assert len(actual) == len(expected) == len(loader)
+    for a, b in zip(actual, expected):
+        for key in b:
+            np.testing.assert_array_equal(a[key], b[key])
+
+
+@pytest.mark.parametrize('shuffle_window', [1, 3])
+def test_XarrayBatchLoader_chunked_shuffle(shuffle_window):
+    num_samples, batch_size = 23, 5
+    loader = _chunked_loader(num_samples, batch_size, 4, shuffle=True,
+                             shuffle_window=shuffle_window, seed=0)
+    batches = list(loader)
+
+    sizes = [batch['a'].shape[0] for batch in batches]
+    assert sizes == [5, 5, 5, 5, 3]
+
+    # every sample appears exactly once
+    actual = np.sort(np.concatenate([batch['b'][:, 0].ravel()
+                                     for batch in batches]))
+    expected = np.sort(loader.dataset['b'].values[:, 0])
+    np.testing.assert_array_equal(actual, expected)
+
+    # variables without a sample dimension are not split
+    assert batches[0]['c'].shape == (1, 1, 2, 1, 1)
+
+
+def test_XarrayBatchLoader_chunked_reads_each_chunk_once(monkeypatch):
+    import uwnet.ml_models.nn.datasets_handler as handler
+    calls = []
+    load_batch = handler._load_batch
+
+    def _mock_load_batch(dataset, variables, dims, index):
+        calls.append(index)
+        return load_batch(dataset, variables, dims, index)
+
+    monkeypatch.setattr(handler, '_load_batch', _mock_load_batch)
+    loader = _chunked_loader(23, 3, 4, shuffle=True, shuffle_window=2)
+    list(loader)
+    assert len(calls) == 3
+
+
+def _random_time_series_dataset():
+    ds, _ = get_obj()
+    return ds.assign(a=ds.a * np.random.rand(*ds.a.shape),
+                     b=ds.b * np.random.rand(*ds.b.shape),
+                     layer_mass=('z', np.ones(len(ds.z))))
+
+
+@pytest.mark.parametrize('time_length', [1, 2])
+def test_XRTimeSeries_cache_matches_in_memory(tmpdir, time_length):
+    ds = _random_time_series_dataset()
+
+    expected = XRTimeSeries(ds, time_length=time_length)
+    cached = XRTimeSeries(ds, time_length=time_length, cache_dir=str(tmpdir))
+
+    assert len(cached) == len(expected)
+    for i in [0, 3, -1]:
+        a, b = cached[i], expected[i]
+        assert set(a) == set(b)
+        for key in b:
+            assert isinstance(a[key], torch.Tensor)
+            np.testing.assert_array_equal(a[key].numpy(), b[key])
+
+
+def test_XRTimeSeries_cache_is_reused(tmpdir):
+    ds = _random_time_series_dataset()
+    XRTimeSeries(ds, cache_dir=str(tmpdir))
+    path = tmpdir.join('a.npy')
+    mtime = path.mtime()
+
+    XRTimeSeries(ds, cache_dir=str(tmpdir))
+    assert path.mtime() == mtime
+    assert not tmpdir.join('layer_mass.npy').exists()
+
+    # a dataset with the same shapes but different values rebuilds the cache
+    ds = ds.assign(a=ds.a + 1)
+    cached = XRTimeSeries(ds, cache_dir=str(tmpdir))
+    expected = XRTimeSeries(ds)
+    np.testing.assert_array_equal(cached[0]['a'].numpy(), expected[0]['a'])
+
+
+@pytest.mark.parametrize('cache', [False, True])
+@pytest.mark.parametrize('time_length', [1, 2, 4])
+def test_XRTimeSeries_gather(tmpdir, cache, time_length):
+    ds = _random_time_series_dataset()
+    cache_dir = str(tmpdir) if cache else None
+    dataset = XRTimeSeries(ds, time_length=time_length, cache_dir=cache_dir)
+
+    indices = [0, 5, 2, len(dataset) - 1]
+    batch = dataset.gather(indices)
+    expected = next(iter(DataLoader([dataset[i] for i in indices],
+                                    batch_size=len(indices))))
+
+    assert isinstance(batch, TensorDict)
+    assert set(batch) == set(expected)
+    for key in expected:
+        assert batch[key].dtype == torch.float32
+        np.testing.assert_array_equal(batch[key].numpy(),
+                                      expected[key].numpy())
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_XRTimeSeries_default_collate(tmpdir, cache):
+    from torch.utils.data.dataloader import default_collate
+    ds = _random_time_series_dataset()
+    cache_dir = str(tmpdir) if cache else None
+    dataset = XRTimeSeries(ds, time_length=2, cache_dir=cache_dir)
+
+    # the DataLoader collates the output of __getitems__ if it is defined
+    indices = [0, 5, 2]
+    batch = default_collate(dataset.__getitems__(indices))
+    expected = dataset.gather(indices)
+    for key in expected:
+        np.testing.assert_array_equal(batch[key].numpy(),
+                                      expected[key].numpy())
+
+    batches = list(DataLoader(dataset, batch_size=7))
+    assert [batch['a'].shape[0] for batch in batches] == [7, 7, 6]
+
+
+def test_get_batched_data_loader():
+    ds = _random_time_series_dataset()
+    dataset = XRTimeSeries(ds, time_length=2)
+    loader = get_batched_data_loader(dataset, batch_size=7)
+
+    batches = list(loader)
+    assert [batch['a'].shape[0] for batch in batches] == [7, 7, 6]
+    np.testing.assert_array_equal(batches[1]['a'].numpy(),
+                                  dataset[list(range(7, 14))]['a'].numpy())
+
+
+def test_XarrayBatchLoader_subset():
+    loader = _init_XarrayBatchLoader_random(20, 3, chunked=True,
+                                            shuffle=True)
+    subset = loader.subset(3, seed=1)
+    assert len(subset) == 3
+    assert subset.batches == loader.subset(3, seed=1).batches
+    for batch in subset.batches:
+        assert batch in loader.batches
+
+    first = [batch['a'] for batch in subset]
+    second = [batch['a'] for batch in subset]
+    assert len(first) == 3
+    for x, y in zip(first, second):
+        np.testing.assert_equal(x, y)
+
+    assert len(loader.subset(100)) == len(loader)
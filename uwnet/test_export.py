@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import torch
+
+from uwnet.export import fold_pre_post, load_torchscript, save_torchscript
+from uwnet.model import InnerModel
+from uwnet.modules import IdentityByKey, MapByKey
+from uwnet.normalization import Scaler
+from uwnet.numpy_interface import FlatNumpyWrapper, NumpyWrapper
+from uwnet.pre_post import Post
+from uwnet.tensordict import TensorDict
+from uwnet.testing import random_pca_pre_post
+
+
+def _random_scaler_pre_post(z):
+    inputs = [('QT', z), ('SLI', z), ('SOLIN', 1)]
+    mean = {'QT': torch.rand(z), 'SLI': torch.rand(z), 'SOLIN': torch.rand(())}
+    scale = {key: val + 1 for key, val in mean.items()}
+    pre = Scaler(mean, scale)
+    pre.inputs = pre.outputs = inputs
+    post = Post(torch.rand(z) * 2, [('QT', z), ('SLI', z)])
+    return pre, post
+
+
+def _batch(shape):
+    shape_2d = shape[:-3] + (1, ) + shape[-2:]
+    return TensorDict({'QT': torch.rand(shape), 'SLI': torch.rand(shape),
+                       'SOLIN': torch.rand(shape_2d)})
+
+
+@pytest.mark.parametrize('get_pre_post', [
+    random_pca_pre_post, _random_scaler_pre_post])
+@pytest.mark.parametrize('fused', [False, True])
+def test_fold_pre_post(get_pre_post, fused):
+    z = 5
+    batch = _batch((10, z, 4, 3))
+    model = InnerModel(*get_pre_post(z))
+    folded = fold_pre_post(model)
+    folded.fused = fused
+
+    assert isinstance(folded.model[1], IdentityByKey)
+    assert isinstance(folded.model[9], IdentityByKey)
+    assert folded.input_names == model.input_names
+    assert folded.output_names == model.output_names
+
+    with torch.no_grad():
+        expected = model(batch)
+        actual = folded(batch)
+
+    assert set(actual) == set(expected)
+    for key in expected:
+        np.testing.assert_allclose(actual[key].numpy(),
+                                   expected[key].numpy(), rtol=1e-4,
+                                   atol=1e-6)
+
+
+def test_fold_pre_post_does_not_modify_model():
+    model = InnerModel(*random_pca_pre_post(5))
+    weight = model.model[2].models['QT'].weight.detach().clone()
+    fold_pre_post(model)
+    assert isinstance(model.model[1], MapByKey)
+    assert torch.equal(model.model[2].models['QT'].weight, weight)
+
+
+def test_torchscript_matches_model(tmpdir):
+    z, y, x = 5, 4, 3
+    model = InnerModel(*random_pca_pre_post(z))
+    path = str(tmpdir.join('model.pt'))
+    save_torchscript(model, path)
+    module, metadata = load_torchscript(path)
+
+    assert [key for key, _ in metadata['inputs']] == model.input_names
+    assert [key for key, _ in metadata['outputs']] == model.output_names
+
+    state = {'QT': np.random.rand(z, y, x), 'SLI': np.random.rand(z, y, x),
+             'SOLIN': np.random.rand(y, x).astype(np.float32),
+             'day': 1.0}
+    fast = FlatNumpyWrapper(module, metadata['inputs'], metadata['outputs'])
+    actual = fast(state)
+
+    inputs = {key: val.astype(np.float32) for key, val in state.items()
+              if key != 'day'}
+    inputs['SOLIN'] = inputs['SOLIN'][np.newaxis]
+    expected = NumpyWrapper(model.eval(), inputs)
+
+    assert set(actual) == set(expected)
+    for key in expected:
+        np.testing.assert_allclose(actual[key], expected[key], rtol=1e-4,
+                                   atol=1e-6)
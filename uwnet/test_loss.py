@@ -117,3 +117,41 @@ def test_r2_score():
 
     score = r2_score(a, a.mean())
     assert score.item() == approx(0.0)
+
+
+def _training_problem(n_time=7):
+    model = torch.nn.Linear(3, 3).double()
+
+    def source(x):
+        return TensorDict({'a': model(x['a']) + x['b']})
+
+    source.parameters = model.parameters
+
+    data = TensorDict({'a': torch.rand(2, n_time, 3),
+                       'Fa': torch.rand(2, n_time, 3) / 1000,
+                       'b': torch.rand(2, n_time, 3)}).double()
+    self = Mock()
+    self.model = source
+    self.time_step = 1000.0
+    return self, model, Batch(data, prognostics=['a'])
+
+
+@pytest.mark.parametrize('truncation', [2, 3, 6, 100])
+def test_multiple_step_loss_step_truncation(truncation):
+    self, model, batch = _training_problem()
+    engine = Mock()
+
+    # the mock optimizer does not reset the gradients
+    model.zero_grad()
+    expected = multiple_step_loss_step(self, engine, batch)['loss']
+    expected_grad = model.weight.grad.clone()
+
+    model.zero_grad()
+    loss = multiple_step_loss_step(self, engine, batch,
+                                   truncation=truncation)['loss']
+    assert loss == approx(expected)
+    if truncation >= batch.num_time - 1:
+        np.testing.assert_allclose(model.weight.grad.numpy(),
+                                   expected_grad.numpy(), rtol=1e-6)
+    else:
+        assert model.weight.grad is not None
@@ -7,6 +7,7 @@ from torch.nn import Module
 import xarray as xr
 from uwnet.xarray_interface import call_with_xr
 from uwnet.modules import MOE
+from uwnet.testing import random_pca_pre_post
 
 sl_name = 'SLI'
 
@@ -104,3 +105,97 @@ def test_call_with_xr(drop_time):
     ds = xr.Dataset({'a': (dims, np.random.rand(*shape))}, coords=coords)
     out = call_with_xr(model, ds, drop_times=drop_time)
     np.testing.assert_array_equal(ds.a.values[drop_time:], out.a.values)
+
+
+@pytest.mark.parametrize('shape', [(10, 5, 4, 3), (5, 4, 3)])
+def test_InnerModel_fused_matches_unfused(shape):
+    from uwnet.model import InnerModel
+
+    from uwnet.tensordict import TensorDict
+
+    z = shape[-3]
+    shape_2d = shape[:-3] + (1, ) + shape[-2:]
+    model = InnerModel(*random_pca_pre_post(z))
+    batch = TensorDict({'QT': torch.rand(shape), 'SLI': torch.rand(shape),
+                        'SOLIN': torch.rand(shape_2d)})
+
+    expected = model(batch)
+    model.fused = True
+    actual = model(batch)
+
+    assert set(actual) == set(expected)
+    for key in expected:
+        assert actual[key].shape == expected[key].shape
+        np.testing.assert_allclose(actual[key].detach().numpy(),
+                                   expected[key].detach().numpy(),
+                                   rtol=1e-4, atol=1e-6)
+
+    # gradients flow to the same parameters
+    sum(val.sum() for val in actual.values()).backward()
+    assert model.model[2].models['QT'].weight.grad is not None
+    assert model.model[8].models['SLI'].bias.grad is not None
+
+
+def test_InnerModel_fused_packed_inputs():
+    from uwnet.model import InnerModel
+    from uwnet.tensordict import TensorDict, pack
+
+    z = 5
+    model = InnerModel(*random_pca_pre_post(z), fused=True)
+    batch = TensorDict({'QT': torch.rand(10, z, 4, 3),
+                        'SLI': torch.rand(10, z, 4, 3),
+                        'SOLIN': torch.rand(10, 1, 4, 3)})
+    expected = model(batch)
+    # pack the inputs in and out of the model's order
+    for keys in [model.input_names, ['SOLIN', 'QT', 'SLI']]:
+        actual = model(pack(batch, keys))
+        for key in expected:
+            np.testing.assert_allclose(actual[key].detach().numpy(),
+                                       expected[key].detach().numpy(),
+                                       rtol=1e-5)
+
+
+def test_InnerModel_fused_caches_in_eval_mode():
+    from uwnet.model import InnerModel
+    from uwnet.tensordict import TensorDict
+
+    z = 5
+    model = InnerModel(*random_pca_pre_post(z), fused=True).eval()
+    batch = TensorDict({'QT': torch.rand(10, z, 4, 3),
+                        'SLI': torch.rand(10, z, 4, 3),
+                        'SOLIN': torch.rand(10, 1, 4, 3)})
+    calls = []
+    fused_parameters = model.fused_parameters
+
+    def _fused_parameters():
+        calls.append(1)
+        return fused_parameters()
+
+    model.fused_parameters = _fused_parameters
+    expected = model(batch)
+    model(batch)
+    assert len(calls) == 1
+
+    # updating the parameters in place invalidates the cache
+    other = InnerModel(*random_pca_pre_post(z), fused=True).eval()
+    model.load_state_dict(other.state_dict())
+    actual = model(batch)
+    assert len(calls) == 2
+    for key in expected:
+        np.testing.assert_allclose(actual[key].detach().numpy(),
+                                   other(batch)[key].detach().numpy(),
+                                   rtol=1e-5)
+
+    # training recomputes the weights on every call
+    model.train()
+    model(batch)
+    model(batch)
+    assert len(calls) == 4
+
+
+def test_InnerModel_fused_requires_linear_fixed():
+    from uwnet.model import InnerModel
+    from uwnet.pre_post import LowerAtmosInput, IdentityOutput
+
+    with pytest.raises(ValueError):
+        InnerModel(random_pca_pre_post(34)[0], IdentityOutput(), fused=True)
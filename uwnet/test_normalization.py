@@ -1,6 +1,7 @@
 import numpy as np
 import pytest
 import torch
+import xarray as xr
 from toolz import curry
 from .testing import assert_tensors_allclose, mock_data
 from .normalization import Scaler
@@ -43,3 +44,111 @@ def test_scaler_fit_generator():
 
     expected_mean = a.mean(0).mean(0).squeeze()
     assert_tensors_allclose(scaler.mean[name], expected_mean)
+
+
+def test_scaler_matches_double_precision():
+    x = torch.rand(3, 10) * 100
+    mean = x.mean(0)
+    scale = x.std(0)
+
+    scaler = Scaler({'x': mean}, {'x': scale})
+    y = scaler({'x': x, 'other': x})
+
+    assert y['x'].dtype == torch.float32
+    expected = (x.double() - mean.double()) / (scale.double() + 1e-7)
+    assert_tensors_allclose(y['x'], expected.float(), atol=1e-5)
+    assert y['other'] is x
+
+
+def test_scaler_affine_is_reset_by_fit():
+    scaler = Scaler({'x': torch.zeros(1)}, {'x': torch.ones(1)})
+    scaler.affine()
+    scaler.set_mean_scale({'x': torch.ones(1)}, {'x': torch.ones(1)})
+    weight, bias = scaler.affine()['x']
+    assert bias.item() == approx(-1.0)
+
+
+def test_scaler_affine_is_reset_by_load_state_dict():
+    x = torch.rand(5, 1)
+    scaler = Scaler()
+    scaler.set_mean_scale({'x': torch.zeros(1)}, {'x': torch.ones(1)})
+    scaler({'x': x})
+
+    other = Scaler()
+    other.set_mean_scale({'x': torch.ones(1)}, {'x': torch.ones(1) * 2})
+    scaler.load_state_dict(other.state_dict())
+    assert_tensors_allclose(scaler({'x': x})['x'], other({'x': x})['x'])
+
+
+def test_scaler_fold_into():
+    from .modules import LinearDictIn
+    x = {'a': torch.rand(5, 3) * 10, 'b': torch.rand(5, 1), 'c': torch.rand(5, 2)}
+    mean = {'a': torch.rand(3), 'b': torch.rand(1)}
+    scale = {'a': torch.rand(3) + 1, 'b': torch.rand(1) + 1}
+    scaler = Scaler(mean, scale)
+    linear = LinearDictIn([('a', 3), ('b', 1), ('c', 2)], 4)
+
+    folded = scaler.fold_into(linear)
+    assert_tensors_allclose(folded(x), linear(scaler(x)), atol=1e-5)
+
+
+def test_merge_moments_is_stable():
+    from .normalization import merge_moments, moments, _mean_std
+    # the naive E[x^2] - E[x]^2 formula loses all the digits of the variance
+    x = 1e8 + torch.rand(20, 3, 4, dtype=torch.float64)
+    chunks = [TensorDict({'a': arr}) for arr in x.split(3)]
+    total = moments(chunks[0])
+    for chunk in chunks[1:]:
+        total = merge_moments(total, moments(chunk))
+
+    mean, std = _mean_std(total)
+    flat = x.reshape(-1, 4)
+    assert_tensors_allclose(mean['a'], flat.mean(0))
+    assert_tensors_allclose(std['a'], flat.std(0, unbiased=False))
+
+
+@pytest.mark.parametrize('chunk_size, num_workers, executor', [
+    (None, 1, 'thread'),
+    (1, 1, 'thread'),
+    (3, 2, 'thread'),
+    (3, 2, 'process'),
+])
+def test_scaler_fit_xarray_chunks(chunk_size, num_workers, executor):
+    ds = mock_data(init=np.random.random).to_dataset(name='a')
+    ds['b'] = ds.a.isel(z=0) * 10
+    ds['a'][0, 0, 0] = np.nan
+    scaler = Scaler().fit_xarray(ds, chunk_size=chunk_size,
+                                 num_workers=num_workers, executor=executor)
+
+    for key in ['a', 'b']:
+        expected_mean = ds[key].mean(['x', 'y', 'time']).values
+        expected_std = ds[key].std(['x', 'y', 'time']).values
+        assert_tensors_allclose(scaler.mean[key],
+                                torch.from_numpy(expected_mean))
+        assert_tensors_allclose(scaler.scale[key],
+                                torch.from_numpy(expected_std))
+
+
+def test_moments_from_xarray_process_sends_dataset_once(monkeypatch):
+    from .normalization import moments_from_xarray
+    num_pickles = []
+
+    def _reduce_ex(self, protocol):
+        num_pickles.append(1)
+        return object.__reduce_ex__(self, protocol)
+
+    monkeypatch.setattr(xr.Dataset, '__reduce_ex__', _reduce_ex,
+                        raising=False)
+    ds = mock_data(init=np.random.random).to_dataset(name='a')
+    moments_from_xarray(ds, chunk_size=1, num_workers=2, executor='process')
+    assert len(num_pickles) <= 2
+
+
+def test_scaler_fit_generator_num_workers():
+    a = torch.rand(10, 3, 4, 1, 1)
+    batches = [TensorDict({'a': arr}) for arr in a.split(2, dim=0)]
+    scaler = Scaler().fit_generator(iter(batches), num_workers=3)
+
+    flat = a.double().transpose(0, 2).reshape(4, -1)
+    assert_tensors_allclose(scaler.mean['a'], flat.mean(1))
+    assert_tensors_allclose(scaler.scale['a'], flat.std(1, unbiased=False))
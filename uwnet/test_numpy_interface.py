@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+from torch import nn
+
+from uwnet.numpy_interface import (FlatNumpyWrapper, NumpyBinding,
+                                   NumpyWrapper)
+from uwnet.tensordict import TensorDict
+
+
+class Model(nn.Module):
+    input_names = ['QT', 'SST']
+
+    def forward(self, x):
+        return TensorDict({'QT': x['QT'] * 2 + x['SST'],
+                           'SLI': x['QT'] - 1})
+
+
+def _state():
+    return {
+        'total_water_mixing_ratio': np.random.rand(3, 4, 5),
+        'SST': np.random.rand(4, 5),
+        'irrelevant': np.random.rand(4, 5),
+        'day': 1.0,
+    }
+
+
+def test_NumpyBinding():
+    rename = {'QT': 'total_water_mixing_ratio'}
+    binding = NumpyBinding(Model(), rename=rename, label='nn')
+
+    state = _state()
+    out = binding(state)
+    assert set(out) == {'tendency_of_total_water_mixing_ratio_due_to_nn',
+                        'tendency_of_SLI_due_to_nn'}
+
+    qt = state['total_water_mixing_ratio']
+    np.testing.assert_allclose(
+        out['tendency_of_total_water_mixing_ratio_due_to_nn'],
+        qt * 2 + state['SST'])
+    np.testing.assert_allclose(out['tendency_of_SLI_due_to_nn'], qt - 1)
+
+    # the resolved names are reused with new inputs
+    state = _state()
+    out = binding(state)
+    np.testing.assert_allclose(out['tendency_of_SLI_due_to_nn'],
+                               state['total_water_mixing_ratio'] - 1)
+
+
+def test_NumpyBinding_matches_NumpyWrapper():
+    def model(x):
+        return TensorDict({'a': x['a'] + x['b']})
+
+    state = {'a': np.ones(3), 'b': np.arange(3.0), 'day': 1.0}
+    expected = NumpyWrapper(model, state)
+    out = NumpyBinding(model)(state)
+    np.testing.assert_equal(out, expected)
+
+
+def test_NumpyBinding_shape_change():
+    binding = NumpyBinding(Model())
+    binding({'QT': np.ones((3, 4, 5)), 'SST': np.ones((4, 5))})
+    out = binding({'QT': np.ones((3, 2, 2)), 'SST': np.ones((2, 2))})
+    assert out['QT'].shape == (3, 2, 2)
+    np.testing.assert_equal(out['QT'], 3.0)
+
+
+def test_FlatNumpyWrapper():
+    def model(x):
+        # features are QT (3 levels) and SST
+        return torch.cat([x[:3] * 2 + x[3:], x[3:] - 1])
+
+    rename = {'QT': 'total_water_mixing_ratio'}
+    wrapper = FlatNumpyWrapper(model, [('QT', 3), ('SST', 1)],
+                               [('QT', 3), ('SST', 1)], rename=rename,
+                               label='nn')
+    state = _state()
+    out = wrapper(state)
+    assert set(out) == {'tendency_of_total_water_mixing_ratio_due_to_nn',
+                        'tendency_of_SST_due_to_nn'}
+
+    qt = state['total_water_mixing_ratio']
+    np.testing.assert_allclose(
+        out['tendency_of_total_water_mixing_ratio_due_to_nn'],
+        qt * 2 + state['SST'], rtol=1e-6)
+    # two-dimensional outputs have shape (y, x) like the inputs
+    sst = out['tendency_of_SST_due_to_nn']
+    assert sst.shape == state['SST'].shape
+    np.testing.assert_allclose(sst, state['SST'] - 1, rtol=1e-6)
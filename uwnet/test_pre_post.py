@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+import torch
+import xarray as xr
+
+from uwnet.normalization import merge_moments
+from uwnet.pre_post import get_post, get_pre, streaming_moments, _block_moments
+
+
+def _dataset(num_time=10, num_z=8, num_y=3, num_x=4):
+    rng = np.random.RandomState(0)
+    dims_3d = ['time', 'z', 'y', 'x']
+    dims_2d = ['time', 'y', 'x']
+    shape_3d = (num_time, num_z, num_y, num_x)
+    # correlated heights with distinct variances
+    mixing = rng.randn(num_z, num_z) * np.arange(1, num_z + 1)
+    data_vars = {}
+    for key in ['QT', 'SLI', 'FQT', 'FSLI']:
+        arr = np.einsum('tjyx,ij->tiyx', rng.randn(*shape_3d), mixing)
+        data_vars[key] = (dims_3d, arr)
+    for key in ['SHF', 'LHF', 'SOLIN', 'SST']:
+        data_vars[key] = (dims_2d, rng.rand(num_time, num_y, num_x) * 10)
+    return xr.Dataset(data_vars, coords={'time': np.arange(num_time) * .125})
+
+
+def test_merge_moments():
+    x = np.random.rand(100, 3)
+    blocks = [x[:10], x[10:11], x[11:60], x[60:]]
+    moments = {'x': _block_moments(blocks[0])}
+    for block in blocks[1:]:
+        moments = merge_moments(moments, {'x': _block_moments(block)})
+
+    n, mean, m2 = moments['x']
+    assert n == 100
+    np.testing.assert_allclose(mean, x.mean(axis=0))
+    np.testing.assert_allclose(m2 / (n - 1), np.cov(x.T))
+
+
+def test_block_moments_skips_nans():
+    x = np.random.rand(10, 3)
+    x[4, 1] = np.nan
+    n, mean, _ = _block_moments(x)
+    assert n == 9
+    np.testing.assert_allclose(mean, np.delete(x, 4, axis=0).mean(axis=0))
+
+
+@pytest.mark.parametrize('chunk_size, num_workers', [(1, 1), (3, 1), (4, 3)])
+def test_streaming_moments(chunk_size, num_workers):
+    ds = _dataset()
+    moments = streaming_moments(ds, ['QT', 'SST'], chunk_size=chunk_size,
+                                num_workers=num_workers)
+    expected = _block_moments(
+        ds.QT.stack(s=['x', 'y', 'time']).transpose('s', 'z').values)
+    for actual, desired in zip(moments['QT'], expected):
+        np.testing.assert_allclose(actual, desired)
+    assert len(moments['SST'][1]) == 1
+
+
+def _assert_same_transforms(actual, expected, x):
+    """Compare transforms up to the sign of each principal component"""
+    with torch.no_grad():
+        actual, expected = actual(x).numpy(), expected(x).numpy()
+    signs = np.sign(actual[0] * expected[0])
+    np.testing.assert_allclose(actual, expected * signs, rtol=1e-6,
+                               atol=1e-8)
+
+
+@pytest.mark.parametrize('dask', [False, True])
+def test_get_pre_streaming(dask):
+    ds = _dataset()
+    expected = get_pre(ds, m=4)
+    if dask:
+        ds = ds.chunk({'time': 2})
+    actual = get_pre(ds, m=4, streaming=True, chunk_size=3, num_workers=2)
+
+    assert set(actual.funcs) == set(expected.funcs)
+    for key in expected.funcs:
+        n = expected[key].in_features
+        assert actual[key].weight.shape == expected[key].weight.shape
+        _assert_same_transforms(actual[key], expected[key],
+                                torch.rand(5, n, dtype=torch.float64))
+
+
+def test_get_post_streaming():
+    ds = _dataset()
+    expected = get_post(ds, m=4)
+    actual = get_post(ds, m=4, streaming=True, chunk_size=3)
+
+    for key in expected.funcs:
+        with torch.no_grad():
+            # the inverse transform is linear in the sign of each component
+            signs = np.sign(actual[key].weight[:, 0].numpy() *
+                            expected[key].weight[:, 0].numpy())
+        x = torch.rand(5, 4, dtype=torch.float64)
+        with torch.no_grad():
+            actual_out = actual[key](x * torch.from_numpy(signs)).numpy()
+            expected_out = expected[key](x).numpy()
+        np.testing.assert_allclose(actual_out, expected_out, rtol=1e-6,
+                                   atol=1e-8)
+
+
+def test_get_pre_post_cache(tmpdir, monkeypatch):
+    import uwnet.pre_post
+    from uwnet.pre_post import get_pre_post
+
+    ds = _dataset(num_z=24)
+    config = {'kind': 'pca', 'cache_dir': str(tmpdir.join('cache'))}
+    pre, post = get_pre_post(ds, None, config)
+    assert len(tmpdir.join('cache').listdir()) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The pre/post modules were fit again")
+
+    monkeypatch.setattr(uwnet.pre_post, 'get_pre', fail)
+    cached_pre, _ = get_pre_post(ds, None, config)
+    assert torch.equal(cached_pre['QT'].weight, pre['QT'].weight)
+
+    # another configuration is fit and cached separately
+    monkeypatch.undo()
+    get_pre_post(ds, None, dict(config, streaming=True))
+    assert len(tmpdir.join('cache').listdir()) == 2
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import zarr
+
+from .rechunk import (get_block_shape, get_blocks, parse_chunks,
+                      rechunk_group, PROGRESS_FILE)
+
+
+def _init_group(path):
+    group = zarr.open_group(path, mode='w')
+    group.attrs['title'] = 'test'
+    a = group.create('a', shape=(6, 4, 5), chunks=(6, 1, 1), dtype='f4')
+    a[:] = np.random.rand(6, 4, 5)
+    a.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'xs']
+    b = group.create('b', shape=(6, ), chunks=(6, ), dtype='f8')
+    b[:] = np.arange(6)
+    b.attrs['_ARRAY_DIMENSIONS'] = ['time']
+    return group
+
+
+def test_parse_chunks():
+    assert parse_chunks(['x=1', 'time=640']) == {'x': 1, 'time': 640}
+
+
+@pytest.mark.parametrize('shape, chunks, budget, expected', [
+    ((10, 10), (2, 2), 4 * 4, (2, 2)),
+    ((10, 10), (2, 2), 4 * 8, (2, 4)),
+    ((10, 10), (2, 2), 4 * 40, (4, 10)),
+    ((10, 10), (2, 2), 1, (2, 2)),
+])
+def test_get_block_shape(shape, chunks, budget, expected):
+    assert get_block_shape(shape, chunks, 4, budget) == expected
+
+
+def test_get_blocks_cover_array():
+    blocks = get_blocks((5, 3), (2, 3))
+    assert blocks == [(slice(0, 2), slice(0, 3)), (slice(2, 4), slice(0, 3)),
+                      (slice(4, 5), slice(0, 3))]
+
+
+def test_rechunk_group(tmpdir):
+    src_path, dest_path = str(tmpdir.join('src')), str(tmpdir.join('dest'))
+    src = _init_group(src_path)
+    chunks = {'time': 2, 'y': 4, 'x': 5}
+
+    rechunk_group(src_path, dest_path, chunks, memory_budget=64,
+                  processes=2, rename=True)
+
+    dest = zarr.open_group(dest_path, mode='r')
+    assert dest.attrs['title'] == 'test'
+    assert dest['a'].chunks == (2, 4, 5)
+    assert dest['a'].attrs['_ARRAY_DIMENSIONS'] == ['time', 'y', 'x']
+    assert dest['b'].chunks == (2, )
+    np.testing.assert_array_equal(dest['a'][:], src['a'][:])
+    np.testing.assert_array_equal(dest['b'][:], src['b'][:])
+
+
+def test_rechunk_group_resumes(tmpdir):
+    src_path, dest_path = str(tmpdir.join('src')), str(tmpdir.join('dest'))
+    src = _init_group(src_path)
+    chunks = {'time': 3}
+
+    rechunk_group(src_path, dest_path, chunks, memory_budget=1, processes=1)
+
+    # pretend the run was interrupted before copying the last block of 'b', and
+    # modify a completed block to check it is not copied again
+    dest = zarr.open_group(dest_path, mode='r+')
+    dest['b'][:] = -1
+    progress = tmpdir.join('dest', PROGRESS_FILE)
+    lines = [line for line in progress.readlines() if line != 'b 3:6\n']
+    progress.write(''.join(lines))
+
+    rechunk_group(src_path, dest_path, chunks, memory_budget=1, processes=1)
+    np.testing.assert_array_equal(dest['b'][:], [-1, -1, -1, 3, 4, 5])
+
+
+def test_rechunk_group_resumes_with_different_budget(tmpdir):
+    src_path, dest_path = str(tmpdir.join('src')), str(tmpdir.join('dest'))
+    src = _init_group(src_path)
+    chunks = {'time': 3}
+
+    rechunk_group(src_path, dest_path, chunks, memory_budget=1, processes=1)
+
+    # interrupted before copying the last block of 'b'
+    dest = zarr.open_group(dest_path, mode='r+')
+    dest['b'][3:] = -1
+    progress = tmpdir.join('dest', PROGRESS_FILE)
+    lines = [line for line in progress.readlines() if line != 'b 3:6\n']
+    progress.write(''.join(lines))
+
+    # the larger budget copies 'b' in one block, which was never completed
+    rechunk_group(src_path, dest_path, chunks, memory_budget=2**20,
+                  processes=1)
+    np.testing.assert_array_equal(dest['b'][:], src['b'][:])
@@ -1,4 +1,5 @@
-from .tensordict import TensorDict, stack, lag_tensor
+from .tensordict import (PackedTensorDict, TensorDict, pack, stack,
+                         lag_tensor)
 from .testing import assert_tensors_allclose
 import torch
 import pytest
@@ -99,16 +100,31 @@ def test_tensordict_split():
         assert split['a'].shape == (1, 1)
 
 
+def _is_method(obj, attr):
+    try:
+        return callable(getattr(obj, attr))
+    except (AttributeError, RuntimeError):
+        return False
+
+
 tensor = _get_tensordict_example()['a']
-@pytest.mark.parametrize('attr', dir(tensor))
+@pytest.mark.parametrize('attr', [attr for attr in dir(tensor)
+                                  if _is_method(tensor, attr)])
 def test_tensordict_dispatch(attr):
-    if attr in ['imag', 'real']:
-        pytest.xfail()
     t = _get_tensordict_example()
     a = t['a']
     getattr(t, attr)
 
 
+@pytest.mark.parametrize('attr', ['shape', 'dtype', 'attrs'])
+def test_tensordict_non_callable_attribute(attr):
+    # xarray probes attributes like attrs of the operands of arithmetic
+    t = _get_tensordict_example()
+    with pytest.raises(AttributeError):
+        getattr(t, attr)
+    assert not hasattr(t, attr)
+
+
 def test_stack():
     t = _get_tensordict_example()
     n_stack = 2
@@ -126,3 +142,207 @@ def test_lag_tensor():
 
     b = lag_tensor(a, -1, 0)
     assert_tensors_allclose(a[:-1], b)
+
+
+def test_tensordict_has_no_instance_dict():
+    a = _get_tensordict_example()
+    with pytest.raises(AttributeError):
+        a.some_attribute = 1
+
+
+def test_tensordict_reflected_operators():
+    a = TensorDict({'a': torch.tensor(2.0)})
+    assert (1 - a)['a'].item() == -1.0
+    assert (1 / a)['a'].item() == 0.5
+    assert (3 + a)['a'].item() == 5.0
+
+
+def test_tensordict_missing_attribute():
+    a = _get_tensordict_example()
+    with pytest.raises(AttributeError):
+        a.not_an_attribute
+    assert not hasattr(a, 'not_an_attribute')
+
+
+def test_tensordict_pickle():
+    import pickle
+    a = _get_tensordict_from_shapes([3], [4])
+    b = pickle.loads(pickle.dumps(a))
+    assert isinstance(b, TensorDict)
+    assert b.keys() == a.keys()
+    assert_tensors_allclose(b['c'], a['c'])
+
+
+@pytest.mark.parametrize('grad', [False, True])
+def test_tensordict_use_foreach(grad, monkeypatch):
+    a = TensorDict({'a': torch.rand(3, requires_grad=grad),
+                    'b': torch.rand(2, 2)})
+    b = TensorDict({'a': torch.rand(3), 'b': torch.rand(2, 2)})
+    # broadcasting is not supported by the foreach functions
+    c = TensorDict({'a': torch.rand(1), 'b': torch.rand(2, 2)})
+
+    expected = [a + b, a - b, a * b, a / b, a * 2.0, a + c]
+    monkeypatch.setattr(TensorDict, 'use_foreach', True)
+    actual = [a + b, a - b, a * b, a / b, a * 2.0, a + c]
+
+    for x, y in zip(expected, actual):
+        for key in x:
+            assert_tensors_allclose(x[key], y[key])
+    assert actual[0]['a'].requires_grad == grad
+
+
+def _inplace_examples():
+    a = TensorDict({'a': torch.rand(3), 'b': torch.rand(2, 2)})
+    b = TensorDict({'a': torch.rand(3), 'b': torch.rand(2, 2)})
+    return a, b
+
+
+@pytest.mark.parametrize('op, expected', [
+    (lambda a, b: a.add_(b), lambda a, b: a + b),
+    (lambda a, b: a.add_(b, alpha=2.0), lambda a, b: a + b * 2.0),
+    (lambda a, b: a.add_(3.0), lambda a, b: a + 3.0),
+    (lambda a, b: a.mul_(b), lambda a, b: a * b),
+    (lambda a, b: a.mul_(0.5), lambda a, b: a * 0.5),
+    (lambda a, b: a.add_scaled_(b, 0.1), lambda a, b: a + b * 0.1),
+])
+def test_tensordict_inplace(op, expected):
+    a, b = _inplace_examples()
+    expected = expected(a, b)
+    tensors = dict(a)
+    out = op(a, b)
+    assert out is a
+    for key in a:
+        assert a[key] is tensors[key]
+        assert_tensors_allclose(a[key], expected[key])
+
+
+def test_tensordict_inplace_operators():
+    a, b = _inplace_examples()
+    expected = (a + b) * 2.0 - b
+    c = a
+    c += b
+    c *= 2.0
+    c -= b
+    assert c is a
+    for key in a:
+        assert_tensors_allclose(a[key], expected[key])
+
+
+def test_tensordict_add_scaled():
+    a, b = _inplace_examples()
+    a['a'].requires_grad = True
+    out = a.add_scaled(b, 0.1)
+    expected = a + b * 0.1
+    for key in a:
+        assert_tensors_allclose(out[key], expected[key])
+    out['a'].sum().backward()
+    assert_tensors_allclose(a['a'].grad, torch.ones(3))
+
+
+def _packed_example():
+    return TensorDict({'QT': torch.rand(2, 3, 4, 5),
+                       'SOLIN': torch.rand(2, 1, 4, 5),
+                       'SLI': torch.rand(2, 3, 4, 5)})
+
+
+def test_pack():
+    a = _packed_example()
+    packed = pack(a)
+    assert isinstance(packed, PackedTensorDict)
+    assert packed.buffer.shape == (2, 7, 4, 5)
+    assert packed.index == {'QT': (0, 3), 'SOLIN': (3, 1), 'SLI': (4, 3)}
+    assert list(packed) == list(a)
+    for key in a:
+        assert torch.equal(packed[key], a[key])
+
+    # the values are views of the buffer
+    packed.buffer.zero_()
+    assert packed['SLI'].sum().item() == 0.0
+
+    unpacked = packed.unpack()
+    assert type(unpacked) is TensorDict
+    unpacked['QT'] = torch.ones(1)
+    with pytest.raises(TypeError):
+        packed['QT'] = torch.ones(1)
+
+
+@pytest.mark.parametrize('op', [
+    lambda a, b: a + b,
+    lambda a, b: a * 2.0,
+    lambda a, b: 1.0 - a,
+    lambda a, b: a.add_scaled(b, 0.1),
+    lambda a, b: a.float(),
+])
+def test_packed_tensordict_operations(op):
+    a, b = _packed_example(), _packed_example()
+    expected = op(a, b)
+    actual = op(pack(a), pack(b))
+    assert isinstance(actual, PackedTensorDict)
+    for key in expected:
+        assert_tensors_allclose(actual[key], expected[key])
+
+
+def test_packed_tensordict_mixed_with_tensordict():
+    a, b = _packed_example(), _packed_example()
+    actual = pack(a) + b
+    assert type(actual) is TensorDict
+    for key in a:
+        assert_tensors_allclose(actual[key], a[key] + b[key])
+
+
+def test_packed_tensordict_inplace():
+    a, b = _packed_example(), _packed_example()
+    expected = a + b * 0.1
+    packed = pack(a)
+    buffer = packed.buffer
+    packed.add_scaled_(pack(b), 0.1)
+    assert packed.buffer is buffer
+    for key in a:
+        assert_tensors_allclose(packed[key], expected[key])
+
+
+@pytest.mark.parametrize('dim', [0, 1, 2, 3, -1, -4])
+def test_packed_tensordict_stack(dim):
+    seq = [_packed_example() for _ in range(3)]
+    expected = stack(seq, dim=dim)
+    actual = stack([pack(item) for item in seq], dim=dim)
+    assert isinstance(actual, PackedTensorDict)
+    for key in expected:
+        assert_tensors_allclose(actual[key], expected[key])
+
+
+def test_packed_tensordict_split():
+    a = _packed_example()
+    packed = pack(a)
+    actual = packed.split(1, dim=0)
+    expected = a.split(1, dim=0)
+    assert len(actual) == 2
+    for x, y in zip(actual, expected):
+        assert isinstance(x, PackedTensorDict)
+        for key in y:
+            assert_tensors_allclose(x[key], y[key])
+    assert packed.size(-1) == 5
+    with pytest.raises(ValueError):
+        packed.size(1)
+
+
+def test_packed_tensordict_cat():
+    packed = pack(_packed_example())
+    # adjacent keys are a view of the buffer
+    out = packed.cat(['SOLIN', 'SLI'])
+    assert out.data_ptr() == packed['SOLIN'].data_ptr()
+    assert_tensors_allclose(
+        out, torch.cat([packed['SOLIN'], packed['SLI']], dim=-3))
+
+    out = packed.cat(['SLI', 'QT'])
+    assert_tensors_allclose(
+        out, torch.cat([packed['SLI'], packed['QT']], dim=-3))
+
+
+def test_packed_tensordict_pickle():
+    import pickle
+    packed = pack(_packed_example())
+    loaded = pickle.loads(pickle.dumps(packed))
+    assert loaded.index == packed.index
+    for key in packed:
+        assert torch.equal(loaded[key], packed[key])
@@ -1,6 +1,7 @@
 from .tensordict import TensorDict
 from .timestepper import Batch, TimeStepper
 from .testing import assert_tensors_allclose
+import pytest
 import torch
 
 
@@ -41,3 +42,117 @@ def test_TimeStepper():
 
     assert output[name].shape == (1, n)
     assert_tensors_allclose(output['a'][:, :-1], array[:, 1:])
+
+
+def _linear_problem(n_batch=3, n=10, z=4):
+    import torch.nn as nn
+
+    data = Batch(TensorDict({'a': torch.rand(n_batch, n, z),
+                             'Fa': torch.rand(n_batch, n, z),
+                             'b': torch.rand(n_batch, n, 1)}).double(),
+                 prognostics=['a'])
+    model = nn.Linear(z, z).double()
+
+    def source(x):
+        return TensorDict({'a': model(x['a']) + x['b']})
+
+    return data, model, source
+
+
+@pytest.mark.parametrize('preallocate, checkpoint', [
+    (True, False), (False, True), (True, True)])
+def test_TimeStepper_options_match(preallocate, checkpoint):
+    data, model, source = _linear_problem()
+
+    expected = TimeStepper(source, time_step=100)(data)
+    expected['a'].sum().backward()
+    expected_grad = model.weight.grad.clone()
+    model.zero_grad()
+
+    stepper = TimeStepper(source, time_step=100, preallocate=preallocate,
+                          checkpoint=checkpoint)
+    output = stepper(data)
+    assert_tensors_allclose(output['a'], expected['a'])
+
+    output['a'].sum().backward()
+    assert_tensors_allclose(model.weight.grad, expected_grad)
+
+
+def test_TimeStepper_preallocate_no_grad_inplace():
+    data, model, source = _linear_problem()
+    initial = data.data['a'].clone()
+
+    with torch.no_grad():
+        expected = TimeStepper(source, time_step=100)(data)
+        output = TimeStepper(source, time_step=100, preallocate=True)(data)
+
+    assert_tensors_allclose(output['a'], expected['a'])
+    # the batch is not modified by the in place updates
+    assert_tensors_allclose(data.data['a'], initial)
+
+
+def _relaxation_batch(rate, n_time=41, z=3):
+    """Batch and source function for dx/dt = -rate * x (rate in 1/day)"""
+    data = Batch(TensorDict({'a': torch.ones(2, n_time, z, 1, 1).double(),
+                             'Fa': torch.zeros(2, n_time, z, 1, 1).double()}),
+                 prognostics=['a'])
+
+    def source(x):
+        return TensorDict({'a': -rate * x['a']})
+
+    return data, source
+
+
+def _relaxation_error(integrator, time_step, rate=1.0, substeps=1):
+    """Error after 2 days"""
+    import math
+    data, source = _relaxation_batch(rate)
+    stepper = TimeStepper(source, time_step=time_step * 86400,
+                          integrator=integrator, substeps=substeps)
+    output = stepper(data, prediction_length=round(2 / time_step))
+    exact = math.exp(-rate * 2)
+    return (output['a'][:, -1] - exact).abs().max().item()
+
+
+@pytest.mark.parametrize('integrator, order', [
+    ('euler', 1), ('rk2', 2), ('rk4', 4), ('semi_implicit', 1)])
+def test_integrator_order(integrator, order):
+    import math
+    coarse = _relaxation_error(integrator, 0.1)
+    fine = _relaxation_error(integrator, 0.05)
+    assert math.log2(coarse / fine) == pytest.approx(order, abs=0.3)
+
+
+def test_substeps_reduce_error():
+    assert (_relaxation_error('euler', 0.1, substeps=4) <
+            _relaxation_error('euler', 0.1) / 3)
+
+
+def test_semi_implicit_stable_for_stiff_problem():
+    # forward Euler is unstable for rate * time_step > 2
+    assert _relaxation_error('euler', 1.0, rate=5.0) > 1
+    assert _relaxation_error('semi_implicit', 1.0, rate=5.0) < 0.1
+
+
+def test_column_jacobian():
+    from .timestepper import column_jacobian
+
+    z = 3
+    a = torch.rand(z, z).double()
+    state = TensorDict({'a': torch.rand(4, z, 2, 1).double(),
+                        'b': torch.rand(4, 1, 2, 1).double()})
+
+    def tendency(state):
+        f = TensorDict({
+            'a': torch.einsum('ij,bjyx->biyx', a, state['a']) + state['b'],
+            'b': state['b'] * 2,
+        })
+        return f, f
+
+    jac = column_jacobian(tendency, state, dim=-3)
+    assert jac.shape == (4, 2, 1, z + 1, z + 1)
+    expected = torch.zeros(z + 1, z + 1).double()
+    expected[:z, :z] = a
+    expected[:z, z] = 1
+    expected[z, z] = 2
+    assert_tensors_allclose(jac[0, 0, 0], expected)
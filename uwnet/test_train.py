@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import torch
+import xarray as xr
+from torch import nn
+
+from uwnet.ml_models.nn.datasets_handler import get_data_loader
+from uwnet.ml_models.nn.validation import (CheckpointValidator, validate,
+                                           validate_checkpoint)
+from uwnet.tensordict import TensorDict
+
+
+def _batches(num_batches, shape=(3, 4, 5, 1, 1)):
+    return [TensorDict({key: torch.rand(shape)
+                        for key in ['QT', 'SLI', 'FQT', 'FSLI']})
+            for _ in range(num_batches)]
+
+
+def _zero_model(x):
+    return TensorDict({key: torch.zeros_like(x[key]) for key in ['QT', 'SLI']})
+
+
+class ZeroModel(nn.Module):
+    def forward(self, x):
+        return _zero_model(x)
+
+
+def test_validate():
+    batches = _batches(2)
+    mass = torch.rand(5)
+    dt = 0.125
+    metrics = validate(_zero_model, batches, mass, dt, ['QT', 'SLI'])
+
+    # the apparent source is zero, so the error is the residual
+    for key in ['QT', 'SLI']:
+        total, count = 0.0, 0
+        for batch in batches:
+            x, f = batch[key], batch['F' + key]
+            residual = (x[:, 1:] - x[:, :-1]) / dt - 86400 * (
+                f[:, 1:] + f[:, :-1]) / 2
+            weights = (mass / mass.sum()).view(-1, 1, 1)
+            total += (residual ** 2 * weights).sum().item()
+            count += residual.shape[0] * residual.shape[1]
+        assert metrics[key] == pytest.approx(total / count, rel=1e-5)
+
+
+def test_CheckpointValidator():
+    results = {}
+
+    def callback(epoch, metrics):
+        results[epoch] = metrics
+
+    validator = CheckpointValidator(len, callback)
+    validator.submit('a', 1)
+    validator.submit('bb', 2)
+    validator.submit('ccc', 3)
+    validator.close()
+
+    # the first and last checkpoints are always validated
+    assert results[1] == 1
+    assert results[3] == 3
+
+
+def test_CheckpointValidator_reraises():
+    validator = CheckpointValidator(int, lambda epoch, metrics: None)
+    validator.submit('not a number', 1)
+    with pytest.raises(ValueError):
+        validator.close()
+
+
+def test_validate_checkpoint(tmpdir):
+    dims = ['sample', 'time', 'z']
+    data_vars = {key: (dims, np.random.rand(6, 3, 5))
+                 for key in ['QT', 'SLI', 'FQT', 'FSLI', 'QRAD']}
+    data_vars.update({key: (['sample', 'time'], np.random.rand(6, 3))
+                      for key in ['SST', 'SOLIN']})
+    ds = xr.Dataset(data_vars)
+    data = str(tmpdir.join('data.zarr'))
+    ds.to_zarr(data)
+
+    model = ZeroModel()
+    path = str(tmpdir.join('model.pkl'))
+    torch.save(model, path)
+
+    mass, dt, prognostics = torch.rand(5), 0.125, ['QT', 'SLI']
+    metrics = validate_checkpoint(path, data, True, prognostics, 4, mass, dt)
+    expected = validate(model, get_data_loader(ds, prognostics, 4), mass, dt,
+                        prognostics)
+    assert metrics == pytest.approx(expected)
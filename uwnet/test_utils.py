@@ -1,6 +1,11 @@
+import threading
+import time
+
 import numpy as np
+import pytest
 import torch
-from uwnet.utils import stack_dicts, dataarray_to_broadcastable_array
+from uwnet.utils import (stack_dicts, dataarray_to_broadcastable_array,
+                         BackgroundWorker, map_ordered)
 import xarray as xr
 
 
@@ -30,3 +35,112 @@ def test_dataarray_to_broadcastable_array():
     expected = (1, a, b)
     nparr = dataarray_to_broadcastable_array(arr, desired_dims)
     assert nparr.shape == expected
+
+
+@pytest.mark.parametrize('background', [True, False])
+def test_BackgroundWorker(background):
+    calls = []
+    worker = BackgroundWorker(maxsize=1, background=background)
+    for i in range(5):
+        worker.submit(calls.append, i)
+    worker.flush()
+    assert calls == list(range(5))
+    worker.close()
+
+
+def test_BackgroundWorker_is_bounded():
+    release = threading.Event()
+    worker = BackgroundWorker(maxsize=1)
+    worker.submit(release.wait)
+    worker.submit(lambda: None)
+
+    # the queue is full until the first call finishes
+    blocked = threading.Thread(target=worker.submit, args=(lambda: None, ))
+    blocked.start()
+    blocked.join(timeout=0.1)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    worker.close()
+
+
+def test_BackgroundWorker_reraises():
+    def fail():
+        raise RuntimeError("failed")
+
+    worker = BackgroundWorker()
+    worker.submit(fail)
+    with pytest.raises(RuntimeError):
+        worker.flush()
+
+    # the worker keeps running after the error is raised
+    calls = []
+    worker.submit(calls.append, 1)
+    worker.close()
+    assert calls == [1]
+
+
+def test_dataset_fingerprint():
+    from uwnet.utils import dataset_fingerprint
+
+    ds = xr.Dataset({'QT': (['time', 'x'], np.random.rand(3, 4)),
+                     'SST': (['x'], np.random.rand(4))},
+                    coords={'time': np.arange(3)})
+    assert dataset_fingerprint(ds) == dataset_fingerprint(ds.copy(deep=True))
+    assert dataset_fingerprint(ds) == dataset_fingerprint(ds.chunk())
+
+    changed = ds.copy(deep=True)
+    changed['QT'][0, 0] += 1
+    assert dataset_fingerprint(ds) != dataset_fingerprint(changed)
+    assert dataset_fingerprint(ds) != dataset_fingerprint(ds.isel(x=[0]))
+    assert dataset_fingerprint(ds) != dataset_fingerprint(
+        ds.assign_attrs(description='other'))
+
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_map_ordered(num_workers):
+    def fun(x):
+        time.sleep(0.01 * (x % 3))
+        return x * 2
+
+    out = list(map_ordered(fun, range(10), num_workers))
+    assert out == [2 * x for x in range(10)]
+
+
+def test_map_ordered_is_bounded():
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    def fun(x):
+        calls.append(x)
+        return x
+
+    with ThreadPoolExecutor(2) as executor:
+        results = map_ordered(fun, range(100), executor=executor, depth=3)
+        assert next(results) == 0
+        executor.shutdown(wait=True)
+        # the first result, and the next three calls
+        assert len(calls) <= 4
+
+
+def test_atomic_save(tmpdir):
+    from uwnet.utils import atomic_save
+    path = str(tmpdir.join('a.txt'))
+
+    def save(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write('a')
+
+    atomic_save(save, path)
+    assert tmpdir.join('a.txt').read() == 'a'
+
+    def fail(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write('partial')
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        atomic_save(fail, path)
+    assert tmpdir.join('a.txt').read() == 'a'
+    assert tmpdir.listdir() == [tmpdir.join('a.txt')]
@@ -60,3 +60,69 @@ def test__torch_dict_to_dataset():
     da = init_dataarray(shape).to_dataset(name=name)
     torch_dict = {name: torch.tensor(da[name].values)}
     _torch_dict_to_dataset(torch_dict, da.coords)
+
+
+def _model(d):
+    return {'a': d['a'] * 2, 'b': d['a'].sum(-3, keepdim=True)}
+
+
+@pytest.mark.parametrize('chunks, num_workers', [
+    ({'time': 2}, 1),
+    ({'time': 3, 'x': 2, 'y': 1}, 1),
+    ({'time': 1, 'x': 3}, 3),
+    ({'x': (1, 3)}, 1),
+])
+def test_call_with_xr_chunked(chunks, num_workers):
+    shape = (5, 3, 2, 4)
+    ds = init_dataarray(shape).to_dataset(name='a')
+    ds['a'][:] = np.random.rand(*shape)
+
+    expected = call_with_xr(_model, ds)
+    out = call_with_xr(_model, ds, chunks=chunks, num_workers=num_workers)
+    xr.testing.assert_allclose(out, expected)
+
+
+def test_call_with_xr_chunked_dask():
+    shape = (5, 3, 2, 4)
+    ds = init_dataarray(shape).to_dataset(name='a')
+    ds['a'][:] = np.random.rand(*shape)
+
+    expected = call_with_xr(_model, ds)
+    out = call_with_xr(_model, ds.chunk({'time': 2, 'x': 3}), chunks='auto')
+    xr.testing.assert_allclose(out, expected)
+
+
+def test_call_with_xr_chunked_shape_mismatch_fails():
+    shape = (5, 3, 2, 4)
+    ds = init_dataarray(shape).to_dataset(name='a')
+
+    def model(d):
+        return {'a': d['a'][1:]}
+
+    with pytest.raises(ValueError):
+        call_with_xr(model, ds, chunks={'time': 2})
+
+
+def test_call_with_xr_lazy():
+    from .xarray_interface import call_with_xr_lazy
+
+    shape = (5, 3, 2, 4)
+    ds = init_dataarray(shape).to_dataset(name='a')
+    ds['a'][:] = np.random.rand(*shape)
+
+    expected = call_with_xr(_model, ds)
+    out = call_with_xr_lazy(_model, ds.chunk({'time': 2, 'x': 3}))
+
+    assert out.a.chunks == ((2, 2, 1), (3, ), (2, ), (3, 1))
+    assert out.b.dims == ('time', 'y', 'x')
+    xr.testing.assert_allclose(out.compute(), expected)
+    xr.testing.assert_allclose(out.a.sum('z').compute(),
+                               expected.a.sum('z'))
+
+
+def test_call_with_xr_lazy_requires_dask():
+    from .xarray_interface import call_with_xr_lazy
+
+    ds = init_dataarray((5, 3, 2, 4)).to_dataset(name='a')
+    with pytest.raises(ValueError):
+        call_with_xr_lazy(_model, ds)
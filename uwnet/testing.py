@@ -1,6 +1,9 @@
 import numpy as np
+import torch
 import xarray as xr
 
+from uwnet.modules import LinearFixed, MapByKey
+
 
 def assert_tensors_allclose(*args, atol=1e-7, **kwargs):
     args = [arg.detach().numpy() for arg in args]
@@ -10,3 +13,17 @@ def assert_tensors_allclose(*args, atol=1e-7, **kwargs):
 def mock_data(shape=(4, 5, 6, 7), init=np.zeros):
     dims = ['time', 'y', 'x', 'z']
     return xr.DataArray(init(shape), dims=dims)
+
+
+def random_pca_pre_post(num_z, num_pca=4, num_post_pca=3, scalars=('SOLIN', )):
+    """Random PCA-like pre and post processors of QT and SLI
+
+    The pre processor also maps each of ``scalars`` by a 1x1 layer.
+    """
+    def linear_fixed(n, m):
+        return LinearFixed(torch.rand(n, m), torch.rand(1, m))
+
+    pre = {key: linear_fixed(num_z, num_pca) for key in ['QT', 'SLI']}
+    pre.update({key: linear_fixed(1, 1) for key in scalars})
+    post = {key: linear_fixed(num_post_pca, num_z) for key in ['QT', 'SLI']}
+    return MapByKey(pre), MapByKey(post)
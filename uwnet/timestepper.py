@@ -1,9 +1,19 @@
 """Time steppers"""
+import inspect
+from functools import partial
+
 import attr
+import torch
+from torch.utils.checkpoint import checkpoint as checkpoint_function
 from toolz import merge, first
 from . import tensordict
 from .tensordict import TensorDict
 
+# torch >= 1.11 can checkpoint without the reentrant implementation, which
+# future versions remove
+_NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(
+    checkpoint_function).parameters
+
 
 @attr.s
 class Batch(object):
@@ -72,34 +82,310 @@ class Batch(object):
         return tensordict.lag(self.data[self.prognostics], lag, self.time_dim)
 
 
+def _add_scaled(x, y, alpha):
+    """``x + y * alpha`` with fused TensorDict operations if possible"""
+    if isinstance(x, TensorDict) and isinstance(y, TensorDict):
+        return x.add_scaled(y, alpha)
+    return x + y * alpha
+
+
+def _tendency(apparent_sources, known_forcing):
+    """Total tendency per second from the apparent sources per day"""
+    if (isinstance(apparent_sources, TensorDict)
+            and isinstance(known_forcing, TensorDict)):
+        return known_forcing.add_scaled(apparent_sources, 1 / 86400)
+    return apparent_sources/86400 + known_forcing
+
+
+def euler(tendency, state, time_step):
+    """Forward Euler step
+
+    Parameters
+    ----------
+    tendency
+        function of the state returning the tendency and the apparent sources
+    state : TensorDict
+    time_step : float
+
+    Returns
+    -------
+    state : TensorDict
+        the state after the step
+    sources : TensorDict
+        the apparent sources at the initial state
+    """
+    f, sources = tendency(state)
+    return _add_scaled(state, f, time_step), sources
+
+
+def rk2(tendency, state, time_step):
+    """Second order Runge-Kutta (midpoint) step"""
+    k1, sources = tendency(state)
+    k2, _ = tendency(_add_scaled(state, k1, time_step / 2))
+    return _add_scaled(state, k2, time_step), sources
+
+
+def rk4(tendency, state, time_step):
+    """Classical fourth order Runge-Kutta step"""
+    k1, sources = tendency(state)
+    k2, _ = tendency(_add_scaled(state, k1, time_step / 2))
+    k3, _ = tendency(_add_scaled(state, k2, time_step / 2))
+    k4, _ = tendency(_add_scaled(state, k3, time_step))
+    increment = _add_scaled(k1 + k4, k2 + k3, 2)
+    return _add_scaled(state, increment, time_step / 6), sources
+
+
+def _pack_columns(state, keys, dim):
+    return torch.cat([state[key].movedim(dim, -1) for key in keys], dim=-1)
+
+
+def _unpack_columns(packed, state, keys, dim):
+    sizes = [state[key].size(dim) for key in keys]
+    return TensorDict({
+        key: val.movedim(-1, dim)
+        for key, val in zip(keys, packed.split(sizes, dim=-1))
+    })
+
+
+def column_jacobian(tendency, state, dim=-3):
+    """Jacobian of the tendency with respect to the state of each column
+
+    The variables are concatenated along ``dim``, and the columns are assumed
+    to be independent.
+
+    Returns
+    -------
+    jacobian : torch.tensor
+        jacobian[..., i, j] is the derivative of the ith tendency with respect
+        to the jth state in a column. The leading dimensions are the
+        dimensions of the state other than ``dim``.
+    """
+    keys = list(state)
+    with torch.enable_grad():
+        x = _pack_columns(state, keys, dim).detach().requires_grad_()
+        f, _ = tendency(_unpack_columns(x, state, keys, dim))
+        f = _pack_columns(f, keys, dim)
+        rows = [
+            torch.autograd.grad(f[..., i].sum(), x, retain_graph=True,
+                                allow_unused=True)[0]
+            for i in range(f.size(-1))
+        ]
+    rows = [torch.zeros_like(x) if row is None else row for row in rows]
+    return torch.stack(rows, dim=-2)
+
+
+def semi_implicit(tendency, state, time_step, dim=-3):
+    """Linearly implicit Euler step with the Jacobian of the tendency
+
+    Solves ``(I - dt J) dx = dt f(x)`` in each column, where ``J`` is the
+    Jacobian of the tendency ``f``. The Jacobian is not differentiated.
+    """
+    keys = list(state)
+    f, sources = tendency(state)
+    jac = column_jacobian(tendency, state, dim)
+    eye = torch.eye(jac.size(-1), dtype=jac.dtype, device=jac.device)
+    rhs = _pack_columns(f, keys, dim).unsqueeze(-1) * time_step
+    increment = torch.linalg.solve(eye - jac * time_step, rhs).squeeze(-1)
+    return state + _unpack_columns(increment, state, keys, dim), sources
+
+
+INTEGRATORS = {
+    'euler': euler,
+    'rk2': rk2,
+    'rk4': rk4,
+    'semi_implicit': semi_implicit,
+}
+
+
+def substep(integrator, substeps):
+    """Integrator which takes ``substeps`` steps of ``integrator``"""
+    def step(tendency, state, time_step):
+        sources = None
+        for i in range(substeps):
+            state, sub_sources = integrator(tendency, state,
+                                            time_step / substeps)
+            if sources is None:
+                sources = sub_sources
+        return state, sources
+
+    return step
+
+
+def get_integrator(name='euler', substeps=1, column_dim=-3):
+    """Get a time integrator by name
+
+    Parameters
+    ----------
+    name : str
+        one of 'euler', 'rk2', 'rk4', or 'semi_implicit'
+    substeps : int
+        number of steps per time step
+    column_dim : int
+        the vertical dimension of the state. Used by 'semi_implicit'.
+    """
+    try:
+        integrator = INTEGRATORS[name]
+    except KeyError:
+        raise NotImplementedError(
+            f"Integrator '{name}' is not implemented")
+    if name == 'semi_implicit':
+        integrator = partial(integrator, dim=column_dim)
+    if substeps > 1:
+        integrator = substep(integrator, substeps)
+    return integrator
+
+
 class TimeStepper:
+    """Predict a trajectory with an integrator (forward Euler by default)
+
+    Parameters
+    ----------
+    source_function
+        function of the inputs at a time returning the apparent sources
+    time_step : float
+        time step in seconds
+    integrator : str
+        name of the integrator. See :func:`get_integrator`.
+    substeps : int
+        number of integrator steps per time step
+    column_dim : int
+        the vertical dimension of the state
+    preallocate : bool
+        write the states into a preallocated TensorDict instead of stacking a
+        list of states. When autograd is disabled, the state is also updated
+        in place.
+    checkpoint : bool
+        recompute the source function of each step during the backward pass
+        instead of storing its intermediate values. This trades computation
+        for memory which grows more slowly with the number of steps.
+    """
 
-    def __init__(self, source_function, time_step):
+    def __init__(self, source_function, time_step, integrator='euler',
+                 substeps=1, column_dim=-3, preallocate=False,
+                 checkpoint=False):
         self.source_function = source_function
         self.time_step = time_step
+        self.integrator = integrator
+        self.substeps = substeps
+        self.column_dim = column_dim
+        self.preallocate = preallocate
+        self.checkpoint = checkpoint
 
-    def __call__(self, batch, initial_time=0, prediction_length=None):
+    def __call__(self, batch, initial_time=0, prediction_length=None,
+                 initial_state=None):
 
         if prediction_length is None:
             prediction_length = batch.num_time - initial_time
 
+        is_euler = self.integrator == 'euler' and self.substeps == 1
+        inplace = (self.preallocate and is_euler
+                   and not torch.is_grad_enabled())
+        integrator = get_integrator(self.integrator, self.substeps,
+                                    self.column_dim)
         steps = predict_multiple_steps(
             self.source_function, batch, initial_time, prediction_length,
-            self.time_step)
-        state = [state for t, state, diags in steps]
-        return tensordict.stack(state, dim=batch.time_dim)
+            self.time_step, checkpoint=self.checkpoint, inplace=inplace,
+            integrator=integrator, initial_state=initial_state)
+
+        if not self.preallocate:
+            state = [state for t, state, diags in steps]
+            return tensordict.stack(state, dim=batch.time_dim)
+
+        output = None
+        for i, (t, state, diags) in enumerate(steps):
+            if output is None:
+                output = _allocate_trajectory(state, prediction_length,
+                                              batch.time_dim)
+            for key in state:
+                output[key].select(batch.time_dim, i).copy_(state[key])
+        return output
+
+
+def _allocate_trajectory(state, length, dim):
+    out = {}
+    for key, val in state.items():
+        shape = list(val.shape)
+        shape.insert(dim, length)
+        out[key] = val.new_empty(shape)
+    return TensorDict(out)
+
+
+def _step(model, batch, t, state, time_step, integrator=euler):
+    known_forcing = batch.get_known_forcings_at_time(t)
+
+    def tendency(state):
+        inputs = batch.get_model_inputs(t, state)
+        apparent_sources = model(inputs)
+        return _tendency(apparent_sources, known_forcing), apparent_sources
+
+    return integrator(tendency, state, time_step)
+
+
+def _euler_step_inplace(model, batch, t, state, time_step):
+    inputs = batch.get_model_inputs(t, state)
+    apparent_sources = model(inputs)
+    known_forcing = batch.get_known_forcings_at_time(t)
+    tendency = _tendency(apparent_sources, known_forcing)
+    state.add_scaled_(tendency, time_step)
+    return state, apparent_sources
+
+
+def _step_checkpoint(model, batch, t, state, time_step, integrator=euler):
+    keys = list(state)
+    source_keys = []
+
+    def step(*values):
+        state = TensorDict(dict(zip(keys, values)))
+        state, sources = _step(model, batch, t, state, time_step, integrator)
+        source_keys[:] = list(sources)
+        return tuple(state[key] for key in keys) + tuple(
+            sources[key] for key in source_keys)
+
+    values = [state[key] for key in keys]
+    if _NON_REENTRANT_CHECKPOINT:
+        out = checkpoint_function(step, *values, use_reentrant=False)
+    else:
+        # the reentrant checkpoint only tracks gradients if an input requires
+        # them
+        dummy = torch.ones(1, requires_grad=True)
+        out = checkpoint_function(lambda dummy, *values: step(*values),
+                                  dummy, *values)
+    state = TensorDict(dict(zip(keys, out[:len(keys)])))
+    sources = TensorDict(dict(zip(source_keys, out[len(keys):])))
+    return state, sources
 
 
 def predict_multiple_steps(model, batch: Batch, initial_time,
-                           prediction_length, time_step):
-    """Yield Euler step predictions with a neural network"""
-    state = batch.get_prognostics_at_time(initial_time)
+                           prediction_length, time_step, checkpoint=False,
+                           inplace=False, integrator=euler,
+                           initial_state=None):
+    """Yield predictions with a neural network
+
+    The steps are taken by ``integrator`` (see :func:`get_integrator`), with
+    the known forcing held fixed over each time step. If ``inplace`` is True,
+    forward Euler steps update and yield the same state object at every step,
+    so it must be copied by the caller. This is only possible if autograd is
+    disabled. If ``checkpoint`` is True, the source function is recomputed
+    during the backward pass. The prediction starts from ``initial_state`` if
+    given, and the prognostics at ``initial_time`` otherwise.
+    """
+    if initial_state is None:
+        state = batch.get_prognostics_at_time(initial_time)
+    else:
+        state = TensorDict(initial_state)
+    if inplace:
+        if torch.is_grad_enabled():
+            raise ValueError("In place steps require autograd to be disabled")
+        step = _euler_step_inplace
+        state = state.apply(lambda x: x.clone())
+    elif checkpoint and torch.is_grad_enabled():
+        step = partial(_step_checkpoint, integrator=integrator)
+    else:
+        step = partial(_step, integrator=integrator)
+
     # yield initial_time, state, {}
     for t in range(initial_time, initial_time + prediction_length):
-        inputs = batch.get_model_inputs(t, state)
-        apparent_sources = model(inputs)
-        known_forcing = batch.get_known_forcings_at_time(t)
-        state = state + (apparent_sources/86400 + known_forcing) * time_step
+        state, apparent_sources = step(model, batch, t, state, time_step)
         yield t + 1, state, apparent_sources
 
 
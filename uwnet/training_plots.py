@@ -1,4 +1,5 @@
 import logging
+import os
 
 import attr
 import matplotlib.pyplot as plt
@@ -10,25 +11,35 @@ from .columns import single_column_simulation
 
 @attr.s
 class TrainingPlotManager(object):
-    """Manages the creation of plots during the training process"""
+    """Manages the creation of plots during the training process
+
+    The figures are saved in ``output_dir``.
+    """
 
     experiment = attr.ib()
     model = attr.ib()
     dataset = attr.ib()
     single_column_locations = attr.ib()
     interval = attr.ib(default=1)
+    output_dir = attr.ib(default='.')
 
     def __call__(self, engine):
         return self.plot(engine)
 
     def plot(self, engine):
-        n = engine.state.epoch
+        return self.plot_epoch(engine.state.epoch)
+
+    def plot_epoch(self, n):
+        """Make the plots for epoch n
 
+        This does not use the training engine, so it can be called from a
+        background thread.
+        """
         if n % self.interval != 0:
             return
 
         ex = self.experiment
-        imbalance_plot(self.model, self.dataset, engine)
+        imbalance_plot(self.model, self.dataset, n, self.output_dir)
         single_column_plots = [plot_q2(ex), plot_scatter_q2_fqt(ex)]
         for y, x in self.single_column_locations:
             location = self.dataset.isel(
@@ -40,9 +51,10 @@ class TrainingPlotManager(object):
                 continue
 
             for plot in single_column_plots:
-                plot.save_figure(f'{engine.state.epoch}-{y}', location, output)
+                plot.save_figure(f'{n}-{y}', location, output,
+                                 output_dir=self.output_dir)
 
-            i = engine.state.epoch
+            i = n
             filenames = [
                 name + f'{i}-{y}'
                 for name in ['qt', 'fqtnn', 'fqtnn-obs', 'pw']
@@ -96,10 +108,10 @@ class Plot(object):
     def get_filename(self, epoch):
         return self.name.format(epoch)
 
-    def save_figure(self, epoch, location, output):
+    def save_figure(self, epoch, location, output, output_dir='.'):
         fig, ax = plt.subplots()
         self.plot(location, output, ax)
-        path = self.get_filename(epoch)
+        path = os.path.join(output_dir, self.get_filename(epoch))
         logging.info(f"Saving to {path}")
         fig.savefig(path)
         self.ex.add_artifact(path)
@@ -125,9 +137,8 @@ class plot_scatter_q2_fqt(Plot):
         plt.colorbar(im, ax=ax)
 
 
-def imbalance_plot(model, dataset, engine):
+def imbalance_plot(model, dataset, n, output_dir='.'):
     from uwnet.thermo import lhf_to_evap
-    n = engine.state.epoch
     mass = dataset.layer_mass
     subset = dataset.isel(time=slice(0, None, 20))
     out = model.call_with_xr(subset)
@@ -148,6 +159,6 @@ def imbalance_plot(model, dataset, engine):
         df = plotme.squeeze().to_series()
         df.plot(kind='bar')
 
-    plt.savefig(f"{n}-imbalance.png")
+    plt.savefig(os.path.join(output_dir, f"{n}-imbalance.png"))
 
     plt.close()
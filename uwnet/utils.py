@@ -1,3 +1,15 @@
+import hashlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 import torch
 from toolz import merge_with, first, merge
 import itertools
@@ -175,3 +187,198 @@ def dataarray_to_broadcastable_array(
 def dataset_to_broadcastable_array_dict(dataset, dims):
     return {key: dataarray_to_broadcastable_array(dataset[key], dims)
             for key in dataset.data_vars}
+
+
+def dataset_fingerprint(data):
+    """Hash of the metadata, coordinates, and first time point of a dataset
+
+    This is cheap to compute for large on-disk datasets, and changes if the
+    variables, their shapes, dtypes, or attributes, the coordinates, or the
+    values at the first time are different.
+    """
+    sha = hashlib.sha256()
+
+    def update(obj):
+        sha.update(json.dumps(obj, sort_keys=True, default=str).encode())
+
+    update(data.attrs)
+    for name in sorted(data.coords):
+        coord = data.coords[name]
+        update([name, coord.dims, coord.attrs])
+        sha.update(np.ascontiguousarray(coord.values).tobytes())
+
+    for name in sorted(data.data_vars):
+        var = data[name]
+        update([name, var.dims, var.shape, str(var.dtype), var.attrs])
+        if 'time' in var.dims:
+            var = var.isel(time=0)
+        sha.update(np.ascontiguousarray(var.values).tobytes())
+
+    return sha.hexdigest()
+
+
+def atomic_save(save, path):
+    """Write a file with ``save(tmp_path)`` and move it to ``path``
+
+    A run which is interrupted, or which loads the file while another writes
+    it, never sees a partial file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        save(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def load_module(path, **kwargs):
+    """Load a pickled module saved with torch.save
+
+    torch >= 2.6 only loads tensors by default, so ``weights_only=False`` is
+    passed if torch.load accepts it.
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        kwargs.setdefault('weights_only', False)
+    return torch.load(path, **kwargs)
+
+
+def spawn_process_pool(max_workers, **kwargs):
+    """ProcessPoolExecutor whose workers are started with spawn
+
+    Forking after dask or torch have started threads can deadlock.
+    """
+    context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers, mp_context=context, **kwargs)
+
+
+# the dataset of a worker of dataset_process_pool
+_worker_dataset = None
+
+
+def _set_worker_dataset(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def worker_dataset():
+    """The dataset of a worker of :func:`dataset_process_pool`"""
+    return _worker_dataset
+
+
+def dataset_process_pool(max_workers, dataset):
+    """spawn_process_pool whose workers receive ``dataset`` once
+
+    The functions run in the pool get it with :func:`worker_dataset`, so that
+    it is not pickled with every call.
+    """
+    return spawn_process_pool(max_workers, initializer=_set_worker_dataset,
+                              initargs=(dataset, ))
+
+
+def map_ordered(fun, args, num_workers=1, executor=None, depth=None):
+    """Map a function over args with a bounded number of pending calls
+
+    The results are yielded in the same order as ``args`` regardless of the
+    order the calls finish in.
+
+    Parameters
+    ----------
+    fun : callable
+    args : iterable
+    num_workers : int
+        size of the thread pool used if ``executor`` is not given. With one
+        worker, the calls are made in the calling thread.
+    executor : concurrent.futures.Executor, optional
+    depth : int, optional
+        the number of pending calls. Defaults to twice ``num_workers``.
+    """
+    depth = depth or 2 * num_workers
+    if executor is None:
+        if num_workers <= 1:
+            yield from map(fun, args)
+        else:
+            with ThreadPoolExecutor(num_workers) as executor:
+                yield from map_ordered(fun, args, executor=executor,
+                                       depth=depth)
+        return
+
+    args = iter(args)
+    futures = deque()
+
+    def submit_next():
+        for arg in args:
+            futures.append(executor.submit(fun, arg))
+            return
+
+    try:
+        for _ in range(depth):
+            submit_next()
+
+        while futures:
+            result = futures.popleft().result()
+            submit_next()
+            yield result
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+class BackgroundWorker(object):
+    """Run functions in order in a background thread
+
+    At most ``maxsize`` calls wait in the queue, so :meth:`submit` blocks if
+    the worker falls behind. An exception raised by a call is logged, and
+    re-raised by the next :meth:`submit`, :meth:`flush`, or :meth:`close`.
+    If ``background`` is False, the functions are called by :meth:`submit`.
+    """
+
+    def __init__(self, maxsize=2, background=True):
+        self.background = background
+        self._error = None
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                fun, args, kwargs = item
+                if self._error is None:
+                    fun(*args, **kwargs)
+            except Exception as e:
+                logging.getLogger(__name__).exception(
+                    "Error in background worker")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, fun, *args, **kwargs):
+        self._raise()
+        if self.background:
+            self._queue.put((fun, args, kwargs))
+        else:
+            fun(*args, **kwargs)
+
+    def flush(self):
+        """Wait for the submitted calls to finish"""
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        """Wait for the submitted calls and stop the thread"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
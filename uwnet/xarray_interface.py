@@ -1,9 +1,12 @@
 from functools import partial
+from itertools import product
 
+import numpy as np
 import torch
 import xarray as xr
 from toolz import pipe
 from .tensordict import TensorDict
+from .utils import map_ordered
 
 
 def _is_at_least_2d(da):
@@ -26,17 +29,21 @@ def dataset_to_torch_dict(ds):
     })
 
 
+def _output_dims(dims):
+    """Dimensions of the 2D and 3D outputs and the index of z"""
+    dims_2d = [dim for dim in ['time', 'y', 'x'] if dim in dims]
+    dims_3d = [dim for dim in ['time', 'z', 'y', 'x'] if dim in dims]
+    z_dim = 1 if 'time' in dims_2d else 0
+    return dims_2d, dims_3d, z_dim
+
+
 def _torch_dict_to_dataset(output, coords):
     # parse output
     data_vars = {}
 
-    dims_2d = [dim for dim in ['time', 'y', 'x'] if dim in coords.dims]
-    dims_3d = [dim for dim in ['time', 'z', 'y', 'x'] if dim in coords.dims]
-
-    time_dim_present = 'time' in dims_2d
+    dims_2d, dims_3d, z_dim = _output_dims(coords.dims)
 
     for key, val in output.items():
-        z_dim = 1 if time_dim_present else 0
         nz = val.size(z_dim)
 
         if nz == 1:
@@ -59,19 +66,185 @@ def _assert_no_null_dimensions(ds):
                 )
 
 
-def call_with_xr(self, ds, **kwargs):
-    """Call the neural network with xarray inputs"""
+def _get_blocks(sizes, chunks):
+    """Indexers of the blocks of a dataset
+
+    Parameters
+    ----------
+    sizes : dict
+        length of each dimension
+    chunks : dict
+        size of the blocks along each dimension. Either an int or a sequence
+        of block sizes like the dask chunks.
+
+    Returns
+    -------
+    list of dicts
+        slice of each chunked dimension
+    """
+    slices = []
+    for dim, chunk in chunks.items():
+        if dim not in sizes:
+            continue
+        n = sizes[dim]
+        if isinstance(chunk, int):
+            starts = list(range(0, n, chunk)) + [n]
+        else:
+            starts = np.cumsum([0] + list(chunk)).tolist()
+        slices.append([(dim, slice(start, stop))
+                       for start, stop in zip(starts[:-1], starts[1:])])
+    return [dict(block) for block in product(*slices)]
+
+
+def _call_block(self, ds, block, kwargs):
+    tensordict = dataset_to_torch_dict(ds.isel(block))
+    with torch.no_grad():
+        return block, self(tensordict, **kwargs)
+
+
+def _call_with_xr_chunked(self, ds, chunks, num_workers=1, **kwargs):
+    if chunks == 'auto':
+        chunks = {dim: ds.chunks[dim] for dim in ['time', 'y', 'x']
+                  if dim in ds.chunks}
+    if 'z' in chunks:
+        raise ValueError("The z dimension cannot be chunked")
+
+    dims_2d, dims_3d, z_dim = _output_dims(ds.coords.dims)
+    blocks = _get_blocks(ds.sizes, chunks)
+    outputs = {}
+    data_vars = {}
+
+    call = partial(_call_block, self, ds, kwargs=kwargs)
+    for block, output in map_ordered(call, blocks, num_workers):
+        for key, val in output.items():
+            nz = val.size(z_dim)
+            if key not in outputs:
+                dims = dims_2d if nz == 1 else dims_3d
+                shape = [nz if dim == 'z' else ds.sizes[dim] for dim in dims]
+                outputs[key] = np.empty(shape, dtype=val.numpy().dtype)
+                data_vars[key] = (dims, outputs[key])
+
+            dims = data_vars[key][0]
+            index = tuple(block.get(dim, slice(None)) for dim in dims)
+            val = val.numpy()
+            if nz == 1 and 'z' not in dims:
+                val = val.squeeze(z_dim)
+            if val.shape != outputs[key][index].shape:
+                raise ValueError(
+                    f"The output '{key}' has shape {val.shape} but the "
+                    f"block has shape {outputs[key][index].shape}. Models "
+                    "which change the size of the chunked dimensions cannot "
+                    "be called in chunks.")
+            outputs[key][index] = val
+
+    return xr.Dataset(data_vars, coords=dict(ds.coords.items()))
+
+
+def call_with_xr(self, ds, chunks=None, num_workers=1, **kwargs):
+    """Call the neural network with xarray inputs
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+    chunks : dict or 'auto', optional
+        If given, the model is called on blocks of the dataset with these
+        sizes along the time, y, and x dimensions, and the outputs are
+        written into preallocated arrays. This bounds the memory used by the
+        inputs and model intermediates. If 'auto', the blocks are the dask
+        chunks of ``ds``.
+    num_workers : int
+        number of threads loading and predicting blocks at once. Only used if
+        ``chunks`` is given.
+    **kwargs
+        passed to the model
+    """
     _assert_no_null_dimensions(ds)
+    if chunks is not None:
+        return _call_with_xr_chunked(self, ds, chunks,
+                                     num_workers=num_workers, **kwargs)
+
     tensordict = dataset_to_torch_dict(ds)
     with torch.no_grad():
         output = self(tensordict, **kwargs)
     return _torch_dict_to_dataset(output, ds.coords)
 
 
+def _nested_blocks(dims, num_blocks, leaf, index=()):
+    """Nested lists of blocks for dask.array.block"""
+    if len(index) == len(dims):
+        return leaf(index)
+    dim = dims[len(index)]
+    return [_nested_blocks(dims, num_blocks, leaf, index + (i, ))
+            for i in range(num_blocks.get(dim, 1))]
+
+
+def call_with_xr_lazy(self, ds, **kwargs):
+    """Lazily call the neural network on each dask chunk of a dataset
+
+    The model is called once on a single column to find the names and sizes
+    of the outputs. The returned dataset is backed by dask, so reductions of
+    the outputs are computed chunk by chunk, and each chunk of the inputs is
+    passed to the model once.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        dask-backed dataset. The z dimension must not be chunked.
+    **kwargs
+        passed to the model
+
+    Returns
+    -------
+    xr.Dataset
+        dask-backed outputs with the same chunks as ``ds``
+    """
+    import dask
+    import dask.array as da
+
+    if not ds.chunks:
+        raise ValueError("The dataset must be backed by dask. Use ds.chunk.")
+    if len(ds.chunks.get('z', ())) > 1:
+        raise ValueError("The z dimension cannot be chunked")
+    _assert_no_null_dimensions(ds)
+
+    chunks = {dim: ds.chunks[dim] for dim in ['time', 'y', 'x']
+              if dim in ds.chunks}
+    num_blocks = {dim: len(sizes) for dim, sizes in chunks.items()}
+    sample = ds.isel({dim: slice(0, 1) for dim in chunks})
+    sample_output = call_with_xr(self, sample, **kwargs)
+
+    starts = {dim: np.cumsum((0, ) + sizes) for dim, sizes in chunks.items()}
+    predictions = {}
+    for position in product(*(range(n) for n in num_blocks.values())):
+        block = {dim: slice(starts[dim][i], starts[dim][i + 1])
+                 for dim, i in zip(chunks, position)}
+        predictions[position] = dask.delayed(call_with_xr)(
+            self, ds.isel(block), **kwargs)
+
+    data_vars = {}
+    for key in sample_output.data_vars:
+        var = sample_output[key]
+
+        def leaf(index, key=key, var=var):
+            index = dict(zip(var.dims, index))
+            position = tuple(index[dim] for dim in chunks)
+            shape = tuple(chunks[dim][index[dim]] if dim in chunks
+                          else var.sizes[dim] for dim in var.dims)
+            return da.from_delayed(predictions[position][key].values, shape,
+                                   dtype=var.dtype)
+
+        data_vars[key] = (var.dims, da.block(
+            _nested_blocks(var.dims, num_blocks, leaf)))
+
+    return xr.Dataset(data_vars, coords=dict(ds.coords.items()))
+
+
 class XRCallMixin(object):
     """PyTorch module for predicting Q1, Q2 and maybe Q3"""
     call_with_xr = call_with_xr
     predict = call_with_xr
+    call_with_xr_lazy = call_with_xr_lazy
+    predict_lazy = call_with_xr_lazy
 
 
 class XarrayWrapper(object):